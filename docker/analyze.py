@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+"""Analyze the critical path and parallelism of the last build of every target.
+
+Combines the package dependencies of "make show-info" with the step timings of
+build/build-time.log, and writes build-graph.json and build-graph.html to the .retroroot
+directory of each target. Targets that were never built are skipped.
+"""
+import sys
+import argparse
+from typing import List
+from lib.build_graph import BuildGraph
+from lib.dirs import Dirs
+from lib.init_parse import InitParse
+
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", maxsplit=1)[0])
+    InitParse.add_arguments(parser, "The env files of which to analyze the targets")
+    parser.add_argument(
+        "--cores", type=int, default=0, help="The cores of the build. Default: BUILD_CORES"
+    )
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    analyzed = 0
+    failed = 0
+    for config in InitParse.parse_env_files(args.env_files, args.target):
+        config_obj = config.config
+        if not Dirs.exists(config_obj["build_path"]):
+            continue
+        analyzed += 1
+        if not BuildGraph(config_obj, args.cores or None).run():
+            failed += 1
+    if not analyzed:
+        print("No built targets to analyze")
+    sys.exit(1 if failed or not analyzed else 0)
+
+
+if __name__ == "__main__":
+    main()
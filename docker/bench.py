@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+"""Benchmark the orchestration layer against a stand-in make.
+
+Generates a synthetic Buildroot tree with many targets and fragments, puts a fake make and
+brmake first in the PATH and times each phase of the init.py flow: parse, apply, re-apply
+with unchanged inputs, clean and build dispatch. No docker or network access is needed.
+
+For each phase the wall time, the read/write syscalls and the peak RSS of the orchestrator
+are reported, from /proc/self. With --strace, every syscall of the phase and the processes
+it spawns is counted as well.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+from typing import Any, Callable, Dict, List
+from lib.init_parse import InitParse
+from lib.scheduler import Scheduler
+
+FAKE_MAKE = r"""#!/bin/sh
+# Stand-in for make and brmake used by bench.py.
+out=""
+defconfig=""
+for arg in "$@"; do
+  case "${arg}" in
+    O=*) out="${arg#O=}" ;;
+    DEFCONFIG=*) defconfig="${arg#DEFCONFIG=}" ;;
+  esac
+done
+for arg in "$@"; do
+  case "${arg}" in
+    defconfig)
+      mkdir -p "${out}"
+      cp "${defconfig}" "${out}/.config"
+      exit 0
+      ;;
+    show-targets) echo "host-pkgconf zlib mesa3d retroarch"; exit 0 ;;
+    clean|olddefconfig) exit 0 ;;
+  esac
+done
+mkdir -p build
+now=$(date +%s.%N)
+printf "%s:%-5.5s:%-20.20s: %s\n" "${now}" start build zlib >> build/build-time.log
+printf "%s:%-5.5s:%-20.20s: %s\n" "${now}" end build zlib >> build/build-time.log
+echo ">>> zlib 1.3 Building"
+exit 0
+"""
+
+PHASES = ["parse", "apply", "apply (unchanged)", "clean", "build dispatch"]
+
+
+class Bench:
+    """Synthetic tree generation and phase measurement."""
+
+    @staticmethod
+    def __proc_io() -> Dict[str, int]:
+        counters = {"syscr": 0, "syscw": 0}
+        try:
+            with open("/proc/self/io", encoding="utf-8") as io_fd:
+                for line in io_fd:
+                    key, _, value = line.partition(":")
+                    if key in counters:
+                        counters[key] = int(value)
+        except OSError:
+            pass
+        return counters
+
+    @staticmethod
+    def __reset_peak_rss() -> None:
+        try:
+            with open("/proc/self/clear_refs", "w", encoding="utf-8") as clear_refs:
+                clear_refs.write("5")
+        except OSError:
+            pass
+
+    @staticmethod
+    def __peak_rss() -> int:
+        """Get the peak RSS in KiB since the last reset."""
+        try:
+            with open("/proc/self/status", encoding="utf-8") as status:
+                for line in status:
+                    if line.startswith("VmHWM:"):
+                        return int(line.split()[1])
+        except OSError:
+            pass
+        return 0
+
+    def generate(self) -> List[str]:
+        """Generate the synthetic Buildroot tree, fake make and env files.
+
+        :returns: The paths of the generated env files.
+        :rtype: List[str]
+        """
+        buildroot = f"{self.root}/buildroot"
+        tree = f"{buildroot}/retroroot"
+        os.makedirs(f"{tree}/configs/fragments")
+        os.makedirs(f"{self.root}/bin")
+        with open(f"{buildroot}/Makefile", "w", encoding="utf-8") as makefile:
+            makefile.write("export BR2_VERSION := 2024.02.9\n")
+        with open(f"{tree}/external.desc", "w", encoding="utf-8") as desc:
+            desc.write("name: RETROROOT\n")
+        with open(f"{tree}/Config.in", "w", encoding="utf-8") as config_in:
+            for ndx in range(self.args.packages):
+                config_in.write(f'source "$BR2_EXTERNAL_RETROROOT_PATH/package/pkg{ndx}/Config.in"\n')
+        for ndx in range(self.args.packages):
+            os.makedirs(f"{tree}/package/pkg{ndx}")
+            with open(f"{tree}/package/pkg{ndx}/Config.in", "w", encoding="utf-8") as pkg:
+                pkg.write(f"config BR2_PACKAGE_PKG{ndx}\n\tbool \"pkg{ndx}\"\n")
+        fragments: List[str] = []
+        for ndx in range(self.args.fragments):
+            name = f"fragment{ndx}.fragment"
+            fragments.append(name)
+            with open(f"{tree}/configs/fragments/{name}", "w", encoding="utf-8") as fragment:
+                for symbol in range(self.args.symbols):
+                    fragment.write(f"BR2_PACKAGE_SYMBOL_{(ndx * 7 + symbol) % 5000}=y\n")
+                fragment.write(f'BR2_PACKAGE_STRING_{ndx}="$(TOPDIR)/value {ndx}"\n')
+                fragment.write(f"# BR2_PACKAGE_UNSET_{ndx} is not set\n")
+        for make in ("make", "brmake"):
+            with open(f"{self.root}/bin/{make}", "w", encoding="utf-8") as fake_make:
+                fake_make.write(FAKE_MAKE)
+            os.chmod(f"{self.root}/bin/{make}", 0o755)
+
+        env_files: List[str] = []
+        per_file = max(self.args.targets // self.args.env_files, 1)
+        target = 0
+        for env_ndx in range(self.args.env_files):
+            configs: List[Dict[str, Any]] = []
+            for _ in range(per_file):
+                defconfig = f"board{target}_defconfig"
+                with open(f"{tree}/configs/{defconfig}", "w", encoding="utf-8") as board:
+                    board.write("BR2_arm=y\n")
+                    board.write('BR2_DL_DIR="$(TOPDIR)/retroroot/dl"\n')
+                    board.write("BR2_PER_PACKAGE_DIRECTORIES=y\n")
+                    board.write(f'BR2_TARGET_GENERIC_HOSTNAME="board{target}"\n')
+                start = (target * self.args.fragments_per_target) % self.args.fragments
+                target_fragments = [
+                    fragments[(start + ndx) % self.args.fragments]
+                    for ndx in range(self.args.fragments_per_target)
+                ]
+                configs.append(
+                    {
+                        "build": True,
+                        "clean": True,
+                        "defconfig": defconfig,
+                        "external_trees": [
+                            {
+                                "name": "retroroot",
+                                "fragment_dir": "configs/fragments",
+                                "fragments": target_fragments,
+                            }
+                        ],
+                        "output_tree": "retroroot",
+                        "config_dir_tree": "retroroot",
+                    }
+                )
+                target += 1
+            env_file = f"{self.root}/env{env_ndx}.json"
+            with open(env_file, "w", encoding="utf-8") as env_fd:
+                json.dump(
+                    {
+                        "environment": [{"buildroot_path": buildroot}],
+                        "configs": configs,
+                    },
+                    env_fd,
+                    indent=2,
+                )
+            env_files.append(env_file)
+        return env_files
+
+    def __phase(self, name: str, func: Callable[[], bool]) -> None:
+        """Run and measure a single phase."""
+        self.__reset_peak_rss()
+        io_before = self.__proc_io()
+        start = time.perf_counter()
+        retval = func()
+        wall = time.perf_counter() - start
+        io_after = self.__proc_io()
+        self.results.append(
+            {
+                "phase": name,
+                "success": bool(retval),
+                "wall_seconds": round(wall, 4),
+                "read_syscalls": io_after["syscr"] - io_before["syscr"],
+                "write_syscalls": io_after["syscw"] - io_before["syscw"],
+                "peak_rss_kib": self.__peak_rss(),
+            }
+        )
+
+    def run_phases(self, env_files: List[str], until: int = len(PHASES)) -> None:
+        """Run the phases of the init.py flow for all env files.
+
+        :param List[str] env_files: The env files of which to run.
+        :param int until: Stop after this many phases.
+        """
+        inits: List[InitParse] = []
+
+        def parse() -> bool:
+            for env_file in env_files:
+                init = InitParse(env_file, True, False, False)
+                if not init.parse():
+                    return False
+                inits.append(init)
+            return True
+
+        def apply() -> bool:
+            return all(init.apply() for init in inits)
+
+        def clean() -> bool:
+            return all(init.clean() for init in inits)
+
+        def build() -> bool:
+            scheduler = Scheduler()
+            for init in inits:
+                jobs = init.jobs()
+                if jobs is None:
+                    return False
+                for job in jobs:
+                    scheduler.add(job)
+            return scheduler.run()
+
+        funcs = [parse, apply, apply, clean, build]
+        for name, func in list(zip(PHASES, funcs))[:until]:
+            self.__phase(name, func)
+
+    def child(self, until: int) -> None:
+        """Run the phases with the orchestrator's output silenced.
+
+        This is the entry point of the --run-phases process.
+        """
+        null_fd = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(null_fd, sys.stdout.fileno())
+        os.dup2(null_fd, sys.stderr.fileno())
+        os.environ["PATH"] = f"{self.root}/bin:{os.environ.get('PATH', '')}"
+        os.environ["PARALLEL_BUILDS"] = str(self.args.parallel)
+        os.environ["BUILD_MEMORY_PER_TARGET"] = "1"
+        os.chdir(self.root)
+        env_files = sorted(
+            f"{self.root}/{name}" for name in os.listdir(self.root) if name.endswith(".json")
+        )
+        try:
+            self.run_phases(env_files, until)
+        finally:
+            with open(f"{self.root}/results.json", "w", encoding="utf-8") as result_fd:
+                json.dump(self.results, result_fd)
+
+    def __spawn(self, root: str, until: int, strace_out: str = "") -> None:
+        cmd = [
+            sys.executable,
+            os.path.abspath(__file__),
+            "--run-phases",
+            root,
+            "--until",
+            str(until),
+            "--parallel",
+            str(self.args.parallel),
+        ]
+        if strace_out:
+            cmd = ["strace", "-f", "-c", "-o", strace_out] + cmd
+        subprocess.run(cmd, cwd=os.path.dirname(os.path.abspath(__file__)), check=False)
+
+    @staticmethod
+    def __strace_calls(strace_out: str) -> int:
+        with open(strace_out, encoding="utf-8") as strace_fd:
+            for line in strace_fd:
+                fields = line.split()
+                if fields and fields[-1] == "total" and len(fields) >= 4:
+                    return int(fields[3])
+        return 0
+
+    def __count_syscalls(self) -> None:
+        """Count the syscalls of each phase, including the processes it spawns.
+
+        The phases are run under "strace -f -c" once per phase on a freshly generated tree,
+        stopping after one more phase each time; the count of a phase is the difference with
+        the previous run. The count of the first phase includes the interpreter startup.
+        """
+        previous = 0
+        for until in range(1, len(PHASES) + 1):
+            root = tempfile.mkdtemp(prefix="retroroot-bench-")
+            try:
+                Bench(self.args, root).generate()
+                self.__spawn(root, until, f"{root}/strace.out")
+                calls = self.__strace_calls(f"{root}/strace.out")
+            finally:
+                shutil.rmtree(root, ignore_errors=True)
+            self.results[until - 1]["syscalls"] = calls - previous
+            previous = calls
+
+    def run(self) -> List[Dict[str, Any]]:
+        """Generate the tree and measure every phase in a child process.
+
+        :returns: The measurements of each phase.
+        :rtype: List[Dict[str, Any]]
+        """
+        self.generate()
+        self.__spawn(self.root, len(PHASES))
+        with open(f"{self.root}/results.json", encoding="utf-8") as result_fd:
+            self.results = json.load(result_fd)
+        if self.args.strace and shutil.which("strace"):
+            self.__count_syscalls()
+        return self.results
+
+    def __init__(self, args: argparse.Namespace, root: str):
+        self.args = args
+        self.root = root
+        self.results: List[Dict[str, Any]] = []
+
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", maxsplit=1)[0])
+    parser.add_argument("--targets", type=int, default=48, help="Number of targets")
+    parser.add_argument("--env-files", type=int, default=4, help="Number of env files")
+    parser.add_argument("--fragments", type=int, default=400, help="Number of fragments")
+    parser.add_argument(
+        "--fragments-per-target", type=int, default=40, help="Fragments applied to each target"
+    )
+    parser.add_argument("--symbols", type=int, default=25, help="Symbols per fragment")
+    parser.add_argument("--packages", type=int, default=200, help="External tree packages")
+    parser.add_argument("--parallel", type=int, default=4, help="PARALLEL_BUILDS")
+    parser.add_argument(
+        "--strace", action="store_true", help="Count all syscalls of each phase with strace"
+    )
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    parser.add_argument("--keep", action="store_true", help="Keep the generated tree")
+    parser.add_argument("--run-phases", metavar="ROOT", help=argparse.SUPPRESS)
+    parser.add_argument("--until", type=int, default=len(PHASES), help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    if args.run_phases:
+        Bench(args, args.run_phases).child(args.until)
+        sys.exit(0)
+    root = tempfile.mkdtemp(prefix="retroroot-bench-")
+    try:
+        results = Bench(args, root).run()
+    finally:
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(
+            f"{args.targets} targets, {args.env_files} env files, {args.fragments} fragments "
+            f"({args.fragments_per_target} per target)"
+        )
+        print(
+            f"{'phase':<20}{'wall (s)':>10}{'syscalls':>10}{'read sys':>10}{'write sys':>11}"
+            f"{'peak RSS':>14}"
+        )
+        for result in results:
+            status = "" if result["success"] else "  FAILED"
+            print(
+                f"{result['phase']:<20}{result['wall_seconds']:>10.3f}"
+                f"{result.get('syscalls', '-'):>10}"
+                f"{result['read_syscalls']:>10}{result['write_syscalls']:>11}"
+                f"{result['peak_rss_kib']:>10} KiB{status}"
+            )
+    if args.keep:
+        print(f"Generated tree: {root}")
+    sys.exit(0 if all(result["success"] for result in results) else 1)
+
+
+if __name__ == "__main__":
+    main()
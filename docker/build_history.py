@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""Show the build time trends of every target and flag significant slowdowns.
+
+Reads the build history database each build appends to. For each target the latest runs
+are listed with their duration, ccache hit rate and image size, followed by the target and
+package slowdowns of the latest successful run compared with the runs before it.
+Exits with 1 if any target has a slowdown.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+from typing import Any, Dict, List, Set
+from lib.config import Config
+from lib.history import History
+from lib.init_parse import InitParse
+
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", maxsplit=1)[0])
+    InitParse.add_arguments(parser, "The env files of which to find the databases")
+    parser.add_argument("--db", default="", help="The database. Default: BUILD_HISTORY_DB")
+    parser.add_argument("--runs", type=int, default=10, help="The runs to list per target")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    return parser.parse_args(argv)
+
+
+def databases(args: argparse.Namespace, configs: List[Config]) -> List[str]:
+    """Get the databases of the targets of the env files, or the one given."""
+    if args.db:
+        return [args.db]
+    paths: List[str] = []
+    for config in configs:
+        path = History.db_path(config.config)
+        if path not in paths and os.path.isfile(path):
+            paths.append(path)
+    return paths
+
+
+def target_names(args: argparse.Namespace, configs: List[Config]) -> Set[str]:
+    """Get the names the history records --target under.
+
+    --target is a defconfig name, as SINGLE_TARGET, while the history is keyed on the output
+    directory name, which differs when the env file sets "name". If no config has the
+    defconfig, IE: with --db, --target is taken as the output directory name.
+    """
+    names = {
+        str(config.config["build_path"]).rsplit("/", maxsplit=1)[-1]
+        for config in configs
+        if args.target == config.config["defconfig"].replace("_defconfig", "")
+    }
+    return names or {args.target}
+
+
+def print_target(target: str, runs: List[Dict[str, Any]], regressions: List[Dict]) -> None:
+    print(f"{target}:")
+    print(
+        f"  {'started':<17}{'seconds':>10}{'result':>8}{'kind':>13}{'ccache':>8}"
+        f"{'images MiB':>12}"
+    )
+    for run in runs:
+        started = time.strftime("%Y-%m-%d %H:%M", time.localtime(run["started"]))
+        rate = run["ccache_hit_rate"]
+        kind = {1: "full", 0: "incremental"}.get(run["full"], "-")
+        print(
+            f"  {started:<17}{run['seconds']:>10.0f}{'ok' if run['success'] else 'failed':>8}"
+            f"{kind:>13}"
+            f"{'-' if rate is None else f'{100 * rate:.0f}%':>8}"
+            f"{run['images_bytes'] / 1024**2:>12.1f}"
+        )
+    for regression in regressions:
+        print(
+            f"  SLOWER {regression['name']}: {regression['seconds']}s, "
+            f"{regression['change_percent']:+.1f}% over {regression['baseline_seconds']}s "
+            f"(z={regression['z_score']})"
+        )
+    print()
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    results: Dict[str, Dict[str, Any]] = {}
+    configs = [] if args.db else InitParse.parse_env_files(args.env_files)
+    names = target_names(args, configs)
+    for path in databases(args, configs):
+        history = History(path)
+        for target in history.targets():
+            if args.target and target not in names:
+                continue
+            runs = history.runs(target, args.runs)
+            results[target] = {"runs": runs, "regressions": history.regressions(target)}
+    if args.json:
+        print(json.dumps(results, indent=2))
+    elif not results:
+        print("No build history")
+    else:
+        for target, result in results.items():
+            print_target(target, result["runs"], result["regressions"])
+    sys.exit(1 if any(result["regressions"] for result in results.values()) else 0)
+
+
+if __name__ == "__main__":
+    main()
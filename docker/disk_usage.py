@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""Show the disk usage of every target and enforce the disk budget.
+
+Lists the target directories below the output directories of the env files, least recently
+used first, with their size and what trimming them would free. With --enforce the least
+recently used targets are trimmed and evicted until they fit in DISK_BUDGET, as before a
+build. Exits with 1 if the targets are over the budget.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+from typing import List
+from lib.disk_budget import DiskBudget
+from lib.init_parse import InitParse
+
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", maxsplit=1)[0])
+    InitParse.add_arguments(
+        parser, "The env files of which to measure the output directories", target=False
+    )
+    parser.add_argument(
+        "--budget", default="", help="The budget, IE: 200G. Default: DISK_BUDGET"
+    )
+    parser.add_argument(
+        "--enforce", action="store_true", help="Trim and evict targets until within budget"
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="Only show what --enforce would remove"
+    )
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    if args.budget:
+        os.environ["DISK_BUDGET"] = args.budget
+    disk_budget = DiskBudget()
+    disk_budget.add(
+        {str(config.config["output_dir"]) for config in InitParse.parse_env_files(args.env_files)}
+    )
+    usage = disk_budget.usage()
+    if args.json:
+        print(json.dumps({"budget": disk_budget.limit, "targets": usage}, indent=2))
+    else:
+        print(f"{'last used':<17}{'GiB':>8}{'trimmable':>11}  target")
+        for target, entry in usage.items():
+            last_used = time.strftime("%Y-%m-%d %H:%M", time.localtime(entry["last_used"]))
+            print(
+                f"{last_used:<17}{entry['bytes'] / 1024**3:>8.1f}"
+                f"{entry['trimmable_bytes'] / 1024**3:>11.1f}  {target}"
+            )
+        total = sum(entry["bytes"] for entry in usage.values())
+        budget = "no" if disk_budget.limit is None else f"{disk_budget.limit / 1024**3:.1f} GiB"
+        print(f"Total: {total / 1024**3:.1f} GiB, {budget} budget")
+    if args.enforce or args.dry_run:
+        sys.exit(0 if disk_budget.run(args.dry_run) else 1)
+    within = disk_budget.limit is None or sum(
+        entry["bytes"] for entry in usage.values()
+    ) <= disk_budget.limit
+    sys.exit(0 if within else 1)
+
+
+if __name__ == "__main__":
+    main()
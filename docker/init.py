@@ -3,9 +3,12 @@ import os
 import sys
 import signal
 from typing import List
+from lib.coordinator import Coordinator
+from lib.daemon import Daemon
 from lib.files import Files
 from lib.init_parse import InitParse
 from lib.logger import Logger
+from lib.scheduler import Scheduler
 
 
 def signal_handler(sig, _):
@@ -14,20 +17,49 @@ def signal_handler(sig, _):
     :param int sig: The signal of which to handle.
     :param object _: unused frame stack.
     """
-    if sig == signal.SIGINT:
+    if sig in (signal.SIGINT, signal.SIGTERM):
         print("\n## Exiting. ##\n")
         sys.exit(0)
 
 
 class Init:
+    def distribute(self):
+        # The workers apply and build the targets, this container only collects the results.
+        coordinator = Coordinator()
+        for env_file in self.env_files:
+            if not coordinator.add(env_file):
+                sys.exit(-1)
+        if not coordinator.run():
+            sys.exit(-1)
+
     def run(self):
+        if Coordinator.enabled() and not self.nb:
+            self.distribute()
+            return
+        # Prepare every env file first, then build the targets of all env files together so
+        # the scheduler can run them side by side.
+        scheduler = Scheduler()
         for env_file in self.env_files:
             init = InitParse(
                 env_file, self.apply_configs, self.nb, self.clean_after_build
             )
-            if not init.run():
+            if not init.prepare():
+                sys.exit(-1)
+            jobs = init.jobs()
+            if jobs is None:
                 sys.exit(-1)
-            os.chdir(self.cwd)
+            for job in jobs:
+                scheduler.add(job)
+        # A failed prefetch is not fatal, the builds download what is missing.
+        InitParse.prefetch(scheduler.jobs)
+        # Nor is a corrupt source, the builds download it again.
+        InitParse.verify_downloads(scheduler.jobs)
+        # Nor is sharing host packages, the builds build the packages they lack.
+        InitParse.share_host_tools(scheduler.jobs)
+        # Over the disk budget, the builds still run with what space is left.
+        InitParse.enforce_disk_budget(scheduler.jobs)
+        if not scheduler.run():
+            sys.exit(-1)
 
     def check_env_files(self):
         env_files: List[str] = os.environ.get("ENV_FILES", "x86_64.json").split(":")
@@ -43,7 +75,11 @@ class Init:
                 sys.exit(-1)
 
     def parse_env(self):
-        self.apply_configs = os.environ.get("APPLY_CONFIGS", False)
+        self.apply_configs = (
+            True
+            if os.environ.get("APPLY_CONFIGS", "false").lower() == "true"
+            else False
+        )
         self.clean_after_build = (
             True
             if os.environ.get("CLEAN_AFTER_BUILD", "false").lower() == "true"
@@ -68,6 +104,11 @@ class Init:
 
 def main():
     signal.signal(signal.SIGINT, signal_handler)
+    if os.environ.get("DAEMON", "false").lower() == "true":
+        signal.signal(signal.SIGTERM, signal_handler)
+        clean_after_build = os.environ.get("CLEAN_AFTER_BUILD", "false").lower() == "true"
+        Daemon(clean_after_build).serve()
+        sys.exit(0)
     init = Init()
     init.parse_env()
     init.run()
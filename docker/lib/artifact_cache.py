@@ -0,0 +1,535 @@
+"""Content-addressed cache of per-package build outputs"""
+import os
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import contextlib
+from typing import Any, Dict, Iterator, List, Set, Tuple, Union
+from lib.files import Files
+from lib.fingerprint import Fingerprint
+from lib.kconfig import KConfig
+from lib.logger import Logger
+from lib.metrics import BuildMonitor
+from lib.packages import Packages
+from lib.state import State
+
+
+class ArtifactCache:
+    """Keep the build outputs of every package and restore them instead of building again.
+
+    Only targets with BR2_PER_PACKAGE_DIRECTORIES are cached, as their packages install into
+    output/<target>/per-package/<package> rather than into one shared host and target
+    directory.
+
+    - Each package gets a key: a hash of the target's output directory, the Buildroot
+      version, the package's version and sources, the files of its package directory, its
+      global patches, its config options and the files they point to, the target-wide
+      options that change how packages build, and the keys of its dependencies.
+    - After a successful build, every installed package whose key is not cached is saved:
+      its per-package and build directories, the files it installed into images/ according
+      to build/build-time.log, and its lines of Buildroot's package file lists.
+    - Before a build, every package that is not installed and whose key is cached is
+      restored, dependencies first, with its times and modes. Files shared between
+      per-package directories are hardlinked again, like Buildroot does. The build that
+      follows only builds the misses.
+    - Files are stored once by content under objects/, and never hardlinked into a build, so
+      a build writing a file in place can't alter the cache. The size of every object is
+      checked before restoring an entry, ARTIFACT_CACHE_VERIFY=true checks its sha256 as
+      well. An entry with a missing or damaged object is dropped and the package is built.
+    - ARTIFACT_CACHE_SIZE, IE: 50G, evicts the least recently used entries after saving.
+    - The hits and misses of each build are logged and kept in the per-target state under
+      "artifact_cache".
+
+    The output directory is part of the key, so entries are only restored into the target
+    they were built for, IE: after CLEAN_AFTER_BUILD or "remove": true.
+
+    Environment variables:
+      - ARTIFACT_CACHE: Cache the build outputs of every package. Default: false
+      - ARTIFACT_CACHE_DIR: The cache directory. Default: <output dir>/.artifact-cache
+      - ARTIFACT_CACHE_SIZE: The maximum size of the cache, IE: 50G. Default: unlimited
+      - ARTIFACT_CACHE_VERIFY: Check the sha256 of every file restored. Default: false
+    """
+
+    # Options that change how every package is built.
+    GLOBAL_PREFIXES = (
+        "BR2_ARCH",
+        "BR2_ENDIAN",
+        "BR2_GCC_TARGET_",
+        "BR2_TOOLCHAIN",
+        "BR2_OPTIMIZE_",
+        "BR2_ENABLE_",
+        "BR2_STRIP_",
+        "BR2_SHARED_",
+        "BR2_STATIC_LIBS",
+        "BR2_INIT_",
+        "BR2_ROOTFS_MERGED_",
+        "BR2_SYSTEM_",
+        "BR2_TIME_BITS_",
+        "BR2_FORTIFY_SOURCE_",
+        "BR2_SSP_",
+        "BR2_RELRO_",
+        "BR2_PIC_PIE",
+        "BR2_REPRODUCIBLE",
+    )
+    # Packages whose options are not named after them.
+    SYMBOL_PREFIXES = {"linux": ("BR2_LINUX_KERNEL",), "linux-headers": ("BR2_KERNEL_HEADERS",)}
+    UNITS = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+    @staticmethod
+    def enabled() -> bool:
+        """Check if the artifact cache is enabled.
+
+        :returns: True if ARTIFACT_CACHE is set to true.
+        :rtype: bool
+        """
+        return os.environ.get("ARTIFACT_CACHE", "false").lower() == "true"
+
+    @staticmethod
+    def parse_size(size: str) -> Union[None, int]:
+        """Parse a size like 500M or 50G.
+
+        :param str size: A number of bytes with an optional K, M, G or T suffix.
+        :returns: The size in bytes, or None if it can't be parsed.
+        :rtype: Union[None, int]
+        """
+        size = size.strip().upper().rstrip("IB")
+        multiplier = ArtifactCache.UNITS.get(size[-1:], 1)
+        try:
+            return int(float(size.rstrip("KMGT")) * multiplier)
+        except ValueError:
+            return None
+
+    @contextlib.contextmanager
+    def __lock(self, exclusive: bool = False) -> Iterator[None]:
+        """Lock the cache. Eviction takes it exclusively, everything else shares it."""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(f"{self.cache_dir}/.lock", "a", encoding="utf-8") as lock_fd:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_fd, fcntl.LOCK_UN)
+
+    def __hash_tree(self, path: str, skip: Set[str]) -> str:
+        """Hash the names and contents of the files below a path, skipping some directories."""
+        sha256 = hashlib.sha256()
+        if os.path.isfile(path):
+            return Fingerprint.hash_file(path) or ""
+        for root, dirs, names in os.walk(path):
+            dirs[:] = sorted(name for name in dirs if f"{root}/{name}" not in skip)
+            for name in sorted(names):
+                sha256.update(f"{root[len(path):]}/{name}\0".encode())
+                sha256.update((Fingerprint.hash_file(f"{root}/{name}") or "").encode())
+        return sha256.hexdigest()
+
+    def __symbols(self, package: str, kconfig: KConfig) -> Dict[str, Any]:
+        """Get the options of a package and the hashes of the files they point to."""
+        name = package[len("host-"):] if package.startswith("host-") else package
+        upper = package.upper().replace("-", "_")
+        prefixes = self.SYMBOL_PREFIXES.get(
+            package, (f"BR2_PACKAGE_{upper}", f"BR2_TARGET_{upper}")
+        ) + self.GLOBAL_PREFIXES
+        symbols: Dict[str, Any] = {}
+        for symbol, raw in sorted(kconfig.raw.items()):
+            if not symbol.startswith(prefixes) and not symbol.endswith(f"_{upper}"):
+                continue
+            value = kconfig.get(symbol)
+            files = {}
+            for word in (value or "").split():
+                path = os.path.join(self.buildroot_path, word)
+                if word != name and os.path.exists(path):
+                    files[word] = self.__hash_tree(path, set())
+            symbols[symbol] = [raw, files] if files else raw
+        return symbols
+
+    def keys(self) -> Dict[str, str]:
+        """Get the key of every package of the target.
+
+        :returns: A dictionary of package names and keys.
+        :rtype: Dict[str, str]
+        """
+        kconfig = KConfig.load(f"{self.build_path}/.config", self.buildroot_path)
+        package_dirs = Packages.package_dirs(
+            self.buildroot_path, str(self.config_obj["external_trees"])
+        )
+        patch_dirs = [
+            os.path.join(self.buildroot_path, directory)
+            for directory in (kconfig.get("BR2_GLOBAL_PATCH_DIR") or "").split()
+        ]
+        common = {
+            "build-path": self.build_path,
+            "buildroot-version": Fingerprint.buildroot_version(self.buildroot_path),
+        }
+        keys: Dict[str, str] = {}
+        for package in Packages.build_order(self.info, self.info):
+            package_info = self.info[package]
+            if not isinstance(package_info, dict):
+                continue
+            name = package[len("host-"):] if package.startswith("host-") else package
+            package_dir = package_dirs.get(name, "")
+            # Packages nested in the directory of another have their own key.
+            nested = {path for path in package_dirs.values() if path != package_dir}
+            payload = dict(
+                common,
+                package=package,
+                version=package_info.get("version"),
+                sources=[download.get("source") for download in package_info.get("downloads", [])],
+                package_dir=self.__hash_tree(package_dir, nested) if package_dir else None,
+                patches=[
+                    self.__hash_tree(f"{directory}/{name}", set())
+                    for directory in patch_dirs
+                    if os.path.isdir(f"{directory}/{name}")
+                ],
+                symbols=self.__symbols(package, kconfig),
+                dependencies={
+                    dependency: keys.get(dependency)
+                    for dependency in sorted(package_info.get("dependencies", []))
+                },
+            )
+            keys[package] = hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+        return keys
+
+    def __object_path(self, sha: str) -> str:
+        return f"{self.cache_dir}/objects/{sha[:2]}/{sha}"
+
+    def __store(self, path: str, stat: os.stat_result) -> str:
+        """Store a file by content, hashing each inode once."""
+        inode = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        sha = self.hashes.get(inode)
+        if sha is None:
+            sha = Fingerprint.hash_file(path) or ""
+            self.hashes[inode] = sha
+        object_path = self.__object_path(sha)
+        if sha and not os.path.exists(object_path):
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            tmp_path = f"{object_path}.{os.getpid()}.tmp"
+            shutil.copyfile(path, tmp_path)
+            os.replace(tmp_path, object_path)
+        return sha
+
+    def __snapshot(self, path: str, only: Union[None, Set[str]] = None) -> List[List[Any]]:
+        """Store every file below a path and list its entries.
+
+        :returns: [relative path, type, mode, mtime_ns, size, sha256 or link target] of every
+                  directory (d), file (f) and symlink (l).
+        """
+        entries: List[List[Any]] = []
+        for root, dirs, names in os.walk(path):
+            relative_root = root[len(path) + 1:]
+            for name in sorted(dirs) + sorted(names):
+                relative = f"{relative_root}/{name}" if relative_root else name
+                if only is not None and relative not in only:
+                    continue
+                full_path = f"{root}/{name}"
+                stat = os.lstat(full_path)
+                if os.path.islink(full_path):
+                    entries.append([relative, "l", 0, stat.st_mtime_ns, 0, os.readlink(full_path)])
+                elif name in dirs:
+                    entries.append([relative, "d", stat.st_mode & 0o7777, stat.st_mtime_ns, 0, ""])
+                else:
+                    sha = self.__store(full_path, stat)
+                    entries.append(
+                        [relative, "f", stat.st_mode & 0o7777, stat.st_mtime_ns, stat.st_size, sha]
+                    )
+        return entries
+
+    def __image_files(self, package: str) -> Set[str]:
+        """Get the files a package installed into images/, by the time of its install step."""
+        start = end = None
+        try:
+            with open(
+                f"{self.build_path}/build/build-time.log", encoding="utf-8", errors="replace"
+            ) as log_fd:
+                for line in log_fd:
+                    parsed = BuildMonitor.parse_build_time_line(line)
+                    if parsed is None or parsed[2] != "install-image" or parsed[3] != package:
+                        continue
+                    if parsed[1] == "start":
+                        start = parsed[0]
+                    else:
+                        end = parsed[0]
+        except OSError:
+            return set()
+        if start is None or end is None:
+            return set()
+        files: Set[str] = set()
+        images = f"{self.build_path}/images"
+        for root, _, names in os.walk(images):
+            for name in names:
+                path = f"{root}/{name}"
+                try:
+                    mtime = os.lstat(path).st_mtime
+                except OSError:
+                    continue
+                if start - 1 <= mtime <= end + 1:
+                    files.add(path[len(images) + 1:])
+        # Their directories too, so they can be created with their modes.
+        for path in list(files):
+            while "/" in path:
+                path = path.rsplit("/", maxsplit=1)[0]
+                files.add(path)
+        return files
+
+    def __file_lists(self, package: str) -> Dict[str, List[str]]:
+        """Get the lines of Buildroot's package file lists that belong to a package."""
+        file_lists: Dict[str, List[str]] = {}
+        for file_list in (
+            "packages-file-list.txt",
+            "packages-file-list-staging.txt",
+            "packages-file-list-host.txt",
+        ):
+            try:
+                with open(f"{self.build_path}/build/{file_list}", encoding="utf-8") as list_fd:
+                    lines = [line for line in list_fd if line.startswith(f"{package},")]
+            except OSError:
+                continue
+            if lines:
+                file_lists[file_list] = lines
+        return file_lists
+
+    def __trees(self, package: str) -> Dict[str, str]:
+        """Get the directories of a package, keyed on their name in an entry."""
+        return {
+            "per-package": f"{self.build_path}/per-package/{package}",
+            "build": Packages.build_dir(self.build_path, package, self.info[package]),
+            "images": f"{self.build_path}/images",
+        }
+
+    def save(self) -> int:
+        """Save every installed package that is not cached yet. Call after a successful build.
+
+        :returns: The number of packages saved.
+        :rtype: int
+        """
+        saved = 0
+        with self.__lock():
+            for package, key in self.package_keys.items():
+                entry_path = f"{self.cache_dir}/entries/{key}.json"
+                if os.path.exists(entry_path) or package in self.restored:
+                    continue
+                if self.info[package].get("type") == "rootfs":
+                    continue
+                trees = self.__trees(package)
+                if not Packages.installed(self.build_path, package, self.info):
+                    continue
+                if not os.path.isdir(trees["per-package"]) or not os.path.isdir(trees["build"]):
+                    continue
+                images = self.__image_files(package)
+                entry = {
+                    "package": package,
+                    "key": key,
+                    "created": time.time(),
+                    "trees": {
+                        "per-package": self.__snapshot(trees["per-package"]),
+                        "build": self.__snapshot(trees["build"]),
+                        "images": self.__snapshot(trees["images"], images) if images else [],
+                    },
+                    "file_lists": self.__file_lists(package),
+                }
+                os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+                Files.save_atomic(entry_path, json.dumps(entry))
+                saved += 1
+        if saved:
+            self.logger.info(f"{self.target}: saved {saved} packages to the artifact cache")
+            self.evict()
+        return saved
+
+    def __load(self, key: str) -> Union[None, Dict[str, Any]]:
+        """Load a cache entry, dropping it if it or any of its objects is damaged."""
+        entry_path = f"{self.cache_dir}/entries/{key}.json"
+        if not os.path.exists(entry_path):
+            return None
+        try:
+            with open(entry_path, encoding="utf-8") as entry_fd:
+                entry = json.load(entry_fd)
+            for entries in entry["trees"].values():
+                for _, kind, _, _, size, sha in entries:
+                    if kind != "f":
+                        continue
+                    object_path = self.__object_path(sha)
+                    if os.path.getsize(object_path) != size:
+                        raise ValueError(f"{object_path}: size mismatch")
+                    if self.verify and Fingerprint.hash_file(object_path) != sha:
+                        raise ValueError(f"{object_path}: sha256 mismatch")
+        except (OSError, ValueError, KeyError, TypeError, json.decoder.JSONDecodeError) as err:
+            self.logger.warning(f"{self.target}: dropping artifact cache entry {key}: {err}")
+            with contextlib.suppress(OSError):
+                os.remove(entry_path)
+            return None
+        # Touch the entry, so eviction drops the least recently used entries first.
+        os.utime(entry_path)
+        return entry
+
+    def __extract(self, path: str, entries: List[List[Any]], link: bool) -> int:
+        """Recreate the entries of a tree below a path.
+
+        :param bool link: Hardlink files identical to a file restored before, as Buildroot
+                          does between per-package directories.
+        :returns: The number of bytes written.
+        """
+        written = 0
+        for relative, kind, mode, mtime_ns, size, value in entries:
+            full_path = f"{path}/{relative}"
+            if kind == "d":
+                os.makedirs(full_path, exist_ok=True)
+                continue
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            if os.path.lexists(full_path) and not os.path.isdir(full_path):
+                os.remove(full_path)
+            if kind == "l":
+                os.symlink(value, full_path)
+                os.utime(full_path, ns=(mtime_ns, mtime_ns), follow_symlinks=False)
+                continue
+            inode = (value, mode, mtime_ns)
+            linked = self.restored_files.get(inode) if link else None
+            if linked is not None:
+                try:
+                    os.link(linked, full_path)
+                    continue
+                except OSError:
+                    pass
+            shutil.copyfile(self.__object_path(value), full_path)
+            os.chmod(full_path, mode)
+            os.utime(full_path, ns=(mtime_ns, mtime_ns))
+            written += size
+            if link:
+                self.restored_files[inode] = full_path
+        # Directory times last, once their entries are written.
+        for relative, kind, mode, mtime_ns, _, _ in reversed(entries):
+            if kind == "d":
+                os.chmod(f"{path}/{relative}", mode)
+                os.utime(f"{path}/{relative}", ns=(mtime_ns, mtime_ns))
+        return written
+
+    def __restore_package(self, package: str, entry: Dict[str, Any]) -> int:
+        trees = self.__trees(package)
+        for name in ("per-package", "build"):
+            shutil.rmtree(trees[name], ignore_errors=True)
+        written = self.__extract(trees["per-package"], entry["trees"]["per-package"], True)
+        written += self.__extract(trees["images"], entry["trees"]["images"], False)
+        # The build directory holds the stamps, so it goes last.
+        written += self.__extract(trees["build"], entry["trees"]["build"], False)
+        for file_list, lines in entry.get("file_lists", {}).items():
+            with open(f"{self.build_path}/build/{file_list}", "a", encoding="utf-8") as list_fd:
+                list_fd.write("".join(lines))
+        return written
+
+    def restore(self) -> None:
+        """Restore every package that is not installed and is cached. Call before a build."""
+        start = time.monotonic()
+        hits: List[str] = []
+        misses: List[str] = []
+        written = 0
+        with self.__lock():
+            for package, key in self.package_keys.items():
+                package_info = self.info[package]
+                if package_info.get("type") == "rootfs":
+                    continue
+                if Packages.installed(self.build_path, package, self.info):
+                    continue
+                dependencies = package_info.get("dependencies", [])
+                entry = None
+                if all(
+                    Packages.installed(self.build_path, dependency, self.info)
+                    for dependency in dependencies
+                ):
+                    entry = self.__load(key)
+                if entry is None:
+                    misses.append(package)
+                    continue
+                try:
+                    written += self.__restore_package(package, entry)
+                except OSError as err:
+                    self.logger.warning(f"{self.target}: failed to restore {package}: {err}")
+                    for name in ("per-package", "build"):
+                        shutil.rmtree(self.__trees(package)[name], ignore_errors=True)
+                    misses.append(package)
+                    continue
+                hits.append(package)
+                self.restored.add(package)
+        self.report = {
+            "hits": len(hits),
+            "misses": len(misses),
+            "restored_mib": round(written / 1024**2, 1),
+            "restore_seconds": round(time.monotonic() - start, 3),
+            "missed": misses,
+        }
+        if hits or misses:
+            self.logger.info(
+                f"{self.target}: artifact cache {len(hits)} hits, {len(misses)} misses, "
+                f"restored {self.report['restored_mib']} MiB in "
+                f"{self.report['restore_seconds']:.1f}s"
+            )
+        state = State(self.build_path)
+        state.set("artifact_cache", self.report)
+        state.save()
+
+    def evict(self) -> None:
+        """Drop the least recently used entries until the cache fits ARTIFACT_CACHE_SIZE,
+        then remove the objects no entry uses."""
+        if self.max_size is None:
+            return
+        with self.__lock(exclusive=True):
+            entries: List[Tuple[float, str, Set[str]]] = []
+            entries_dir = f"{self.cache_dir}/entries"
+            for name in os.listdir(entries_dir) if os.path.isdir(entries_dir) else []:
+                path = f"{entries_dir}/{name}"
+                try:
+                    with open(path, encoding="utf-8") as entry_fd:
+                        trees = json.load(entry_fd)["trees"].values()
+                    shas = {item[5] for tree in trees for item in tree if item[1] == "f"}
+                    entries.append((os.stat(path).st_mtime, path, shas))
+                except (OSError, ValueError, KeyError, TypeError):
+                    with contextlib.suppress(OSError):
+                        os.remove(path)
+            sizes: Dict[str, int] = {}
+            for root, _, names in os.walk(f"{self.cache_dir}/objects"):
+                for name in names:
+                    with contextlib.suppress(OSError):
+                        sizes[name] = os.path.getsize(f"{root}/{name}")
+            references: Dict[str, int] = {}
+            for _, _, shas in entries:
+                for sha in shas:
+                    references[sha] = references.get(sha, 0) + 1
+            total = sum(size for sha, size in sizes.items() if sha in references)
+            evicted = 0
+            # Oldest first, the most recently used entries are kept.
+            for _, path, shas in sorted(entries):
+                if total <= self.max_size:
+                    break
+                os.remove(path)
+                evicted += 1
+                for sha in shas:
+                    references[sha] -= 1
+                    if not references[sha]:
+                        del references[sha]
+                        total -= sizes.get(sha, 0)
+            for sha in set(sizes) - set(references):
+                with contextlib.suppress(OSError):
+                    os.remove(self.__object_path(sha))
+            if evicted:
+                self.logger.info(
+                    f"Evicted {evicted} artifact cache entries, {total // 1024**2} MiB left"
+                )
+
+    def __init__(self, config_obj: Dict[str, Union[str, bool]]):
+        self.logger = Logger(__name__)
+        self.config_obj = config_obj
+        self.buildroot_path = str(config_obj["buildroot_path"])
+        self.build_path = str(config_obj["build_path"])
+        self.target = self.build_path.rsplit("/", maxsplit=1)[-1]
+        self.cache_dir = os.environ.get("ARTIFACT_CACHE_DIR", "") or (
+            f"{config_obj['output_dir']}/.artifact-cache"
+        )
+        self.max_size = self.parse_size(os.environ.get("ARTIFACT_CACHE_SIZE", "") or "0") or None
+        self.verify = os.environ.get("ARTIFACT_CACHE_VERIFY", "false").lower() == "true"
+        self.info = Packages.show_info(config_obj)
+        self.package_keys = self.keys() if self.info else {}
+        # (device, inode, size, mtime_ns): sha256 of the files hashed while saving.
+        self.hashes: Dict[Tuple[int, int, int, int], str] = {}
+        # (sha256, mode, mtime_ns): the first file restored with them.
+        self.restored_files: Dict[Tuple[str, int, int], str] = {}
+        self.restored: Set[str] = set()
+        self.report: Dict[str, Any] = {}
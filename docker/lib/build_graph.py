@@ -0,0 +1,393 @@
+"""Critical path and parallelism analysis of a finished build"""
+import os
+import json
+import html
+import multiprocessing
+from typing import Any, Dict, List, Tuple, Union
+from lib.files import Files
+from lib.logger import Logger
+from lib.metrics import BuildMonitor
+from lib.packages import Packages
+from lib.state import State
+
+
+class BuildGraph:
+    """Find out what set the wall-clock time of a target's last build.
+
+    The dependencies of every package come from "make show-info", the time each package
+    spent in each step from build/build-time.log. Buildroot appends to the log on every
+    build, so only the steps of the last successful build are used: the ones within the
+    build window BuildMonitor recorded in the state. Without one, IE: for a build run by
+    hand, the log is split where nothing ran for SPLIT_SECONDS and the last part is used.
+
+    - The critical path is the chain of dependent packages with the longest total build
+      time. No number of cores builds the target faster than it.
+    - The parallelism profile is the number of packages in a step over time.
+    - Idle periods are the stretches of at least MIN_IDLE_SECONDS where fewer packages were
+      building than there are cores, IE: while the toolchain or a large package builds alone.
+
+    Parallelism is counted in packages, the jobs each package's own make runs are not
+    visible in build-time.log. If the build took about as long as the critical path, more
+    cores do not help; if it took much longer and the average parallelism is close to the
+    number of cores, they do.
+
+    The results are written to <build dir>/.retroroot/build-graph.json, and as a timeline to
+    build-graph.html.
+    """
+
+    MIN_IDLE_SECONDS = 10.0
+    # A pause between steps this long separates two builds.
+    SPLIT_SECONDS = 60.0
+    # The number of points of the parallelism profile in the JSON report.
+    PROFILE_POINTS = 200
+    ROW_HEIGHT = 12
+    CHART_WIDTH = 1200
+    LABEL_WIDTH = 220
+
+    def __last_build(
+        self, events: List[Tuple[float, str, str, str]]
+    ) -> List[Tuple[float, str, str, str]]:
+        """Get the events of the last build from the events of build-time.log."""
+        window = State(self.build_path).get("build_window")
+        if isinstance(window, list) and len(window) == 2:
+            within = [event for event in events if window[0] <= event[0] <= window[1]]
+            if within:
+                return within
+        # The last stretch of the log without a long pause while no step ran.
+        first = 0
+        running = 0
+        for ndx, (timestamp, kind, _, _) in enumerate(events):
+            if kind != "start":
+                running = max(running - 1, 0)
+                continue
+            if not running and ndx and timestamp - events[ndx - 1][0] >= self.SPLIT_SECONDS:
+                first = ndx
+            running += 1
+        return events[first:]
+
+    def __intervals(self) -> Dict[str, List[Tuple[float, float, str]]]:
+        """Get the start, end and name of every step of every package of the last build."""
+        started: Dict[Tuple[str, str], float] = {}
+        steps: Dict[Tuple[str, str], Tuple[float, float]] = {}
+        events: List[Tuple[float, str, str, str]] = []
+        with open(self.build_time_log, encoding="utf-8", errors="replace") as log_fd:
+            for line in log_fd:
+                parsed = BuildMonitor.parse_build_time_line(line)
+                if parsed is not None:
+                    events.append(parsed)
+        for timestamp, kind, step, package in self.__last_build(events):
+            if kind == "start":
+                started[(package, step)] = timestamp
+            elif (package, step) in started:
+                steps[(package, step)] = (started.pop((package, step)), timestamp)
+        intervals: Dict[str, List[Tuple[float, float, str]]] = {}
+        for (package, step), (start, end) in steps.items():
+            intervals.setdefault(package, []).append((start, end, step))
+        for package_steps in intervals.values():
+            package_steps.sort()
+        return intervals
+
+    def __critical_path(self, durations: Dict[str, float]) -> Tuple[float, List[str]]:
+        """Get the chain of dependent packages with the longest total build time."""
+        longest: Dict[str, Tuple[float, Union[None, str]]] = {}
+        for package in Packages.build_order(self.info, durations):
+            dependencies = [
+                dependency
+                for dependency in self.__dependencies(package)
+                if dependency in longest
+            ]
+            previous = max(
+                dependencies, key=lambda dependency: longest[dependency][0], default=None
+            )
+            base = longest[previous][0] if previous is not None else 0.0
+            longest[package] = (base + durations[package], previous)
+        if not longest:
+            return 0.0, []
+        package: Union[None, str] = max(longest, key=lambda name: longest[name][0])
+        total = longest[package][0]
+        path: List[str] = []
+        while package is not None:
+            path.append(package)
+            package = longest[package][1]
+        return total, list(reversed(path))
+
+    def __dependencies(self, package: str) -> List[str]:
+        """Get the dependencies of a package, looking through virtual packages, which have
+        no steps of their own."""
+        dependencies: List[str] = []
+        pending = list(self.info.get(package, {}).get("dependencies", []))
+        seen = set(pending)
+        while pending:
+            dependency = pending.pop()
+            if dependency in self.intervals:
+                dependencies.append(dependency)
+                continue
+            for nested in self.info.get(dependency, {}).get("dependencies", []):
+                if nested not in seen:
+                    seen.add(nested)
+                    pending.append(nested)
+        return dependencies
+
+    def __profile(self, start: float, end: float) -> List[Tuple[float, int]]:
+        """Get the number of packages in a step from start to end, as (offset, count) at
+        every change."""
+        events: List[Tuple[float, int]] = []
+        for package_steps in self.intervals.values():
+            for step_start, step_end, _ in package_steps:
+                events.append((step_start, 1))
+                events.append((step_end, -1))
+        events.sort()
+        profile: List[Tuple[float, int]] = [(0.0, 0)]
+        running = 0
+        for timestamp, delta in events:
+            running += delta
+            offset = round(min(max(timestamp, start), end) - start, 3)
+            if profile[-1][0] == offset:
+                profile[-1] = (offset, running)
+            else:
+                profile.append((offset, running))
+        return profile
+
+    def __idle_periods(
+        self, profile: List[Tuple[float, int]], wall: float
+    ) -> Tuple[float, List[Dict[str, Any]]]:
+        """Get the core-seconds left idle and the periods of idle cores.
+
+        :returns: The idle core-seconds, and the periods of at least MIN_IDLE_SECONDS with
+                  fewer packages building than cores, longest first.
+        """
+        idle = 0.0
+        periods: List[Dict[str, Any]] = []
+        period_start: Union[None, float] = None
+        lowest = self.cores
+        for ndx, (offset, running) in enumerate(profile):
+            if offset >= wall:
+                break
+            next_offset = profile[ndx + 1][0] if ndx + 1 < len(profile) else wall
+            idle += max(self.cores - running, 0) * (next_offset - offset)
+            if running < self.cores:
+                if period_start is None:
+                    period_start, lowest = offset, running
+                lowest = min(lowest, running)
+                continue
+            if period_start is not None and offset - period_start >= self.MIN_IDLE_SECONDS:
+                periods.append(self.__period(period_start, offset, lowest))
+            period_start = None
+        if period_start is not None and wall - period_start >= self.MIN_IDLE_SECONDS:
+            periods.append(self.__period(period_start, wall, lowest))
+        periods.sort(key=lambda period: -period["seconds"])
+        return idle, periods
+
+    def __period(self, start: float, end: float, lowest: int) -> Dict[str, Any]:
+        """Describe an idle period and the packages building during it."""
+        packages = sorted(
+            package
+            for package, package_steps in self.intervals.items()
+            if any(
+                step_start - self.start < end and step_end - self.start > start
+                for step_start, step_end, _ in package_steps
+            )
+        )
+        return {
+            "start": round(start, 1),
+            "end": round(end, 1),
+            "seconds": round(end - start, 1),
+            "min_packages": lowest,
+            "packages": packages,
+        }
+
+    def analyze(self) -> Dict[str, Any]:
+        """Analyze the last build of the target.
+
+        :returns: The report, or an empty dictionary if there is no build-time.log.
+        :rtype: Dict[str, Any]
+        """
+        if not os.path.isfile(self.build_time_log):
+            return {}
+        self.intervals = self.__intervals()
+        if not self.intervals:
+            return {}
+        self.info = Packages.show_info(self.config_obj)
+        self.start = min(steps[0][0] for steps in self.intervals.values())
+        end = max(step[1] for steps in self.intervals.values() for step in steps)
+        wall = end - self.start
+        durations = {
+            package: sum(step_end - step_start for step_start, step_end, _ in steps)
+            for package, steps in self.intervals.items()
+        }
+        busy = sum(durations.values())
+        critical_seconds, critical_path = self.__critical_path(durations)
+        profile = self.__profile(self.start, end)
+        idle, idle_periods = self.__idle_periods(profile, wall)
+        # The build can't be faster than its critical path, nor than its work spread
+        # over every core.
+        bound = max(critical_seconds, busy / self.cores)
+        step = max(len(profile) // self.PROFILE_POINTS, 1)
+        return {
+            "target": self.target,
+            "cores": self.cores,
+            "packages": len(self.intervals),
+            "dependencies_known": bool(self.info),
+            "wall_seconds": round(wall, 1),
+            "busy_seconds": round(busy, 1),
+            "average_parallelism": round(busy / wall, 2) if wall else 0.0,
+            "idle_core_seconds": round(idle, 1),
+            "critical_path_seconds": round(critical_seconds, 1),
+            "lower_bound_seconds": round(bound, 1),
+            "more_cores_help": bool(busy / self.cores > critical_seconds * 1.1),
+            "critical_path": [
+                {
+                    "package": package,
+                    "start": round(self.intervals[package][0][0] - self.start, 1),
+                    "seconds": round(durations[package], 1),
+                }
+                for package in critical_path
+            ],
+            "slowest": [
+                {"package": package, "seconds": round(durations[package], 1)}
+                for package in sorted(durations, key=lambda name: -durations[name])[:20]
+            ],
+            "idle_periods": idle_periods,
+            "profile": profile[::step],
+            "steps": {
+                package: [
+                    [round(start - self.start, 2), round(end - self.start, 2), name]
+                    for start, end, name in steps
+                ]
+                for package, steps in self.intervals.items()
+            },
+        }
+
+    def html(self, report: Dict[str, Any]) -> str:
+        """Render a report as a self-contained HTML page with an SVG timeline.
+
+        Every package is a row of its steps, the packages of the critical path are red. The
+        parallelism profile is drawn below, with the number of cores as a dashed line.
+
+        :param Dict[str, Any] report: A report returned by analyze().
+        :returns: The HTML page.
+        :rtype: str
+        """
+        wall = max(report["wall_seconds"], 1.0)
+        scale = (self.CHART_WIDTH - self.LABEL_WIDTH) / wall
+        critical = {entry["package"] for entry in report["critical_path"]}
+        rows = sorted(report["steps"], key=lambda package: report["steps"][package][0][0])
+        profile_height = 120
+        height = len(rows) * self.ROW_HEIGHT + profile_height + 40
+        svg = [
+            f'<svg xmlns="http://www.w3.org/2000/svg" width="{self.CHART_WIDTH}" '
+            f'height="{height}" font-family="monospace" font-size="10">'
+        ]
+        for ndx, package in enumerate(rows):
+            y_pos = ndx * self.ROW_HEIGHT
+            color = "#d62728" if package in critical else "#1f77b4"
+            svg.append(
+                f'<text x="0" y="{y_pos + 9}">{html.escape(package[:34])}</text>'
+            )
+            for start, end, step in report["steps"][package]:
+                x_pos = self.LABEL_WIDTH + start * scale
+                width = max((end - start) * scale, 0.5)
+                svg.append(
+                    f'<rect x="{x_pos:.1f}" y="{y_pos + 1}" width="{width:.1f}" '
+                    f'height="{self.ROW_HEIGHT - 2}" fill="{color}">'
+                    f"<title>{html.escape(package)} {html.escape(step)}: "
+                    f"{end - start:.1f}s</title></rect>"
+                )
+        top = len(rows) * self.ROW_HEIGHT + 20
+        peak = max([count for _, count in report["profile"]] + [report["cores"], 1])
+        y_scale = profile_height / peak
+        points = []
+        for offset, count in report["profile"]:
+            x_pos = self.LABEL_WIDTH + offset * scale
+            if points:
+                points.append(f"{x_pos:.1f},{points[-1].split(',')[1]}")
+            points.append(f"{x_pos:.1f},{top + profile_height - count * y_scale:.1f}")
+        cores_y = top + profile_height - report["cores"] * y_scale
+        svg.append(f'<text x="0" y="{top + 10}">packages building</text>')
+        svg.append(
+            f'<polyline points="{" ".join(points)}" fill="none" stroke="#2ca02c"/>'
+            f'<line x1="{self.LABEL_WIDTH}" y1="{cores_y:.1f}" x2="{self.CHART_WIDTH}" '
+            f'y2="{cores_y:.1f}" stroke="#7f7f7f" stroke-dasharray="4"/>'
+        )
+        svg.append("</svg>")
+        summary = [
+            ("Wall time", f"{report['wall_seconds']}s"),
+            ("Critical path", f"{report['critical_path_seconds']}s"),
+            ("Lower bound", f"{report['lower_bound_seconds']}s"),
+            ("Average parallelism", f"{report['average_parallelism']} of {report['cores']}"),
+            ("Idle core-seconds", f"{report['idle_core_seconds']}"),
+            ("More cores help", "yes" if report["more_cores_help"] else "no"),
+        ]
+        body = ["<table>"]
+        body += [f"<tr><th>{name}</th><td>{value}</td></tr>" for name, value in summary]
+        body.append("</table><h2>Critical path</h2><table>")
+        body += [
+            f"<tr><td>{html.escape(entry['package'])}</td><td>{entry['seconds']}s</td></tr>"
+            for entry in report["critical_path"]
+        ]
+        body.append("</table><h2>Idle periods</h2><table>")
+        body += [
+            f"<tr><td>{period['start']}s</td><td>{period['seconds']}s</td>"
+            f"<td>{html.escape(' '.join(period['packages']))}</td></tr>"
+            for period in report["idle_periods"]
+        ]
+        body.append("</table>")
+        return (
+            f"<!DOCTYPE html><html><head><meta charset=\"utf-8\">"
+            f"<title>{html.escape(self.target)} build graph</title></head><body>"
+            f"<h1>{html.escape(self.target)}</h1>{''.join(body)}<h2>Timeline</h2>"
+            f"{''.join(svg)}</body></html>\n"
+        )
+
+    def run(self) -> bool:
+        """Analyze the last build and write the JSON and HTML reports.
+
+        :returns: True if the reports were written.
+        :rtype: bool
+        """
+        report = self.analyze()
+        if not report:
+            self.logger.warning(f"{self.target}: no build-time.log to analyze")
+            return False
+        if not report["dependencies_known"]:
+            self.logger.warning(f"{self.target}: show-info failed, no critical path")
+        os.makedirs(self.state_dir, exist_ok=True)
+        json_path = f"{self.state_dir}/build-graph.json"
+        html_path = f"{self.state_dir}/build-graph.html"
+        if not Files.save_atomic(json_path, json.dumps(report, indent=2)):
+            return False
+        if not Files.save_atomic(html_path, self.html(report)):
+            return False
+        path = " -> ".join(entry["package"] for entry in report["critical_path"])
+        self.logger.info(
+            f"{self.target}: {report['wall_seconds']}s wall, critical path "
+            f"{report['critical_path_seconds']}s: {path}"
+        )
+        self.logger.info(
+            f"{self.target}: average parallelism {report['average_parallelism']} of "
+            f"{self.cores} cores, more cores "
+            f"{'would' if report['more_cores_help'] else 'would not'} help. "
+            f"Report: {html_path}"
+        )
+        return True
+
+    def __init__(self, config_obj: Dict[str, Union[str, bool]], cores: Union[None, int] = None):
+        """Initialize the class.
+
+        :param Dict[str, Union[str, bool]] config_obj: A parsed config object.
+        :param int cores: The number of cores the build had. Default: BUILD_CORES, or all.
+        """
+        self.logger = Logger(__name__)
+        self.config_obj = config_obj
+        self.build_path = str(config_obj["build_path"])
+        self.target = self.build_path.rsplit("/", maxsplit=1)[-1]
+        self.build_time_log = f"{self.build_path}/build/build-time.log"
+        self.state_dir = f"{self.build_path}/.retroroot"
+        try:
+            build_cores = int(os.environ.get("BUILD_CORES", "0") or 0)
+        except ValueError:
+            build_cores = 0
+        self.cores = max(cores or build_cores or multiprocessing.cpu_count(), 1)
+        self.info: Dict[str, Any] = {}
+        self.intervals: Dict[str, List[Tuple[float, float, str]]] = {}
+        self.start = 0.0
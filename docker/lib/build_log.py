@@ -0,0 +1,104 @@
+"""Streaming analysis of Buildroot build logs"""
+import re
+from typing import Dict, Tuple, Union
+from lib.files import Files
+from lib.logger import Logger
+
+
+class BuildLog:
+    """Find why a build failed by reading br.log line by line.
+
+    The log is never loaded into memory as a whole; only the first error line of each package
+    is kept.
+    """
+
+    # brmake prefixes every line with a timestamp.
+    TIMESTAMP = re.compile(r"^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2} ")
+    # >>> mesa3d 24.0.1 Building
+    STEP = re.compile(r"^>>> (\S+) (\S+) (.+)$")
+    # make[1]: *** [package/pkg-generic.mk:283: /path/build/mesa3d-24.0.1/.stamp_built] Error 2
+    MAKE_ERROR = re.compile(r"\*\*\* \[[^\]]*/build/([^/\]]+)/\.stamp_(\w+)\] Error")
+    # foo.c:12:3: error: ..., ld: error: ..., error: ..., undefined reference to ...
+    COMPILER_ERROR = re.compile(
+        r"(^|: )(fatal )?error:|undefined reference to|^Error:", re.IGNORECASE
+    )
+
+    @staticmethod
+    def failure(log_path: str) -> Dict[str, Union[None, str]]:
+        """Extract the failing package and its first error from a build log.
+
+        :param str log_path: The path of br.log or a make output log.
+        :returns: A dictionary with the package, version, step, error and make_error keys.
+                  Values are None if they could not be determined.
+        :rtype: Dict[str, Union[None, str]]
+        """
+        report: Dict[str, Union[None, str]] = {
+            "package": None,
+            "version": None,
+            "step": None,
+            "error": None,
+            "make_error": None,
+        }
+        first_errors: Dict[str, str] = {}
+        steps: Dict[str, Tuple[str, str]] = {}
+        package_dir = None
+        current = None
+        try:
+            with open(log_path, encoding="utf-8", errors="replace") as log_fd:
+                for line in log_fd:
+                    line = BuildLog.TIMESTAMP.sub("", line.rstrip("\n"))
+                    match = BuildLog.STEP.match(line)
+                    if match:
+                        current = match.group(1)
+                        steps[current] = (match.group(2), match.group(3))
+                        report["package"] = current
+                        report["version"] = match.group(2)
+                        report["step"] = match.group(3)
+                        continue
+                    match = BuildLog.MAKE_ERROR.search(line)
+                    if match:
+                        if report["make_error"] is None:
+                            report["make_error"] = line.strip()
+                            package_dir = match.group(1)
+                        continue
+                    if current and current not in first_errors:
+                        if BuildLog.COMPILER_ERROR.search(line):
+                            first_errors[current] = line.strip()
+        except OSError as err:
+            Logger("BuildLog").error(f"{log_path}: {err}")
+            return report
+        if package_dir:
+            # The make error names the build directory of the package: <package>-<version>.
+            report["package"] = package_dir
+            report["version"] = None
+            report["step"] = None
+            for package, (version, step) in steps.items():
+                if package_dir == f"{package}-{version}":
+                    report["package"] = package
+                    report["version"] = version
+                    report["step"] = step
+                    break
+        if report["package"]:
+            report["error"] = first_errors.get(report["package"])
+        return report
+
+    @staticmethod
+    def report(log_path: str, lines: int = 100) -> None:
+        """Print the failing package, its first error and the end of a build log.
+
+        :param str log_path: The path of br.log or a make output log.
+        :param int lines: The number of lines of the end of the log to print.
+        """
+        logger = Logger("BuildLog")
+        for line in Files.tail(log_path, lines):
+            print(line)
+        failure = BuildLog.failure(log_path)
+        if failure["package"]:
+            version = f" {failure['version']}" if failure["version"] else ""
+            step = f" ({failure['step']})" if failure["step"] else ""
+            logger.error(f"Failed package: {failure['package']}{version}{step}")
+        if failure["error"]:
+            logger.error(f"First error: {failure['error']}")
+        if failure["make_error"]:
+            logger.error(failure["make_error"])
+        logger.error(f"Full log: {log_path}")
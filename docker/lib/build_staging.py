@@ -0,0 +1,279 @@
+"""Staging of build trees in memory"""
+import os
+import time
+import fcntl
+import shutil
+import hashlib
+import subprocess
+from typing import Dict, List, Set, Tuple, Union
+from lib.logger import Logger
+from lib.state import State
+
+
+class BuildStaging:
+    """Keep the build trees of a target on tmpfs while it builds.
+
+    With "tmpfs_build": true in the env file, build/ and per-package/, where the packages are
+    configured and compiled, are moved to a tmpfs and replaced by symlinks. Buildroot keeps
+    using the same paths, so nothing built refers to the tmpfs. images/, host/, legal-info/ and
+    the rest of the target stay on persistent storage, so the finished artifacts never need
+    to be copied back.
+
+    The trees are sized from the previous build: their size at its end, which is their peak as
+    Buildroot removes nothing while building, plus a margin for growth. The first build of a
+    target runs on disk to measure them. The trees are only staged when the tmpfs has room
+    for them and the memory left still fits BUILD_MEMORY_PER_TARGET, otherwise the build runs
+    on disk. They stay on the tmpfs between builds, so the next build of a hot target starts
+    from them.
+
+    The trees are spilled back to disk when:
+
+    - The tmpfs or the memory no longer fits them before a build.
+    - A build fails with the tmpfs full. The build then carries on from where it stopped,
+      on disk.
+    - "tmpfs_build" is turned off.
+
+    If the tmpfs was emptied, IE: by a restart of the container, the target is built again
+    from scratch.
+
+    Environment variables:
+      - TMPFS_BUILD_DIR: The tmpfs directory the build trees are staged in.
+                         Default: /dev/shm/retroroot
+    """
+
+    STAGED_DIRS = ("build", "per-package")
+    # The growth of the trees allowed for since the previous build.
+    MARGIN = 1.25
+    # Below this much free space after a failed build, the tmpfs is considered full.
+    FULL_BYTES = 64 * 1024**2
+
+    @staticmethod
+    def enabled(config_obj: Dict[str, Union[str, bool]]) -> bool:
+        """Check if a target stages its build trees on tmpfs.
+
+        :param Dict[str, Union[str, bool]] config_obj: A parsed config object.
+        :returns: True if "tmpfs_build" is set in its env file.
+        :rtype: bool
+        """
+        return bool(config_obj.get("tmpfs_build", False))
+
+    @staticmethod
+    def discard(build_path: str) -> None:
+        """Remove the staged trees of a target, IE: before removing its output directory.
+
+        :param str build_path: The output directory of the target.
+        """
+        for name in BuildStaging.STAGED_DIRS:
+            path = f"{build_path}/{name}"
+            if os.path.islink(path):
+                shutil.rmtree(os.readlink(path), ignore_errors=True)
+                os.remove(path)
+
+    @staticmethod
+    def __mem_available() -> int:
+        """Get MemAvailable in bytes, or 0 if it can't be determined."""
+        try:
+            with open("/proc/meminfo", encoding="utf-8") as meminfo:
+                for line in meminfo:
+                    if line.startswith("MemAvailable:"):
+                        return int(line.split()[1]) * 1024
+        except (OSError, IndexError, ValueError):
+            pass
+        return 0
+
+    @staticmethod
+    def __usage(paths: List[str]) -> int:
+        """Get the disk usage of trees, counting hardlinked files once."""
+        size = 0
+        seen: Set[Tuple[int, int]] = set()
+        for root, dirs, names in (entry for path in paths for entry in os.walk(path)):
+            for name in dirs + names:
+                try:
+                    stat = os.lstat(os.path.join(root, name))
+                except OSError:
+                    continue
+                if stat.st_nlink > 1:
+                    if (stat.st_dev, stat.st_ino) in seen:
+                        continue
+                    seen.add((stat.st_dev, stat.st_ino))
+                size += stat.st_blocks * 512
+        return size
+
+    def __copy(self, source: str, destination: str) -> None:
+        """Copy a tree with its hardlinks, times and modes, as make relies on all of them.
+
+        :raises subprocess.CalledProcessError: If the copy fails.
+        """
+        shutil.rmtree(destination, ignore_errors=True)
+        subprocess.run(
+            ["cp", "-a", source, destination],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            check=True,
+        )
+
+    def __free(self) -> int:
+        """Get the free space of the tmpfs in bytes."""
+        try:
+            stat = os.statvfs(self.tmpfs_dir)
+        except OSError:
+            return 0
+        return stat.f_bavail * stat.f_frsize
+
+    def staged(self) -> bool:
+        """Check if the build trees are on the tmpfs.
+
+        :rtype: bool
+        """
+        return all(
+            os.path.islink(f"{self.build_path}/{name}")
+            and os.readlink(f"{self.build_path}/{name}") == f"{self.staging_path}/{name}"
+            and os.path.isdir(f"{self.staging_path}/{name}")
+            for name in self.STAGED_DIRS
+        )
+
+    def __fits(self, needed: int) -> bool:
+        """Check if the tmpfs and the memory have room for more bytes of build trees."""
+        free = self.__free()
+        if free < needed:
+            self.logger.info(
+                f"{self.target}: the tmpfs has {free / 1024**2:.0f} MiB free, "
+                f"{needed / 1024**2:.0f} MiB are needed, building on disk"
+            )
+            return False
+        left = self.__mem_available() - needed
+        if left < self.memory_per_target:
+            self.logger.info(
+                f"{self.target}: staging would leave {left / 1024**2:.0f} MiB of memory, "
+                f"{self.memory_per_target / 1024**2:.0f} MiB are needed, building on disk"
+            )
+            return False
+        return True
+
+    def spill(self) -> bool:
+        """Move the build trees back to disk.
+
+        :returns: True if the trees are on disk.
+        :rtype: bool
+        """
+        for name in self.STAGED_DIRS:
+            path = f"{self.build_path}/{name}"
+            if not os.path.islink(path):
+                continue
+            staged = os.readlink(path)
+            self.logger.info(f"{self.target}: moving {name}/ back to disk")
+            try:
+                if os.path.isdir(staged):
+                    self.__copy(staged, f"{path}.tmp")
+                os.remove(path)
+                if os.path.isdir(f"{path}.tmp"):
+                    os.rename(f"{path}.tmp", path)
+            except (OSError, subprocess.SubprocessError) as err:
+                self.logger.error(f"{self.target}: could not move {name}/ back to disk: {err}")
+                shutil.rmtree(f"{path}.tmp", ignore_errors=True)
+                return False
+            shutil.rmtree(staged, ignore_errors=True)
+        try:
+            os.rmdir(self.staging_path)
+        except OSError:
+            pass
+        return True
+
+    def __stage(self) -> bool:
+        """Move the build trees to the tmpfs."""
+        for name in self.STAGED_DIRS:
+            path = f"{self.build_path}/{name}"
+            staged = f"{self.staging_path}/{name}"
+            if os.path.islink(path) and os.readlink(path) == staged and os.path.isdir(staged):
+                continue
+            try:
+                if os.path.islink(path):
+                    os.remove(path)
+                if os.path.isdir(path):
+                    self.__copy(path, staged)
+                    os.rename(path, f"{path}.old")
+                else:
+                    shutil.rmtree(staged, ignore_errors=True)
+                    os.makedirs(staged)
+                os.symlink(staged, path)
+            except (OSError, subprocess.SubprocessError) as err:
+                self.logger.warning(f"{self.target}: could not stage {name}/: {err}")
+                if os.path.isdir(f"{path}.old") and not os.path.exists(path):
+                    os.rename(f"{path}.old", path)
+                return False
+            shutil.rmtree(f"{path}.old", ignore_errors=True)
+        return True
+
+    def stage(self) -> bool:
+        """Stage the build trees on the tmpfs before a build, or keep them on disk.
+
+        :returns: True if the build trees are on the tmpfs.
+        :rtype: bool
+        """
+        if not self.enabled(self.config_obj):
+            # Turned off since the last build.
+            if any(os.path.islink(f"{self.build_path}/{name}") for name in self.STAGED_DIRS):
+                self.spill()
+            return False
+        for name in self.STAGED_DIRS:
+            path = f"{self.build_path}/{name}"
+            if os.path.islink(path) and not os.path.exists(path):
+                self.logger.warning(f"{self.target}: the staged {name}/ is gone, rebuilding it")
+                os.remove(path)
+        previous = self.state.get("tmpfs_build", {}).get("bytes")
+        if not previous:
+            self.logger.info(f"{self.target}: building on disk to measure the build trees")
+            return False
+        os.makedirs(self.tmpfs_dir, exist_ok=True)
+        # Builds staging at once must not both count the same free space.
+        with open(f"{self.tmpfs_dir}/.lock", "a", encoding="utf-8") as lock_fd:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            staged = self.staged()
+            current = self.__usage([self.staging_path]) if staged else 0
+            if not self.__fits(max(int(previous * self.MARGIN) - current, 0)):
+                if staged:
+                    self.spill()
+                return False
+            if staged:
+                return True
+            self.logger.info(f"{self.target}: staging the build trees in {self.staging_path}")
+            os.makedirs(self.staging_path, exist_ok=True)
+            if not self.__stage():
+                self.spill()
+                return False
+        return True
+
+    def full(self) -> bool:
+        """Check if the tmpfs filled up, IE: after a failed build.
+
+        :rtype: bool
+        """
+        return self.staged() and self.__free() < self.FULL_BYTES
+
+    def record(self) -> None:
+        """Record the size of the build trees after a build, to size the next one."""
+        size = self.__usage(
+            [os.path.realpath(f"{self.build_path}/{name}") for name in self.STAGED_DIRS]
+        )
+        # Loaded again, as the build recorded its own results in the state meanwhile.
+        self.state = State(self.build_path)
+        self.state.set(
+            "tmpfs_build", {"bytes": size, "staged": self.staged(), "time": time.time()}
+        )
+        self.state.save()
+
+    def __init__(self, config_obj: Dict[str, Union[str, bool]]):
+        self.logger = Logger(__name__)
+        self.config_obj = config_obj
+        self.build_path = str(config_obj["build_path"])
+        self.target = self.build_path.rsplit("/", maxsplit=1)[-1]
+        self.tmpfs_dir = os.environ.get("TMPFS_BUILD_DIR", "/dev/shm/retroroot").rstrip("/")
+        # Targets of different output directories may share a name.
+        suffix = hashlib.sha256(self.build_path.encode()).hexdigest()[:8]
+        self.staging_path = f"{self.tmpfs_dir}/{self.target}-{suffix}"
+        try:
+            memory_per_target = int(os.environ.get("BUILD_MEMORY_PER_TARGET", 4096))
+        except ValueError:
+            memory_per_target = 4096
+        self.memory_per_target = memory_per_target * 1024**2
+        self.state = State(self.build_path)
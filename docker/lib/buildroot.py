@@ -1,10 +1,19 @@
 import os
-import subprocess
 import multiprocessing
-from shutil import rmtree
-from typing import Dict, Union
+from typing import Dict, List, Union
+from lib.artifact_cache import ArtifactCache
+from lib.build_log import BuildLog
+from lib.ccache import Ccache
 from lib.logger import Logger
-from lib.files import Files
+from lib.fingerprint import Fingerprint
+from lib.history import History
+from lib.jobserver import Jobserver
+from lib.kconfig import KConfig
+from lib.legal_info import LegalInfo
+from lib.metrics import BuildMonitor
+from lib.overlay_update import OverlayUpdate
+from lib.rebuild_planner import RebuildPlanner
+from lib.runner import Runner
 
 
 class Buildroot:
@@ -18,106 +27,131 @@ class Buildroot:
         :param str defconfig: A path to the defconfig of which to search.
         :param buildroot_dir: A path to the buildroot directory.
         :returns: A string if the property is found, otherwise None.
-        :rtype: bool
+        :rtype: Union[str, None]
         """
-        buff = {}
-        with open(defconfig, encoding="utf-8") as _defconfig:
-            for line in _defconfig:
-                try:
-                    line = line.strip()
-                    if "is not set" in line:
-                        continue
-                    key_val = line.split("=")
-                    key = key_val[0]
-                    val = key_val[1]
-                    buff[key] = val.replace('"', "").replace("$(TOPDIR)", buildroot_dir)
-                except IndexError:
-                    continue
-        _defconfig.close()
-        if defconfig_property in buff:
-            return buff[defconfig_property]
-        return None
+        return KConfig.load(defconfig, buildroot_dir).get(defconfig_property)
 
     @staticmethod
     def legal_info(config_obj: Dict[str, Union[str, bool]]) -> bool:
         """Generate legal documentation."""
-        logger = Logger("Buildroot")
-        cmd = f"{config_obj['make']} BR2_DL_DIR={config_obj['dl_dir']} legal-info"
-        board_name = config_obj["defconfig"].replace("_defconfig", "")
-        legal_info_tarball = f"{board_name}-legal-info.tar.gz"
-        legal_info_path = f"{config_obj['build_path']}/legal-info"
-        os.chdir(config_obj["build_path"])
-        if Files.exists(
-            f"{config_obj['build_path']}/images/{board_name}-legal-info.tar.gz"
-        ):
-            logger.info("Legal info already generated.")
-            return True
-        logger.info(f"Generating legal-info for {config_obj['defconfig']}")
-        if os.system(cmd):
-            logger.error(
-                f"ERROR: Failed to generate legal information for {config_obj['defconfig']}"
-            )
-            if config_obj["make"] == "brmake":
-                log = Files.to_buffer(f"{config_obj['build_path']}/br.log", split=True)
-                for line in log[-100:]:
-                    print(line)
-            return False
-        # We don't want the sources bundled in the tarball.
-        rmtree(f"{legal_info_path}/sources")
-        rmtree(f"{legal_info_path}/host-sources")
-        if os.system(f"tar -czf {legal_info_tarball} legal-info"):
-            return False
-        if os.makedirs("images", exist_ok=True):
-            return False
-        if os.system(f"mv {legal_info_tarball} images/"):
-            return False
-        return True
+        return LegalInfo(config_obj).run()
 
     @staticmethod
-    def build(config_obj: Dict[str, Union[str, bool]]) -> bool:
+    def build(config_obj: Dict[str, Union[str, bool]], cores: Union[int, None] = None) -> bool:
         """Build all configs that have the build attribute set to true in env.json.
 
         :param Dict[str, Union[str, bool]] config_obj: An instantiated config object from the
                                                        config class.
+        :param int cores: The number of cores allotted to this build by the scheduler. If None,
+                          all cores are used. Not used when the scheduler shares a jobserver.
         :returns: True on success, False on failure.
         :rtype: bool
         """
         logger = Logger("Buildroot")
         build_package = os.environ.get("BUILD_PACKAGE", None)
-        os.chdir(config_obj["build_path"])
-        with open(os.devnull, "wb") as null:
-            subprocess.check_call(
+        # A .config written by Config.apply is already resolved by Kconfig. Only run
+        # olddefconfig if it was edited since, IE: through menuconfig.
+        if not Fingerprint.is_applied(config_obj["build_path"]):
+            result = Runner.run(
                 [config_obj["make"], "olddefconfig"],
-                stdout=null,
-                stderr=subprocess.STDOUT,
+                cwd=config_obj["build_path"],
+                capture=True,
             )
+            if not result:
+                print(result.output, end="")
+                print(f"ERROR: Failed to run olddefconfig for {config_obj['defconfig']}")
+                return False
+        planner = None
+        if os.environ.get("INCREMENTAL_BUILD", "true").lower() != "false":
+            planner = RebuildPlanner(config_obj)
+            plan = planner.plan()
+            # Only overlay files changed, write them into the existing images.
+            if (
+                OverlayUpdate.enabled()
+                and plan["changed"]
+                and not plan["dirclean"]
+                and not plan["clean"]
+                and not build_package
+                and OverlayUpdate(config_obj).run(plan["changed"])
+            ):
+                planner.save()
+                return True
+            if not planner.run(plan):
+                return False
+        artifact_cache = None
+        if config_obj["per_package"] and ArtifactCache.enabled():
+            artifact_cache = ArtifactCache(config_obj)
+            artifact_cache.restore()
         logger.info(f"Building {config_obj['defconfig']}")
         cmd = f"{config_obj['make']} BR2_DL_DIR={config_obj['dl_dir']}"
+        jobserver = Jobserver.active
+        if jobserver is not None:
+            # Every make takes its jobs from the shared jobserver, -j would start its own.
+            if config_obj["per_package"]:
+                cmd += " -Otarget"
         # Check if per_package directories is set. If so, check if BR2_JLEVEL is set and divide
         # by the number of cores by JLEVEL.
-        if config_obj["per_package"]:
-            cores = multiprocessing.cpu_count()
+        elif config_obj["per_package"]:
             j_level = int(
-                Buildroot.parse_defconfig(
-                    "BR2_JLEVEL",
-                    f"{config_obj['build_path']}/.config",
-                    config_obj["buildroot_path"],
-                )
+                KConfig.load(
+                    f"{config_obj['build_path']}/.config", config_obj["buildroot_path"]
+                ).get("BR2_JLEVEL", "0")
             )
+            top_cores = cores or multiprocessing.cpu_count()
             if j_level:
-                cores = max(int(cores / j_level), 1)
-            cmd += f" -Otarget -j{str(cores)}"
-            if build_package:
-                cmd += f" {build_package}"
+                top_cores = max(int(top_cores / j_level), 1)
+            cmd += f" -Otarget -j{str(top_cores)}"
+        elif cores:
+            # Without per-package directories only one package builds at a time, so hand the
+            # whole allotment to the package's own make.
+            cmd += f" BR2_JLEVEL={cores}"
+        ccache = Ccache(config_obj)
+        timeout = float(os.environ.get("BUILD_TIMEOUT", "0") or 0) or None
+        ccache.start()
+        cmds: List[str] = []
+        if ccache.enabled() and Ccache.prewarm_enabled() and not build_package:
+            # The heaviest packages first, so the cache fills with them early, then the rest.
+            packages = ccache.heaviest()
+            if packages:
+                logger.info(f"Pre-warming ccache with {' '.join(packages)}")
+                cmds.append(f"{cmd} {' '.join(packages)}")
+            else:
+                logger.warning(f"{config_obj['defconfig']}: no packages known to pre-warm")
+        if build_package:
+            cmd += f" {build_package}"
+        cmds.append(cmd)
 
         logger.info(f"Running {cmd} for {config_obj['build_path']}")
-        if os.system(cmd):
+        # A pre-warm is part of the build, so it is followed and recorded along with it.
+        monitor = BuildMonitor(config_obj)
+        returncode = monitor.run(cmds, timeout, jobserver)
+        ccache_report = ccache.stop()
+        if History.enabled() and not build_package:
+            history = History(History.db_path(config_obj))
+            package_durations = monitor.package_durations()
+            run_id = history.record(
+                config_obj,
+                returncode == 0,
+                monitor.start_time,
+                (monitor.end_time or monitor.start_time) - monitor.start_time,
+                package_durations,
+                cores,
+                ccache_report,
+                artifact_cache.report if artifact_cache is not None else None,
+                History.full(package_durations, monitor.total),
+            )
+            if run_id is not None and returncode == 0:
+                history.report(config_obj["build_path"].rsplit("/", maxsplit=1)[-1], run_id)
+        if returncode:
             print(f"ERROR: Failed to build {config_obj['defconfig']}")
             if config_obj["make"] == "brmake":
-                log = Files.to_buffer(f"{config_obj['build_path']}/br.log", split=True)
-                for line in log[-100:]:
-                    print(line)
+                BuildLog.report(f"{config_obj['build_path']}/br.log")
             return False
+        # Building some packages only leaves the other changes for the next full build.
+        if planner is not None and not build_package:
+            planner.save()
+        if artifact_cache is not None:
+            artifact_cache.save()
         return True
 
     @staticmethod
@@ -125,13 +159,14 @@ class Buildroot:
         """Update buildroot if it's a git repository.
 
         :param str buildroot_dir: The Buildroot directory of which to update.
+        :returns: True on success or if Buildroot is not from git, False on failure.
+        :rtype: bool
         """
         logger = Logger("Buildroot")
-        os.chdir(buildroot_dir)
-        if not os.path.isdir(".git"):
+        if not os.path.isdir(f"{buildroot_dir}/.git"):
             logger.warning("Buildroot is not from git, skipping update.")
             return True
-        retval = os.system("git pull")
-        if not retval:
+        if not Runner.run(["git", "pull"], cwd=buildroot_dir):
+            logger.error(f"Failed to update {buildroot_dir}")
             return False
         return True
@@ -0,0 +1,225 @@
+"""ccache statistics, size budget and pre-warming"""
+import os
+import subprocess
+from typing import Dict, List, Tuple, Union
+from lib.kconfig import KConfig
+from lib.logger import Logger
+from lib.metrics import BuildMonitor
+from lib.packages import Packages
+from lib.state import State
+
+
+class Ccache:
+    """Report and manage the ccache of a target built with BR2_CCACHE.
+
+    - The ccache counters are read before and after each build. The hits and misses of the
+      build itself come from a ccache stats log kept for the build, so they are exact even
+      when several targets share a cache; the size and cleanup deltas are those of the whole
+      cache directory.
+    - The results are logged and kept in the per-target state under "ccache", along with
+      the hit rates of the last builds.
+    - CCACHE_MAX_SIZE, IE: 10G, sets the maximum size of the cache before and after every
+      build. BR2_CCACHE_INITIAL_SETUP is only applied when host-ccache is first installed.
+    - CCACHE_PREWARM=true builds the heaviest packages of the target first, heaviest first,
+      then the rest of the target, so the cache of a cold builder fills with the costly
+      compilations early. The packages are CCACHE_PREWARM_PACKAGES if set, else the ones
+      that took longest in the target's build/build-time.log, else the packages of
+      DEFAULT_HEAVY that the target has.
+    """
+
+    HISTORY = 20
+    PREWARM_COUNT = 10
+    # Usually the longest compilations of a target, for a builder that has no build history.
+    DEFAULT_HEAVY = (
+        "linux",
+        "llvm",
+        "mesa3d",
+        "ffmpeg",
+        "retroarch",
+        "qt5base",
+        "gstreamer1",
+        "boost",
+        "sdl2",
+        "python3",
+    )
+
+    @staticmethod
+    def prewarm_enabled() -> bool:
+        """Check if the pre-warm mode is enabled.
+
+        :returns: True if CCACHE_PREWARM is set to true.
+        :rtype: bool
+        """
+        return os.environ.get("CCACHE_PREWARM", "false").lower() == "true"
+
+    def enabled(self) -> bool:
+        """Check if the target uses ccache.
+
+        :returns: True if BR2_CCACHE is set.
+        :rtype: bool
+        """
+        return bool(self.cache_dir)
+
+    def __ccache(self, args: List[str]) -> Union[None, str]:
+        """Run the host ccache built by Buildroot against the target's cache directory."""
+        if not os.access(self.binary, os.X_OK):
+            return None
+        # Buildroot's ccache reads its directory from BR_CACHE_DIR rather than CCACHE_DIR.
+        env = dict(os.environ, BR_CACHE_DIR=self.cache_dir, CCACHE_DIR=self.cache_dir)
+        env.pop("CCACHE_STATSLOG", None)
+        try:
+            return subprocess.run(
+                [self.binary] + args,
+                env=env,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                timeout=600,
+                check=True,
+            ).stdout.decode("utf-8", errors="replace")
+        except (OSError, subprocess.SubprocessError):
+            return None
+
+    def stats(self) -> Dict[str, int]:
+        """Get the counters of the cache directory.
+
+        :returns: The counters of "ccache --print-stats", empty if ccache is not built yet.
+        :rtype: Dict[str, int]
+        """
+        counters: Dict[str, int] = {}
+        output = self.__ccache(["--print-stats"])
+        for line in (output or "").splitlines():
+            key, _, value = line.partition("\t")
+            try:
+                counters[key] = int(value)
+            except ValueError:
+                continue
+        return counters
+
+    def apply_budget(self) -> None:
+        """Set the maximum size of the cache from CCACHE_MAX_SIZE and trim it."""
+        max_size = os.environ.get("CCACHE_MAX_SIZE", "")
+        if not max_size:
+            return
+        if self.__ccache([f"--max-size={max_size}"]) is None:
+            return
+        self.__ccache(["--cleanup"])
+
+    def __log_results(self) -> Dict[str, int]:
+        """Count the results of the build's compilations from the stats log."""
+        results: Dict[str, int] = {}
+        try:
+            with open(self.stats_log, encoding="utf-8", errors="replace") as log_fd:
+                for line in log_fd:
+                    line = line.strip()
+                    if line and not line.startswith("#"):
+                        results[line] = results.get(line, 0) + 1
+        except OSError:
+            pass
+        return results
+
+    def heaviest(self, count: int = PREWARM_COUNT) -> List[str]:
+        """Get the packages that took the longest to build, heaviest first.
+
+        :param int count: The maximum number of packages.
+        :returns: The packages from CCACHE_PREWARM_PACKAGES, from build-time.log, or the
+                  packages of DEFAULT_HEAVY the target has.
+        :rtype: List[str]
+        """
+        packages = os.environ.get("CCACHE_PREWARM_PACKAGES", "").split()
+        if packages:
+            return packages
+        durations: Dict[str, float] = {}
+        started: Dict[Tuple[str, str], float] = {}
+        try:
+            with open(
+                f"{self.build_path}/build/build-time.log", encoding="utf-8", errors="replace"
+            ) as log_fd:
+                for line in log_fd:
+                    parsed = BuildMonitor.parse_build_time_line(line)
+                    if parsed is None:
+                        continue
+                    timestamp, kind, step, package = parsed
+                    if kind == "start":
+                        started[(package, step)] = timestamp
+                    elif (package, step) in started:
+                        durations[package] = durations.get(package, 0.0) + (
+                            timestamp - started.pop((package, step))
+                        )
+        except OSError:
+            pass
+        if durations:
+            return sorted(durations, key=lambda package: -durations[package])[:count]
+        info = Packages.show_info(self.config_obj)
+        return [package for package in self.DEFAULT_HEAVY if package in info][:count]
+
+    def start(self) -> None:
+        """Apply the size budget and snapshot the counters before a build."""
+        if not self.enabled():
+            return
+        self.apply_budget()
+        self.before = self.stats()
+        os.makedirs(os.path.dirname(self.stats_log), exist_ok=True)
+        if os.path.exists(self.stats_log):
+            os.remove(self.stats_log)
+        os.environ["CCACHE_STATSLOG"] = self.stats_log
+
+    def stop(self) -> Dict[str, Union[int, float, None]]:
+        """Snapshot the counters after a build, then report and record the results.
+
+        :returns: The results of the build, empty if ccache is not enabled.
+        :rtype: Dict[str, Union[int, float, None]]
+        """
+        if not self.enabled():
+            return {}
+        os.environ.pop("CCACHE_STATSLOG", None)
+        after = self.stats()
+        self.apply_budget()
+        results = self.__log_results()
+        hits = results.get("direct_cache_hit", 0) + results.get("preprocessed_cache_hit", 0)
+        misses = results.get("cache_miss", 0)
+        report: Dict[str, Union[int, float, None]] = {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": round(hits / (hits + misses), 4) if hits + misses else None,
+            "size_kib": after.get("cache_size_kibibyte"),
+            "size_delta_kib": after.get("cache_size_kibibyte", 0)
+            - self.before.get("cache_size_kibibyte", 0),
+            "cleanups": after.get("cleanups_performed", 0)
+            - self.before.get("cleanups_performed", 0),
+        }
+        rate = "n/a" if report["hit_rate"] is None else f"{100 * report['hit_rate']:.1f}%"
+        self.logger.info(
+            f"{self.target}: ccache {hits} hits, {misses} misses ({rate}), "
+            f"{report['size_delta_kib']:+d} KiB, cache {report['size_kib'] or 0} KiB"
+        )
+        if report["cleanups"]:
+            self.logger.warning(
+                f"{self.target}: ccache evicted entries {report['cleanups']} times during the "
+                "build, consider raising CCACHE_MAX_SIZE"
+            )
+        state = State(self.build_path)
+        history = state.get("ccache_hit_rates", [])
+        history = (history + [report["hit_rate"]])[-self.HISTORY:]
+        state.set("ccache", report)
+        state.set("ccache_hit_rates", history)
+        state.save()
+        return report
+
+    def __init__(self, config_obj: Dict[str, Union[str, bool]]):
+        self.logger = Logger(__name__)
+        self.config_obj = config_obj
+        self.build_path = str(config_obj["build_path"])
+        self.target = self.build_path.rsplit("/", maxsplit=1)[-1]
+        self.binary = f"{self.build_path}/host/bin/ccache"
+        self.stats_log = f"{self.build_path}/.retroroot/ccache-stats.log"
+        self.cache_dir = ""
+        try:
+            kconfig = KConfig.load(
+                f"{self.build_path}/.config", str(config_obj["buildroot_path"])
+            )
+            if kconfig.get("BR2_CCACHE") == "y":
+                cache_dir = kconfig.get("BR2_CCACHE_DIR", "$(HOME)/.buildroot-ccache")
+                self.cache_dir = cache_dir.replace("$(HOME)", os.path.expanduser("~"))
+        except OSError:
+            pass
+        self.before: Dict[str, int] = {}
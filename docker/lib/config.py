@@ -1,54 +1,107 @@
 import os
 import sys
-from typing import Any, Dict, Union
+import asyncio
+from typing import Any, Dict, List, Union
+from lib.build_staging import BuildStaging
 from lib.dirs import Dirs
-from lib.buildroot import Buildroot
 from lib.external_trees import ExternalTrees
+from lib.fingerprint import Fingerprint
 from lib.fragments import Fragments
 from lib.json_helper import JSONHelper
+from lib.kconfig import KConfig
 from lib.logger import Logger
+from lib.runner import Runner
 
 
 class Config:
-    def apply(self) -> bool:
-        """Apply all configs defined in env.json."""
+    def __flush(self, lines: List[str]) -> None:
+        """Print the buffered output of a command in one block."""
+        if lines:
+            sys.stdout.write("".join(lines))
+            sys.stdout.flush()
+            lines.clear()
+
+    async def apply_async(self) -> bool:
+        """Apply all configs defined in env.json.
+
+        If the build directory exists and none of the apply inputs changed since the last
+        apply, the config is left as is, as re-applying would only mark .config as newer.
+
+        The output of make is printed in one block once it finishes, so the output of
+        targets applied concurrently does not interleave.
+        """
         Dirs.exists(self.buildroot_path, fail=True)
         Dirs.exists(self.config["output_dir"], make=True, fail=True)
-        if not Dirs.exists(self.config["build_path"]) or self.config["apply_configs"]:
+        build_path_exists = Dirs.exists(self.config["build_path"])
+        if not build_path_exists or self.config["apply_configs"]:
+            # BR2_DEFCONFIG still points to the original defconfig so "make savedefconfig"
+            # updates it rather than the merged copy.
             cmd = (
                 f"BR2_EXTERNAL={self.buildroot_path}/{self.config['external_trees']} "
                 f"BR2_DEFCONFIG={self.config['defconfig_path']} "
-                f"{self.config['make']} {self.config['defconfig']} "
+                f"{self.config['make']} defconfig "
+                f"DEFCONFIG={self.fragments.merged_path} "
                 f"O={self.config['build_path']}"
             )
-            os.chdir(self.buildroot_path)
+            fingerprint = Fingerprint(self.config, self.fragments.fragments, cmd)
+            if build_path_exists:
+                changes = fingerprint.changed()
+                if not changes:
+                    self.logger.info(
+                        f"{self.config['defconfig']}: apply inputs unchanged, skipping apply"
+                    )
+                    return True
+                for change in changes:
+                    self.logger.info(f"{self.config['defconfig']}: {change}")
             self.logger.info(f"Applying {self.config['defconfig_path']}")
+            if not self.fragments.apply():
+                return False
             if self.config["make"] == "make":
                 self.logger.info(cmd)
-            if os.system(cmd):
+            lines: List[str] = []
+            result = await Runner.run_async(
+                cmd, cwd=self.buildroot_path, output=lines.append
+            )
+            self.__flush(lines)
+            if not result:
                 print(f"ERROR: Failed to apply {self.config['defconfig_path']}")
                 return False
-            self.fragments.apply()
+            KConfig.invalidate(f"{self.config['build_path']}/.config")
+            fingerprint.save()
         return True
 
-    def clean(self, force: bool = False) -> bool:
+    def apply(self) -> bool:
+        """Apply the config from synchronous code. See apply_async()."""
+        return asyncio.run(self.apply_async())
+
+    async def clean_async(self, force: bool = False) -> bool:
         """Clean all configs that have the clean boolean set to true."""
         if self.config["remove"]:
             if Dirs.exists(self.config["build_path"]):
                 self.logger.info(f"Removing directory {self.config['build_path']}")
+                BuildStaging.discard(self.config["build_path"])
                 return Dirs.remove(self.config["build_path"])
         elif self.config["clean"] or force:
             if Dirs.exists(self.config["build_path"]):
-                os.chdir(self.config["build_path"])
+                # make clean would only remove the symlinks to the staged build trees.
+                BuildStaging.discard(self.config["build_path"])
                 cmd = f"{self.config['make']} clean"
                 self.logger.info(f"Cleaning {self.config['defconfig']}")
-                if os.system(cmd):
+                lines: List[str] = []
+                result = await Runner.run_async(
+                    cmd, cwd=self.config["build_path"], output=lines.append
+                )
+                self.__flush(lines)
+                if not result:
                     print(f"ERROR: Failed to clean {self.config['defconfig_path']}")
                     return False
-                os.chdir(self.buildroot_path)
                 return True
         return True
 
+    def clean(self, force: bool = False) -> bool:
+        """Clean the config from synchronous code. See clean_async()."""
+        return asyncio.run(self.clean_async(force))
+
     def __parse_paths(self, config: Dict[str, Any]) -> bool:
         """Parse all paths from a given config.
 
@@ -93,14 +146,9 @@ class Config:
             self.logger.error(f"{self.config['defconfig_path']}: no such file!")
             sys.exit(1)
 
-        self.config["dl_dir"] = Buildroot.parse_defconfig(
-            "BR2_DL_DIR", self.config["defconfig_path"], self.buildroot_path
-        )
-        per_package = Buildroot.parse_defconfig(
-            "BR2_PER_PACKAGE_DIRECTORIES",
-            self.config["defconfig_path"],
-            self.buildroot_path,
-        )
+        defconfig_model = KConfig.load(self.config["defconfig_path"], self.buildroot_path)
+        self.config["dl_dir"] = defconfig_model.get("BR2_DL_DIR")
+        per_package = defconfig_model.get("BR2_PER_PACKAGE_DIRECTORIES")
         if per_package == "y":
             self.config["per_package"] = True
         if not self.config["dl_dir"]:
@@ -128,6 +176,9 @@ class Config:
         )[1]
         self.config["remove"] = JSONHelper.parse_attr(config, "remove", bool, False)[1]
         self.config["skip"] = JSONHelper.parse_attr(config, "skip", bool, False)[1]
+        self.config["tmpfs_build"] = JSONHelper.parse_attr(
+            config, "tmpfs_build", bool, False
+        )[1]
         if JSONHelper.parse_attr(config, "verbose", bool, False)[1]:
             self.config["make"] = "make"
         verbose = bool(os.environ.get("VERBOSE", "false").lower() == "true")
@@ -164,4 +215,5 @@ class Config:
             "apply_configs": apply_configs,
             "remove": False,
             "skip": False,
+            "tmpfs_build": False,
         }
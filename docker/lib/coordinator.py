@@ -0,0 +1,398 @@
+"""Distribution of target builds across worker daemons"""
+import os
+import json
+import time
+import shutil
+import socket
+import tarfile
+import threading
+import subprocess
+import http.client
+import urllib.parse
+from typing import Any, Dict, List, Set, Tuple, Union
+from lib.init_parse import InitParse
+from lib.logger import Logger
+
+
+class WorkerClient:
+    """The job API of a worker daemon, over TCP or its Unix socket.
+
+    :param str url: http://host:port, or unix:///path/to/retroroot.sock.
+
+    Requests over TCP carry DAEMON_TOKEN, if set, which the worker checks.
+    """
+
+    TIMEOUT = 60
+
+    def __connection(self) -> http.client.HTTPConnection:
+        if self.socket_path:
+            connection = http.client.HTTPConnection("localhost", timeout=self.TIMEOUT)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.TIMEOUT)
+            sock.connect(self.socket_path)
+            connection.sock = sock
+            return connection
+        return http.client.HTTPConnection(self.netloc, timeout=self.TIMEOUT)
+
+    def __headers(self) -> Dict[str, str]:
+        if self.token and not self.socket_path:
+            return {"Authorization": f"Bearer {self.token}"}
+        return {}
+
+    def request(
+        self, method: str, path: str, body: Union[None, Dict[str, Any]] = None
+    ) -> Tuple[int, Any]:
+        """Send a request and decode the JSON reply.
+
+        :param str method: GET or POST.
+        :param str path: The path of the request, IE: /jobs.
+        :param Dict[str, Any] body: The JSON body of a POST.
+        :returns: A tuple of the status and the decoded reply.
+        :rtype: Tuple[int, Any]
+        :raises OSError: If the worker can't be reached.
+        """
+        connection = self.__connection()
+        try:
+            data = None if body is None else json.dumps(body).encode()
+            headers = self.__headers()
+            if data is not None:
+                headers["Content-Type"] = "application/json"
+            connection.request(method, path, body=data, headers=headers)
+            response = connection.getresponse()
+            reply = response.read()
+            try:
+                return response.status, json.loads(reply or b"null")
+            except json.decoder.JSONDecodeError:
+                return response.status, None
+        except http.client.HTTPException as err:
+            raise OSError(str(err)) from err
+        finally:
+            connection.close()
+
+    def stream(self, path: str, consume, read_timeout: Union[None, float] = TIMEOUT) -> int:
+        """Pass the body of a GET request to a callable taking the response.
+
+        :param str path: The path of the request, IE: /jobs/1/log.
+        :param consume: A callable reading the body from the response it is given.
+        :param float read_timeout: The time the body may stall for, None for no limit.
+        :returns: The status of the response.
+        :rtype: int
+        :raises OSError: If the worker can't be reached.
+        """
+        connection = self.__connection()
+        try:
+            connection.request("GET", path, headers=self.__headers())
+            # The connection lets go of its socket once it has the response.
+            sock = connection.sock
+            response = connection.getresponse()
+            sock.settimeout(read_timeout)
+            if response.status == 200:
+                consume(response)
+            else:
+                response.read()
+            return response.status
+        except http.client.HTTPException as err:
+            raise OSError(str(err)) from err
+        finally:
+            connection.close()
+
+    def __init__(self, url: str):
+        self.url = url
+        parsed = urllib.parse.urlparse(url)
+        self.socket_path = parsed.path if parsed.scheme == "unix" else ""
+        self.netloc = parsed.netloc
+        self.token = os.environ.get("DAEMON_TOKEN", "")
+
+
+class Coordinator:
+    """Spread the targets of every env file across worker daemons.
+
+    Each worker is a daemon, see lib.daemon, started with DAEMON=true and reachable over
+    DAEMON_HTTP or its socket. The coordinator does not build. It gives each worker one target
+    at a time, longest last build first, and for each target:
+
+    - Sends the env file's content and the commit of the external trees, which the worker
+      checks out before building. Uncommitted changes are not sent.
+    - Streams the worker's log of the build to .retroroot/coordinator.log of the target.
+    - Fetches images/ once the build succeeds, replacing the local images/ of the target.
+
+    A target that fails, or whose worker can't be reached, is retried on a worker that has
+    not built it yet, up to COORDINATOR_RETRIES times. A worker that can't be reached gets
+    no more targets.
+
+    Several daemons on one host, each with its own DAEMON_SOCKET and DAEMON_LOG_DIR, stand
+    in for remote workers, IE: for testing.
+
+    Environment variables:
+      - COORDINATOR_WORKERS: Comma separated worker urls, IE:
+                             http://builder1:8080,unix:///mnt/docker/worker2.sock.
+                             Default: none, build locally
+      - COORDINATOR_RETRIES: The number of other workers a failed target is tried on.
+                             Default: 2
+    """
+
+    POLL_INTERVAL = 2.0
+
+    @staticmethod
+    def enabled() -> bool:
+        """Check if builds are distributed.
+
+        :returns: True if COORDINATOR_WORKERS is set.
+        :rtype: bool
+        """
+        return bool(os.environ.get("COORDINATOR_WORKERS", "").strip())
+
+    @staticmethod
+    def revision(buildroot_path: str, external_trees: str) -> str:
+        """Get the commit of the external trees.
+
+        :param str buildroot_path: The Buildroot directory.
+        :param str external_trees: The external trees, relative to Buildroot and colon separated.
+        :returns: The commit of HEAD, or "" if the trees are not a git checkout.
+        :rtype: str
+        """
+        tree = f"{buildroot_path}/{external_trees.split(':', maxsplit=1)[0]}"
+        try:
+            return subprocess.run(
+                ["git", "-C", os.path.realpath(tree), "rev-parse", "HEAD"],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                text=True,
+                check=True,
+            ).stdout.strip()
+        except (OSError, subprocess.SubprocessError):
+            return ""
+
+    def add(self, env_file: str) -> bool:
+        """Add the targets of an env file to build.
+
+        :param str env_file: The env file.
+        :returns: False if the env file can't be parsed.
+        :rtype: bool
+        """
+        init = InitParse(env_file, False, False, False)
+        if not init.parse():
+            return False
+        jobs = init.jobs()
+        if jobs is None:
+            return False
+        try:
+            with open(env_file, encoding="utf-8") as env_fd:
+                env = env_fd.read()
+        except OSError as err:
+            self.logger.error(f"{env_file}: {err}")
+            return False
+        for job in jobs:
+            config_obj = job.config_obj
+            if config_obj is None:
+                continue
+            revision = self.revision(init.buildroot_path, str(config_obj["external_trees"]))
+            self.targets.append(
+                {
+                    # The name the daemon selects the target by.
+                    "name": str(config_obj["defconfig"]).replace("_defconfig", ""),
+                    "env_file": os.path.basename(env_file),
+                    "env": env,
+                    "revision": revision,
+                    "build_path": str(config_obj["build_path"]),
+                    "estimate": job.estimate,
+                    "tried": [],
+                    "status": "queued",
+                    "seconds": 0.0,
+                }
+            )
+        return True
+
+    def __fetch_images(self, client: WorkerClient, job_id: str, target: Dict[str, Any]) -> bool:
+        """Replace the local images/ of a target with the worker's."""
+        tmp_path = f"{target['build_path']}/.retroroot/images.coordinator.tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+
+        def extract(response) -> None:
+            with tarfile.open(fileobj=response, mode="r|") as tar:
+                prefix = f"{target['name']}/images"
+                for member in tar:
+                    # Only the images of the target, never a path outside of them.
+                    name = os.path.normpath(member.name)
+                    if name != prefix and not name.startswith(f"{prefix}/"):
+                        continue
+                    if member.issym():
+                        link = os.path.normpath(
+                            os.path.join(os.path.dirname(name), member.linkname)
+                        )
+                        if os.path.isabs(member.linkname) or not link.startswith(f"{prefix}/"):
+                            continue
+                    elif not member.isfile() and not member.isdir():
+                        continue
+                    tar.extract(member, tmp_path)
+
+        try:
+            status = client.stream(f"/jobs/{job_id}/images", extract)
+        except (OSError, tarfile.TarError) as err:
+            self.logger.warning(f"{target['name']}: could not fetch images/: {err}")
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            return False
+        if status != 200:
+            self.logger.warning(f"{target['name']}: could not fetch images/: HTTP {status}")
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            return False
+        images = f"{target['build_path']}/images"
+        fetched = f"{tmp_path}/{target['name']}/images"
+        if not os.path.isdir(fetched):
+            os.makedirs(fetched)
+        shutil.rmtree(images, ignore_errors=True)
+        os.rename(fetched, images)
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        return True
+
+    def __build(self, client: WorkerClient, target: Dict[str, Any]) -> Union[None, bool]:
+        """Build a target on a worker.
+
+        :returns: True on success, False if the build failed, None if the worker can't be
+                  reached.
+        """
+        log_path = f"{target['build_path']}/.retroroot/coordinator.log"
+        os.makedirs(os.path.dirname(log_path), exist_ok=True)
+        try:
+            status, job = client.request(
+                "POST",
+                "/jobs",
+                {
+                    "action": "build",
+                    "env_file": target["env_file"],
+                    "env": target["env"],
+                    "target": target["name"],
+                    "revision": target["revision"],
+                },
+            )
+            if status not in (200, 201) or not isinstance(job, dict):
+                self.logger.error(f"{target['name']}: {client.url} refused the job: {job}")
+                return False
+            job_id = job["id"]
+            with open(log_path, "ab") as log_fd:
+                log_fd.write(f"## {client.url} job {job_id}\n".encode())
+                try:
+                    # A package step may print nothing for longer than any timeout.
+                    client.stream(
+                        f"/jobs/{job_id}/log",
+                        lambda response: shutil.copyfileobj(response, log_fd, 65536),
+                        read_timeout=None,
+                    )
+                except OSError as err:
+                    self.logger.warning(
+                        f"{target['name']}: lost the log of {client.url}, polling the job: {err}"
+                    )
+            # The log ends when the job finishes, or when the connection was cut; the worker
+            # is only unreachable if it does not answer for the job either.
+            while True:
+                status, job = client.request("GET", f"/jobs/{job_id}")
+                if status != 200 or not isinstance(job, dict):
+                    return None
+                if job.get("status") in ("succeeded", "failed"):
+                    break
+                time.sleep(self.POLL_INTERVAL)
+        except OSError as err:
+            self.logger.warning(f"{target['name']}: {client.url}: {err}")
+            return None
+        if job["status"] != "succeeded":
+            return False
+        return self.__fetch_images(client, job_id, target)
+
+    def __next(self, url: str) -> Union[None, Dict[str, Any]]:
+        """Take the next target a worker has not tried yet, waiting while others run.
+
+        :returns: A target, or None once no target is left for the worker.
+        """
+        with self.condition:
+            while True:
+                queued = [target for target in self.targets if target["status"] == "queued"]
+                for target in queued:
+                    if url not in target["tried"]:
+                        target["status"] = "running"
+                        target["tried"].append(url)
+                        return target
+                running = any(target["status"] == "running" for target in self.targets)
+                # What is queued was tried here; only a failure elsewhere can add work.
+                if not running:
+                    return None
+                self.condition.wait()
+
+    def __worker(self, url: str) -> None:
+        client = WorkerClient(url)
+        while True:
+            target = self.__next(url)
+            if target is None:
+                return
+            self.logger.info(f"{target['name']}: building on {url}")
+            start = time.monotonic()
+            result = self.__build(client, target)
+            with self.condition:
+                target["seconds"] = time.monotonic() - start
+                if result:
+                    target["status"] = "succeeded"
+                elif len(target["tried"]) <= self.retries and any(
+                    worker not in target["tried"] for worker in self.alive
+                ):
+                    self.logger.warning(f"{target['name']}: failed on {url}, retrying elsewhere")
+                    target["status"] = "queued"
+                else:
+                    target["status"] = "failed"
+                if result is None:
+                    self.logger.error(f"{url} can't be reached, giving it no more targets")
+                    self.alive.discard(url)
+                    # No other worker may be left to take what is queued.
+                    for queued in self.targets:
+                        if queued["status"] == "queued" and not any(
+                            worker not in queued["tried"] for worker in self.alive
+                        ):
+                            queued["status"] = "failed"
+                self.condition.notify_all()
+            if result is None:
+                return
+
+    def run(self) -> bool:
+        """Build every target on the workers.
+
+        :returns: True if every target was built and its images fetched.
+        :rtype: bool
+        """
+        if not self.targets:
+            return True
+        # Longest first, as the scheduler orders local builds; unknown targets go first.
+        self.targets.sort(
+            key=lambda target: -(target["estimate"] or float("inf")),
+        )
+        self.logger.info(f"Building {len(self.targets)} targets on {len(self.workers)} workers")
+        threads = [
+            threading.Thread(target=self.__worker, args=(url,), name=url) for url in self.workers
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for target in self.targets:
+            if target["status"] == "queued":
+                target["status"] = "failed"
+            log_path = f"{target['build_path']}/.retroroot/coordinator.log"
+            self.logger.info(
+                f"{target['name']}: {'OK' if target['status'] == 'succeeded' else 'FAILED'} "
+                f"({target['seconds']:.0f}s) on {target['tried'][-1] if target['tried'] else '-'}"
+                f" log: {log_path}"
+            )
+        return all(target["status"] == "succeeded" for target in self.targets)
+
+    def __init__(self):
+        self.logger = Logger(__name__)
+        self.workers: List[str] = [
+            url.strip().rstrip("/")
+            for url in os.environ.get("COORDINATOR_WORKERS", "").split(",")
+            if url.strip()
+        ]
+        try:
+            self.retries = max(int(os.environ.get("COORDINATOR_RETRIES", 2)), 0)
+        except ValueError:
+            self.retries = 2
+        self.alive: Set[str] = set(self.workers)
+        self.targets: List[Dict[str, Any]] = []
+        self.condition = threading.Condition()
@@ -0,0 +1,587 @@
+"""Persistent build daemon with a local HTTP job API"""
+import os
+import sys
+import json
+import time
+import re
+import hmac
+import glob
+import socket
+import hashlib
+import tarfile
+import subprocess
+import itertools
+import threading
+import socketserver
+import multiprocessing
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Deque, Dict, List, Tuple, Union
+from lib.buildroot import Buildroot
+from lib.files import Files
+from lib.init_parse import InitParse
+from lib.logger import Logger
+from lib.runner import Runner
+from lib.scheduler import Scheduler
+
+
+class Job:
+    """A queued daemon job."""
+
+    ACTIONS = ("apply", "build", "clean", "legal-info")
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Get the job as a JSON serializable dictionary.
+
+        :rtype: Dict[str, Any]
+        """
+        return {
+            "id": self.job_id,
+            "action": self.action,
+            "env_file": self.env_file,
+            "target": self.target,
+            "revision": self.revision,
+            "status": self.status,
+            "submitted": self.submitted,
+            "started": self.started,
+            "finished": self.finished,
+            "clients": self.clients,
+        }
+
+    def __init__(
+        self,
+        job_id: str,
+        action: str,
+        env_file: str,
+        target: str,
+        log_path: str,
+        revision: str = "",
+    ):
+        self.job_id = job_id
+        self.action = action
+        self.env_file = env_file
+        self.target = target
+        self.log_path = log_path
+        # The commit the external trees must be at, IE: when sent by a coordinator.
+        self.revision = revision
+        # queued, running, succeeded or failed
+        self.status = "queued"
+        self.submitted = time.time()
+        self.started: Union[None, float] = None
+        self.finished: Union[None, float] = None
+        # The number of requests that were deduplicated into this job.
+        self.clients = 1
+        # Target name: output directory, of the targets the job ran on.
+        self.build_paths: Dict[str, str] = {}
+
+
+class Daemon:
+    """Keep env files and configs parsed and run build jobs from a queue.
+
+    Jobs are submitted over HTTP, on a Unix socket (DAEMON_SOCKET, default
+    ./retroroot.sock) and optionally on TCP (DAEMON_HTTP, IE: 0.0.0.0:8080):
+
+      - POST /jobs {"action": "build", "env_file": "rpi4.json", "target": "raspberrypi4"}
+        queues a job. action is one of apply, build, clean or legal-info; target is
+        optional and defaults to every target of the env file. A request identical to a
+        job that has not started yet returns that job instead of queuing a new one.
+        A coordinator also sends "env", the content of the env file, which is used instead
+        of the daemon's copy, and "revision", the commit the external trees are checked out
+        at before the job runs. env_file must be relative to the docker directory, and the
+        paths of a sent env file must stay within the Buildroot directory of one of the
+        daemon's own env files.
+      - GET /jobs lists the jobs, GET /jobs/<id> returns a job.
+      - GET /jobs/<id>/log streams the log of a job until it finishes.
+      - GET /jobs/<id>/images streams the images/ directories of the job's targets as a tar.
+
+    IE: curl --unix-socket retroroot.sock -d '{"action": "build", "env_file": "x86_64.json"}'
+    http://localhost/jobs
+
+    Over TCP, requests must carry "Authorization: Bearer <DAEMON_TOKEN>" when DAEMON_TOKEN is
+    set. It must be set for DAEMON_HTTP to listen beyond localhost.
+
+    Jobs run one at a time, each in a forked process that inherits the parsed env files and
+    configs, so a job never re-parses what did not change. An env file is parsed again when
+    it is modified. Targets of a build job still build side by side as set by PARALLEL_BUILDS.
+    """
+
+    LOCAL_HOSTS = ("127.0.0.1", "localhost", "::1")
+
+    @staticmethod
+    def __check_paths(value: Any, key: str = "") -> None:
+        """Reject the paths of a sent env file that could leave the Buildroot directory.
+
+        :raises ValueError: If a string is an absolute path or has a ".." component.
+        """
+        if isinstance(value, dict):
+            for child_key, child in value.items():
+                Daemon.__check_paths(child, str(child_key))
+        elif isinstance(value, list):
+            for child in value:
+                Daemon.__check_paths(child, key)
+        # buildroot_path is absolute, it is checked against the daemon's own.
+        elif isinstance(value, str) and key != "buildroot_path":
+            if os.path.isabs(value) or ".." in value.split("/"):
+                raise ValueError(f"{key}: {value} is not a relative path")
+
+    def __buildroot_paths(self) -> List[str]:
+        """Get the Buildroot directories of the daemon's own env files."""
+        paths: List[str] = []
+        for env_path in sorted(glob.glob(f"{self.cwd}/*.json")):
+            try:
+                init = InitParse(env_path, False, True, False)
+                init.parse(configs=False)
+            except (OSError, SystemExit, KeyError, IndexError, TypeError):
+                continue
+            paths.append(os.path.realpath(init.buildroot_path))
+        return paths
+
+    def __save_env(self, env_file: str, env: str) -> str:
+        """Save a sent env file, once its paths are checked.
+
+        :returns: The path of the saved env file.
+        :raises ValueError: If the env file is not valid, or leaves the daemon's Buildroot.
+        """
+        self.__check_paths(json.loads(env))
+        # Named after its content, so the parsed copy is reused while it does not change.
+        sha = hashlib.sha256(env.encode()).hexdigest()[:12]
+        env_path = f"{self.log_dir}/env/{sha}-{os.path.basename(env_file) or 'env.json'}"
+        if os.path.isfile(env_path):
+            return env_path
+        os.makedirs(os.path.dirname(env_path), exist_ok=True)
+        Files.save_atomic(env_path, env)
+        try:
+            init = InitParse(env_path, False, True, False)
+            init.parse(configs=False)
+            buildroot_path = os.path.realpath(init.buildroot_path)
+        except (OSError, SystemExit, KeyError, IndexError, TypeError):
+            buildroot_path = ""
+        if buildroot_path not in self.__buildroot_paths():
+            os.remove(env_path)
+            raise ValueError(
+                f"{buildroot_path or env_file}: not a Buildroot directory of this daemon"
+            )
+        return env_path
+
+    def __env_path(self, env_file: str) -> Union[None, str]:
+        path = os.path.normpath(os.path.join(self.cwd, env_file))
+        if not path.endswith(".json") or not os.path.isfile(path):
+            return None
+        return path
+
+    @staticmethod
+    def __git(tree: str, *args: str) -> subprocess.CompletedProcess:
+        return subprocess.run(
+            ["git", "-C", tree] + list(args),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            check=False,
+        )
+
+    def __checkout(self, init: InitParse, revision: str) -> bool:
+        """Check out the external trees of an env file at a revision.
+
+        :returns: True if the trees are at the revision, False if they could not be moved to
+                  it, IE: they have uncommitted changes.
+        """
+        trees = {
+            os.path.realpath(f"{init.buildroot_path}/{tree}")
+            for config in init.targets
+            for tree in str(config.config["external_trees"]).split(":")
+            if tree
+        }
+        for tree in sorted(trees):
+            head = self.__git(tree, "rev-parse", "HEAD")
+            if head.returncode != 0:
+                print(f"ERROR: {tree} is not a git checkout, can't check out {revision}")
+                return False
+            if head.stdout.strip() == revision:
+                continue
+            if self.__git(tree, "status", "--porcelain", "--untracked-files=no").stdout.strip():
+                print(f"ERROR: {tree} has uncommitted changes, can't check out {revision}")
+                return False
+            if self.__git(tree, "cat-file", "-e", f"{revision}^{{commit}}").returncode != 0:
+                self.__git(tree, "fetch", "--quiet", "origin")
+            checkout = self.__git(tree, "checkout", "--quiet", "--detach", revision)
+            if checkout.returncode != 0:
+                print(checkout.stdout, end="")
+                print(f"ERROR: Could not check out {revision} in {tree}")
+                return False
+            print(f"Checked out {revision} in {tree}")
+        return True
+
+    def __init_parse(self, env_path: str) -> Union[None, InitParse]:
+        """Get the parsed env file, parsing it again if it was modified."""
+        mtime = os.stat(env_path).st_mtime_ns
+        with self.condition:
+            cached = self.env_cache.get(env_path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        init = InitParse(env_path, True, False, self.clean_after_build)
+        try:
+            # Config parsing exits on a missing defconfig, which must not stop the daemon.
+            if not init.parse(update=True):
+                return None
+        except SystemExit:
+            return None
+        with self.condition:
+            self.env_cache[env_path] = (mtime, init)
+        return init
+
+    @staticmethod
+    def __run_action(init: InitParse, action: str, target: str) -> bool:
+        """The body of a job. Runs in a forked process."""
+        configs = [
+            config
+            for config in init.targets
+            if not target or config.config["defconfig"].replace("_defconfig", "") == target
+        ]
+        if not configs:
+            print(f"ERROR: No such target: {target}")
+            return False
+        if action == "clean":
+            return all(
+                Runner.gather(
+                    [config.clean_async(force=True) for config in configs],
+                    InitParse.concurrency(),
+                )
+            )
+        if action == "legal-info":
+            return all(Buildroot.legal_info(config.config) for config in configs)
+        # Clean, then apply, as InitParse.prepare does.
+        configs = [config for config in configs if target or not config.config["skip"]]
+        cleaned = Runner.gather(
+            [config.clean_async() for config in configs], InitParse.concurrency()
+        )
+        if not all(cleaned):
+            return False
+        applied = Runner.gather(
+            [config.apply_async() for config in configs], InitParse.concurrency()
+        )
+        if not all(applied):
+            return False
+        if action == "apply":
+            return True
+        if target:
+            os.environ["SINGLE_TARGET"] = target
+        jobs = init.jobs()
+        if jobs is None:
+            return False
+        InitParse.prefetch(jobs)
+        InitParse.verify_downloads(jobs)
+        InitParse.share_host_tools(jobs)
+        InitParse.enforce_disk_budget(jobs)
+        scheduler = Scheduler()
+        for job in jobs:
+            scheduler.add(job)
+        return scheduler.run()
+
+    def __execute(self, job: Job) -> bool:
+        """Run a job in a forked process with its output sent to the job's log."""
+        env_path = self.__env_path(job.env_file)
+        init = self.__init_parse(env_path) if env_path else None
+        if init is None:
+            with open(job.log_path, "a", encoding="utf-8") as log_fd:
+                log_fd.write(f"ERROR: Could not parse {job.env_file}\n")
+            return False
+        build_paths = {
+            config.config["defconfig"].replace("_defconfig", ""): config.config["build_path"]
+            for config in init.targets
+        }
+        with self.condition:
+            job.build_paths = {
+                name: build_path
+                for name, build_path in build_paths.items()
+                if not job.target or job.target == name
+            }
+
+        def child() -> None:
+            log_fd = os.open(job.log_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            os.dup2(log_fd, sys.stdout.fileno())
+            os.dup2(log_fd, sys.stderr.fileno())
+            os.close(log_fd)
+            if job.revision and not self.__checkout(init, job.revision):
+                sys.stdout.flush()
+                os._exit(1)  # pylint: disable=W0212
+            retval = self.__run_action(init, job.action, job.target)
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(0 if retval else 1)  # pylint: disable=W0212
+
+        process = multiprocessing.get_context("fork").Process(target=child, name=job.job_id)
+        process.start()
+        process.join()
+        return process.exitcode == 0
+
+    def __worker(self) -> None:
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+                job = self.queue[0]
+                job.status = "running"
+                job.started = time.time()
+            self.logger.info(f"Job {job.job_id}: {job.action} {job.env_file} {job.target}")
+            try:
+                retval = self.__execute(job)
+            except Exception as err:  # pylint: disable=W0703
+                self.logger.exception(f"Job {job.job_id}: {err}")
+                retval = False
+            with self.condition:
+                self.queue.popleft()
+                job.status = "succeeded" if retval else "failed"
+                job.finished = time.time()
+                self.condition.notify_all()
+            self.logger.info(f"Job {job.job_id}: {job.status}")
+
+    def submit(
+        self,
+        action: str,
+        env_file: str,
+        target: str = "",
+        env: Union[None, str] = None,
+        revision: str = "",
+    ) -> Tuple[Job, bool]:
+        """Queue a job, or return the identical job that has not started yet.
+
+        :param str action: One of Job.ACTIONS.
+        :param str env_file: The env file, relative to the docker directory.
+        :param str target: The target of which to run the job, or "" for every target.
+        :param str env: The content of the env file, used instead of the daemon's copy.
+        :param str revision: The commit to check the external trees out at first.
+        :returns: A tuple of the job and whether it was deduplicated.
+        :rtype: Tuple[Job, bool]
+        :raises ValueError: If the action, env file or env is not valid.
+        """
+        if action not in Job.ACTIONS:
+            raise ValueError(f"action must be one of {', '.join(Job.ACTIONS)}")
+        if os.path.isabs(env_file) or ".." in env_file.split("/"):
+            raise ValueError(f"{env_file}: must be relative to the docker directory")
+        if revision and not re.fullmatch(r"[0-9a-f]{7,40}", revision):
+            raise ValueError(f"{revision}: not a commit id")
+        if env is not None:
+            env_file = self.__save_env(env_file, env)
+        if self.__env_path(env_file) is None:
+            raise ValueError(f"{env_file}: no such env file")
+        with self.condition:
+            for job in self.queue:
+                # A running job may have started before the change the client wants built.
+                if job.status != "queued":
+                    continue
+                if (job.action, job.env_file, job.target, job.revision) == (
+                    action,
+                    env_file,
+                    target,
+                    revision,
+                ):
+                    job.clients += 1
+                    return job, True
+            job_id = str(next(self.counter))
+            log_path = f"{self.log_dir}/{self.start_time}-{job_id}.log"
+            job = Job(job_id, action, env_file, target, log_path, revision)
+            open(job.log_path, "w", encoding="utf-8").close()
+            self.jobs[job_id] = job
+            self.queue.append(job)
+            self.condition.notify_all()
+        return job, False
+
+    def follow(self, job: Job, write) -> None:
+        """Pass the log of a job to a callable until the job finishes.
+
+        :param Job job: The job of which to follow.
+        :param write: A callable taking bytes.
+        """
+        with open(job.log_path, "rb") as log_fd:
+            while True:
+                with self.condition:
+                    done = job.status in ("succeeded", "failed")
+                chunk = log_fd.read(65536)
+                if chunk:
+                    write(chunk)
+                    continue
+                if done:
+                    return
+                time.sleep(0.2)
+
+    def images(self, job: Job, fileobj) -> bool:
+        """Write the images/ directories of the targets of a job as a tar stream.
+
+        :param Job job: The job of which to send the images.
+        :param fileobj: A writable file object.
+        Only the output directories the job recorded when it ran are read.
+
+        :returns: False if the job did not record any target.
+        :rtype: bool
+        """
+        with self.condition:
+            build_paths = dict(job.build_paths)
+        if not build_paths:
+            return False
+        with tarfile.open(fileobj=fileobj, mode="w|") as tar:
+            for name, build_path in sorted(build_paths.items()):
+                images = f"{build_path}/images"
+                if os.path.isdir(images):
+                    tar.add(images, arcname=f"{name}/images")
+        return True
+
+    def __handler(self):
+        daemon = self
+
+        class Handler(BaseHTTPRequestHandler):
+            """HTTP requests of the job API."""
+
+            def address_string(self):
+                return self.client_address[0] if self.client_address else "unix"
+
+            def log_message(self, format, *args):  # pylint: disable=W0622
+                daemon.logger.debug(format % args)
+
+            def __reply(self, code: int, body: Any) -> None:
+                data = (json.dumps(body, indent=2) + "\n").encode()
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def __authorized(self) -> bool:
+                """Check the token of a TCP request, replying 401 if it is wrong."""
+                if isinstance(self.server, UnixHTTPServer) or not daemon.token:
+                    return True
+                if hmac.compare_digest(
+                    self.headers.get("Authorization", ""), f"Bearer {daemon.token}"
+                ):
+                    return True
+                self.__reply(401, {"error": "a valid DAEMON_TOKEN is required"})
+                return False
+
+            def do_GET(self):  # pylint: disable=C0103
+                if not self.__authorized():
+                    return
+                parts = [part for part in self.path.split("?")[0].split("/") if part]
+                if parts == ["jobs"]:
+                    with daemon.condition:
+                        jobs = [job.to_dict() for job in daemon.jobs.values()]
+                    self.__reply(200, jobs)
+                    return
+                if len(parts) < 2 or parts[0] != "jobs" or parts[1] not in daemon.jobs:
+                    self.__reply(404, {"error": "no such job"})
+                    return
+                job = daemon.jobs[parts[1]]
+                if parts[2:] == ["images"]:
+                    if job.status != "succeeded":
+                        self.__reply(409, {"error": f"the job is {job.status}"})
+                        return
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/x-tar")
+                    self.end_headers()
+                    try:
+                        daemon.images(job, self.wfile)
+                    except (BrokenPipeError, ConnectionResetError):
+                        pass
+                    return
+                if parts[2:] == ["log"]:
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; charset=utf-8")
+                    self.end_headers()
+                    try:
+                        daemon.follow(job, self.__write_flush)
+                    except (BrokenPipeError, ConnectionResetError):
+                        pass
+                    return
+                if parts[2:]:
+                    self.__reply(404, {"error": "not found"})
+                    return
+                self.__reply(200, job.to_dict())
+
+            def __write_flush(self, data: bytes) -> None:
+                self.wfile.write(data)
+                self.wfile.flush()
+
+            def do_POST(self):  # pylint: disable=C0103
+                if not self.__authorized():
+                    return
+                if self.path.rstrip("/") != "/jobs":
+                    self.__reply(404, {"error": "not found"})
+                    return
+                try:
+                    length = int(self.headers.get("Content-Length", 0))
+                    request = json.loads(self.rfile.read(length) or b"{}")
+                    env = request.get("env")
+                    job, deduplicated = daemon.submit(
+                        str(request.get("action", "")),
+                        str(request.get("env_file", "")),
+                        str(request.get("target", "") or ""),
+                        None if env is None else str(env),
+                        str(request.get("revision", "") or ""),
+                    )
+                except (ValueError, AttributeError) as err:
+                    self.__reply(400, {"error": str(err)})
+                    return
+                body = job.to_dict()
+                body["deduplicated"] = deduplicated
+                self.__reply(200 if deduplicated else 201, body)
+
+        return Handler
+
+    def serve(self) -> None:
+        """Serve the job API until interrupted."""
+        threading.Thread(target=self.__worker, daemon=True).start()
+        handler = self.__handler()
+        servers: List[socketserver.BaseServer] = []
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        unix_server = UnixHTTPServer(self.socket_path, handler)
+        servers.append(unix_server)
+        self.logger.info(f"Listening on {self.socket_path}")
+        if self.http_address:
+            host, _, port = self.http_address.rpartition(":")
+            if host and host.strip("[]") not in self.LOCAL_HOSTS and not self.token:
+                self.logger.error(
+                    f"DAEMON_HTTP listens on {host}, set DAEMON_TOKEN to accept requests"
+                )
+                sys.exit(-1)
+            servers.append(ThreadingHTTPServer((host or "127.0.0.1", int(port)), handler))
+            self.logger.info(f"Listening on http://{host or '127.0.0.1'}:{port}")
+        for server in servers[1:]:
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            unix_server.serve_forever()
+        finally:
+            for server in servers:
+                server.server_close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+    def __init__(self, clean_after_build: bool = False):
+        self.logger = Logger(__name__)
+        self.cwd = os.getcwd()
+        self.clean_after_build = clean_after_build
+        self.socket_path = os.path.abspath(
+            os.environ.get("DAEMON_SOCKET", "") or f"{self.cwd}/retroroot.sock"
+        )
+        self.http_address = os.environ.get("DAEMON_HTTP", "")
+        self.token = os.environ.get("DAEMON_TOKEN", "")
+        self.log_dir = os.path.abspath(
+            os.environ.get("DAEMON_LOG_DIR", "") or f"{self.cwd}/daemon-logs"
+        )
+        os.makedirs(self.log_dir, exist_ok=True)
+        self.start_time = time.strftime("%Y%m%d-%H%M%S")
+        self.counter = itertools.count(1)
+        self.condition = threading.Condition()
+        self.queue: Deque[Job] = deque()
+        self.jobs: Dict[str, Job] = {}
+        # Env file path: (mtime, parsed env file)
+        self.env_cache: Dict[str, Tuple[int, InitParse]] = {}
+
+
+class UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    """An HTTP server on a Unix socket."""
+
+    daemon_threads = True
+
+    def server_bind(self):
+        socketserver.ThreadingUnixStreamServer.server_bind(self)
+        self.server_name = socket.gethostname()
+        self.server_port = 0
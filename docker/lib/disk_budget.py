@@ -0,0 +1,320 @@
+"""Disk budget of the output directories"""
+import os
+import stat as stat_module
+import time
+import fcntl
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Set, Union
+from lib.artifact_cache import ArtifactCache
+from lib.build_staging import BuildStaging
+from lib.dirs import Dirs
+from lib.logger import Logger
+from lib.state import State
+
+
+class DiskBudget:
+    """Keep the output directories of all targets under a size budget.
+
+    Every target directory below the output directories, IE: retroroot/output/*, is measured,
+    along with the time it was last built. When their total is over DISK_BUDGET, the least
+    recently used targets are cut down until it is not:
+
+    1. Trimmed: the parts that are cheap to build again are removed. These are images/,
+       target/ and the build/ and per-package/ directories of the target packages. host/,
+       the host packages, the toolchain packages and Buildroot's own Kconfig tools are kept.
+       Their target, staging and images install stamps are removed, so the next build
+       installs them into target/ again, IE: libc from the toolchain, then builds the
+       target packages again.
+    2. Evicted: if trimming every target was not enough, whole target directories are
+       removed, least recently used first.
+
+    The targets about to be built, and targets another process is building, are never
+    touched. Files hardlinked between targets are counted once, split between their links.
+
+    Environment variables:
+      - DISK_BUDGET: The size the output directories may take, IE: 200G. Default: no budget
+      - DISK_BUDGET_EVICT: Remove whole target directories if trimming is not enough.
+                           Default: true
+    """
+
+    LOCK_FILE = ".retroroot/disk-budget.lock"
+    # Directories of a target that are removed when trimming it.
+    TRIM_DIRS = ("images", "target")
+    # Directories with a directory per package, of which the target packages are trimmed.
+    PACKAGE_DIRS = ("build", "per-package")
+    # The packages kept when trimming: host packages, the toolchain, IE: toolchain-external-*,
+    # and build/buildroot-config.
+    KEEP_PACKAGES = ("host-", "toolchain", "buildroot-config")
+    # The stamps of the kept packages removed with target/, so they are installed again.
+    INSTALL_STAMPS = (
+        ".stamp_target_installed",
+        ".stamp_staging_installed",
+        ".stamp_images_installed",
+    )
+
+    @staticmethod
+    def budget() -> Union[None, int]:
+        """Get the budget.
+
+        :returns: DISK_BUDGET in bytes, or None if it is not set or can't be parsed.
+        :rtype: Union[None, int]
+        """
+        budget = os.environ.get("DISK_BUDGET", "")
+        return ArtifactCache.parse_size(budget) if budget else None
+
+    @staticmethod
+    def enabled() -> bool:
+        """Check if the disk budget is enabled.
+
+        :returns: True if DISK_BUDGET is set.
+        :rtype: bool
+        """
+        return DiskBudget.budget() is not None
+
+    @staticmethod
+    @contextlib.contextmanager
+    def use(build_path: str) -> Iterator[None]:
+        """Mark a target as in use while it is built, and record the time it was last used.
+
+        :param str build_path: The output directory of the target.
+        """
+        state = State(build_path)
+        state.set("last_used", time.time())
+        state.save()
+        try:
+            lock_fd = open(f"{build_path}/{DiskBudget.LOCK_FILE}", "a", encoding="utf-8")
+        except OSError:
+            yield
+            return
+        with lock_fd:
+            fcntl.flock(lock_fd, fcntl.LOCK_SH)
+            yield
+
+    @staticmethod
+    def last_used(build_path: str) -> float:
+        """Get the time a target was last built.
+
+        :param str build_path: The output directory of the target.
+        :returns: The recorded time, or else the time of its .config.
+        :rtype: float
+        """
+        last_used = State(build_path).get("last_used")
+        if isinstance(last_used, (int, float)):
+            return float(last_used)
+        try:
+            return os.stat(f"{build_path}/.config").st_mtime
+        except OSError:
+            return 0.0
+
+    @staticmethod
+    def __size(path: str) -> int:
+        """Get the disk usage of a path, sharing hardlinked files between their links."""
+        size = 0
+        stack = [path]
+        while stack:
+            current = stack.pop()
+            try:
+                stat = os.lstat(current)
+            except OSError:
+                continue
+            if not stat_module.S_ISDIR(stat.st_mode):
+                size += stat.st_blocks * 512 // max(stat.st_nlink, 1)
+                continue
+            size += stat.st_blocks * 512
+            try:
+                stack += [entry.path for entry in os.scandir(current)]
+            except OSError:
+                continue
+        return size
+
+    def __measure(self, build_path: str) -> Dict[str, int]:
+        """Measure each part of a target: top-level entries and package directories."""
+        parts: Dict[str, int] = {}
+        try:
+            entries = list(os.scandir(build_path))
+        except OSError:
+            return parts
+        for entry in entries:
+            if entry.name not in self.PACKAGE_DIRS or not entry.is_dir(follow_symlinks=False):
+                parts[entry.name] = self.__size(entry.path)
+                continue
+            # The package directories, and the files next to them.
+            parts[entry.name] = 0
+            for package in os.scandir(entry.path):
+                if package.is_dir(follow_symlinks=False):
+                    parts[f"{entry.name}/{package.name}"] = self.__size(package.path)
+                else:
+                    parts[entry.name] += self.__size(package.path)
+        return parts
+
+    def __trimmable(self, parts: Dict[str, int]) -> List[str]:
+        """Get the parts of a target that trimming removes."""
+        trimmable: List[str] = []
+        for part in parts:
+            top, _, package = part.partition("/")
+            if top in self.TRIM_DIRS and not package:
+                trimmable.append(part)
+            elif top in self.PACKAGE_DIRS and package and not package.startswith(
+                self.KEEP_PACKAGES
+            ):
+                trimmable.append(part)
+        return sorted(trimmable)
+
+    def __reset_stamps(self, build_path: str) -> None:
+        """Remove the install stamps of the packages kept when trimming a target."""
+        try:
+            packages = [
+                entry.path
+                for entry in os.scandir(f"{build_path}/build")
+                if entry.is_dir(follow_symlinks=False)
+                and entry.name.startswith(self.KEEP_PACKAGES)
+            ]
+        except OSError:
+            return
+        for package in packages:
+            for stamp in self.INSTALL_STAMPS:
+                try:
+                    os.remove(f"{package}/{stamp}")
+                except FileNotFoundError:
+                    pass
+
+    @contextlib.contextmanager
+    def __unused(self, build_path: str) -> Iterator[bool]:
+        """Lock a target against builds, yielding False if it is being built."""
+        try:
+            os.makedirs(os.path.dirname(f"{build_path}/{self.LOCK_FILE}"), exist_ok=True)
+            lock_fd = open(f"{build_path}/{self.LOCK_FILE}", "a", encoding="utf-8")
+        except OSError:
+            yield False
+            return
+        with lock_fd:
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                yield False
+                return
+            yield True
+
+    def add(self, output_dirs: Iterable[str]) -> None:
+        """Add the target directories below output directories.
+
+        :param Iterable[str] output_dirs: The output directories, IE: retroroot/output.
+        """
+        for output_dir in output_dirs:
+            try:
+                entries = list(os.scandir(output_dir))
+            except OSError:
+                continue
+            for entry in entries:
+                # A Buildroot output directory, not the caches kept next to the targets.
+                if (
+                    entry.is_dir(follow_symlinks=False)
+                    and not entry.name.startswith(".")
+                    and os.path.isfile(f"{entry.path}/Makefile")
+                    and os.path.isfile(f"{entry.path}/.config")
+                ):
+                    self.targets.add(entry.path)
+
+    def protect(self, build_paths: Iterable[str]) -> None:
+        """Never trim or evict some targets, IE: the ones about to be built.
+
+        :param Iterable[str] build_paths: The output directories of the targets.
+        """
+        self.protected.update(build_paths)
+
+    def usage(self) -> Dict[str, Dict[str, float]]:
+        """Measure every target.
+
+        :returns: A dictionary of targets and their size, the size trimming them would free
+                  and the time they were last used, least recently used first.
+        :rtype: Dict[str, Dict[str, float]]
+        """
+        targets = sorted(self.targets)
+        with ThreadPoolExecutor(max_workers=min(len(targets), 8) or 1) as executor:
+            self.measured = dict(zip(targets, executor.map(self.__measure, targets)))
+        usage = {
+            target: {
+                "bytes": sum(parts.values()),
+                "trimmable_bytes": sum(parts[part] for part in self.__trimmable(parts)),
+                "last_used": self.last_used(target),
+            }
+            for target, parts in self.measured.items()
+        }
+        return dict(sorted(usage.items(), key=lambda item: item[1]["last_used"]))
+
+    def run(self, dry_run: bool = False) -> bool:
+        """Trim and evict the least recently used targets until the total is within budget.
+
+        :param bool dry_run: Only report what would be removed.
+        :returns: True if the targets are within the budget.
+        :rtype: bool
+        """
+        if self.limit is None:
+            return True
+        usage = self.usage()
+        sizes = {target: int(entry["bytes"]) for target, entry in usage.items()}
+        total = sum(sizes.values())
+        self.logger.info(
+            f"{len(usage)} targets take {total / 1024**3:.1f} GiB of a "
+            f"{self.limit / 1024**3:.1f} GiB budget"
+        )
+        candidates = [target for target in usage if target not in self.protected]
+        # The cheap parts of every target go before any whole target.
+        for target in candidates:
+            if total <= self.limit:
+                break
+            trimmable = self.__trimmable(self.measured[target])
+            freed = int(usage[target]["trimmable_bytes"])
+            if not freed:
+                continue
+            with self.__unused(target) as unused:
+                if not unused:
+                    self.logger.info(f"{target} is being built, not trimming it")
+                    continue
+                self.logger.info(
+                    f"{'Would trim' if dry_run else 'Trimming'} {target}, "
+                    f"freeing {freed / 1024**2:.0f} MiB"
+                )
+                if not dry_run:
+                    for part in trimmable:
+                        Dirs.remove(f"{target}/{part}")
+                    if "target" in trimmable:
+                        self.__reset_stamps(target)
+            sizes[target] -= freed
+            total -= freed
+            self.trimmed.append(target)
+        evict = os.environ.get("DISK_BUDGET_EVICT", "true").lower() != "false"
+        for target in candidates:
+            if total <= self.limit or not evict:
+                break
+            with self.__unused(target) as unused:
+                if not unused:
+                    self.logger.info(f"{target} is being built, not evicting it")
+                    continue
+                self.logger.info(
+                    f"{'Would evict' if dry_run else 'Evicting'} {target}, "
+                    f"freeing {sizes[target] / 1024**2:.0f} MiB"
+                )
+                if not dry_run:
+                    BuildStaging.discard(target)
+                    Dirs.remove(target)
+            total -= sizes[target]
+            self.evicted.append(target)
+        if total > self.limit:
+            self.logger.warning(
+                f"The targets still take {total / 1024**3:.1f} GiB, over the "
+                f"{self.limit / 1024**3:.1f} GiB budget"
+            )
+            return False
+        return True
+
+    def __init__(self):
+        self.logger = Logger(__name__)
+        self.limit = self.budget()
+        self.targets: Set[str] = set()
+        self.protected: Set[str] = set()
+        # The size of each part of every target, keyed on the target.
+        self.measured: Dict[str, Dict[str, int]] = {}
+        self.trimmed: List[str] = []
+        self.evicted: List[str] = []
@@ -0,0 +1,372 @@
+"""Integrity verification of the download directory"""
+import os
+import json
+import hashlib
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Set, Tuple, Union
+from lib.files import Files
+from lib.kconfig import KConfig
+from lib.logger import Logger
+from lib.packages import Packages
+
+
+class DownloadVerify:
+    """Check the files of the download directory against their hashes once, for every target.
+
+    Buildroot checks the hash of every source of a package in its download step, so each
+    target sharing a download directory reads every toolchain and kernel tarball again. This
+    stage hashes the sources of all targets at once, spread over the cores, and caches the
+    digests in the download directory keyed on the path, size and modification time of each
+    file, so only new or changed files are read again.
+
+    The hashes are looked up as Buildroot looks them up: the .hash files of the package in
+    BR2_GLOBAL_PATCH_DIR, IE: board/raspberrypi/hashes/linux/linux.hash, or else the .hash file
+    next to the package's .mk file. A file passes when it has at least one hash and all of them
+    match.
+
+    - A package whose sources all pass gets its download stamp in each target that has not
+      downloaded it yet, so make skips the download step and the hash checks in it.
+    - A file that does not match its hashes is reported and removed, as Buildroot would before
+      downloading it again.
+    - Files in the download directory that no target uses are reported as orphaned, with the
+      space they take. They are kept, another env file may use them.
+
+    The results are written to .retroroot-verify-report.json in the download directory.
+
+    Environment variables:
+      - DL_VERIFY: Verify the download directory before building. Default: true
+      - DL_VERIFY_JOBS: The number of files hashed at the same time. Default: all cores
+    """
+
+    HASH_TYPES = {"md5", "sha1", "sha224", "sha256", "sha384", "sha512"}
+    CACHE_FILE = ".retroroot-verify.json"
+    REPORT_FILE = ".retroroot-verify-report.json"
+    DOWNLOAD_STAMP = ".stamp_downloaded"
+
+    @staticmethod
+    def enabled() -> bool:
+        """Check if download verification is enabled.
+
+        :returns: True unless DL_VERIFY is set to false.
+        :rtype: bool
+        """
+        return os.environ.get("DL_VERIFY", "true").lower() != "false"
+
+    @staticmethod
+    def parse_hash_file(path: str) -> Dict[str, List[Tuple[str, str]]]:
+        """Parse a Buildroot .hash file.
+
+        :param str path: The .hash file, with lines like "sha256 <hash> <file>".
+        :returns: A dictionary of file names and their (type, hash) pairs. Empty if the file
+                  can't be read.
+        :rtype: Dict[str, List[Tuple[str, str]]]
+        """
+        hashes: Dict[str, List[Tuple[str, str]]] = {}
+        try:
+            with open(path, encoding="utf-8") as hash_fd:
+                for line in hash_fd:
+                    fields = line.split()
+                    if len(fields) != 3 or fields[0].startswith("#"):
+                        continue
+                    hashes.setdefault(fields[2], []).append((fields[0], fields[1].lower()))
+        except OSError:
+            pass
+        return hashes
+
+    def __hash_files(
+        self,
+        config_obj: Dict[str, Union[str, bool]],
+        package: str,
+        package_info: Dict[str, Any],
+        patch_dirs: List[str],
+    ) -> List[str]:
+        """Get the .hash files Buildroot checks the sources of a package against."""
+        buildroot_path = str(config_obj["buildroot_path"])
+        trees = str(config_obj["external_trees"])
+        if (buildroot_path, trees) not in self.package_dirs:
+            self.package_dirs[(buildroot_path, trees)] = Packages.package_dirs(
+                buildroot_path, trees
+            )
+        name = str(package_info.get("name") or package.replace("host-", "", 1))
+        version = str(package_info.get("version") or "")
+        global_files = [
+            path
+            for patch_dir in patch_dirs
+            for path in (
+                f"{patch_dir}/{name}/{version}/{name}.hash",
+                f"{patch_dir}/{name}/{name}.hash",
+            )
+            if os.path.isfile(path)
+        ]
+        if global_files:
+            return global_files
+        package_dir = self.package_dirs[(buildroot_path, trees)].get(name)
+        if not package_dir:
+            return []
+        for path in (f"{package_dir}/{version}/{name}.hash", f"{package_dir}/{name}.hash"):
+            if os.path.isfile(path):
+                return [path]
+        return []
+
+    def add(self, config_objs: List[Dict[str, Union[str, bool]]]) -> None:
+        """Add the sources of targets.
+
+        The targets must have been applied.
+
+        :param List[Dict[str, Union[str, bool]]] config_objs: Parsed config objects.
+        """
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            infos = list(executor.map(Packages.show_info, config_objs))
+        for config_obj, info in zip(config_objs, infos):
+            if not info:
+                self.logger.warning(
+                    f"{config_obj['defconfig']}: could not list the sources, not verifying"
+                )
+                continue
+            buildroot_path = str(config_obj["buildroot_path"])
+            kconfig = KConfig.load(f"{config_obj['build_path']}/.config", buildroot_path)
+            patch_dirs = [
+                os.path.join(buildroot_path, directory)
+                for directory in (kconfig.get("BR2_GLOBAL_PATCH_DIR") or "").split()
+            ]
+            # make runs from the Buildroot directory, which a relative BR2_DL_DIR is relative to.
+            dl_dir = os.path.join(buildroot_path, str(config_obj["dl_dir"]))
+            self.dl_dirs.add(dl_dir)
+            for package, package_info in sorted(info.items()):
+                if not isinstance(package_info, dict) or not package_info.get("downloads"):
+                    continue
+                hashes: Dict[str, List[Tuple[str, str]]] = {}
+                for hash_file in self.__hash_files(config_obj, package, package_info, patch_dirs):
+                    for source, pairs in self.parse_hash_file(hash_file).items():
+                        hashes.setdefault(source, []).extend(pairs)
+                dl_subdir = package_info.get("dl_dir") or package
+                paths: List[str] = []
+                for download in package_info["downloads"]:
+                    source = download.get("source")
+                    if not source:
+                        continue
+                    path = f"{dl_dir}/{dl_subdir}/{source}"
+                    paths.append(path)
+                    expected = self.expected.setdefault(path, set())
+                    expected.update(
+                        pair for pair in hashes.get(source, []) if pair[0] in self.HASH_TYPES
+                    )
+                self.packages.append((config_obj, package, package_info, paths))
+
+    @staticmethod
+    def __digest(path: str, hash_types: Set[str]) -> Dict[str, str]:
+        """Hash a file with several algorithms in a single read."""
+        hashers = {hash_type: hashlib.new(hash_type) for hash_type in sorted(hash_types)}
+        with open(path, "rb") as file_fd:
+            while True:
+                chunk = file_fd.read(1024 * 1024)
+                if not chunk:
+                    break
+                # hashlib releases the GIL on large buffers, so the workers hash in parallel.
+                for hasher in hashers.values():
+                    hasher.update(chunk)
+        return {hash_type: hasher.hexdigest() for hash_type, hasher in hashers.items()}
+
+    def __load_cache(self, dl_dir: str) -> Dict[str, Dict[str, Any]]:
+        try:
+            with open(f"{dl_dir}/{self.CACHE_FILE}", encoding="utf-8") as cache_fd:
+                cache = json.load(cache_fd)
+        except (OSError, json.decoder.JSONDecodeError):
+            return {}
+        return cache if isinstance(cache, dict) else {}
+
+    def __digests(self) -> Dict[str, Dict[str, str]]:
+        """Get the digests of every existing source, hashing the files the cache lacks."""
+        caches = {dl_dir: self.__load_cache(dl_dir) for dl_dir in self.dl_dirs}
+        digests: Dict[str, Dict[str, str]] = {}
+        stats: Dict[str, os.stat_result] = {}
+        pending: List[Tuple[str, Set[str]]] = []
+        for path, expected in self.expected.items():
+            try:
+                stats[path] = os.stat(path)
+            except OSError:
+                continue
+            dl_dir = next(dl_dir for dl_dir in self.dl_dirs if path.startswith(f"{dl_dir}/"))
+            entry = caches[dl_dir].get(os.path.relpath(path, dl_dir), {})
+            cached: Dict[str, str] = {}
+            if (
+                entry.get("size") == stats[path].st_size
+                and entry.get("mtime_ns") == stats[path].st_mtime_ns
+            ):
+                cached = entry.get("digests", {})
+            digests[path] = dict(cached)
+            missing = {hash_type for hash_type, _ in expected} - set(cached)
+            if missing:
+                pending.append((path, missing))
+        # The largest files first, so one does not start last and hold up the rest.
+        pending.sort(key=lambda item: stats[item[0]].st_size, reverse=True)
+        hashed_bytes = sum(stats[path].st_size for path, _ in pending)
+        self.logger.info(
+            f"Hashing {len(pending)} of {len(digests)} sources, "
+            f"{hashed_bytes / 1024**2:.0f} MiB, with {self.jobs} workers"
+        )
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            results = executor.map(lambda item: self.__safe_digest(*item), pending)
+            for (path, _), result in zip(pending, results):
+                digests[path].update(result)
+        for dl_dir, cache in caches.items():
+            # Entries of files that changed or are gone would never match again.
+            for relative in list(cache):
+                try:
+                    stat = os.stat(f"{dl_dir}/{relative}")
+                except OSError:
+                    del cache[relative]
+                    continue
+                if (cache[relative].get("size"), cache[relative].get("mtime_ns")) != (
+                    stat.st_size,
+                    stat.st_mtime_ns,
+                ):
+                    del cache[relative]
+            for path, path_digests in digests.items():
+                if path.startswith(f"{dl_dir}/") and path_digests:
+                    cache[os.path.relpath(path, dl_dir)] = {
+                        "size": stats[path].st_size,
+                        "mtime_ns": stats[path].st_mtime_ns,
+                        "digests": path_digests,
+                    }
+            Files.save_atomic(
+                f"{dl_dir}/{self.CACHE_FILE}", json.dumps(cache, indent=1, sort_keys=True)
+            )
+        return digests
+
+    def __safe_digest(self, path: str, hash_types: Set[str]) -> Dict[str, str]:
+        try:
+            return self.__digest(path, hash_types)
+        except OSError as err:
+            self.logger.warning(f"Could not hash {path}: {err}")
+            return {}
+
+    def __orphans(self, dl_dir: str) -> List[str]:
+        """Get the files of a download directory no target uses."""
+        orphans: List[str] = []
+        try:
+            entries = list(os.scandir(dl_dir))
+        except OSError:
+            return orphans
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            if entry.is_file(follow_symlinks=False):
+                files = [entry]
+            elif entry.is_dir(follow_symlinks=False):
+                # Not the VCS caches below it, IE: dl/<package>/git.
+                files = [
+                    sub_entry
+                    for sub_entry in os.scandir(entry.path)
+                    if sub_entry.is_file(follow_symlinks=False)
+                ]
+            else:
+                continue
+            orphans += [
+                file.path
+                for file in files
+                if file.path not in self.expected
+                and not file.name.startswith(".")
+                and not file.name.endswith(".tmp")
+            ]
+        return sorted(orphans)
+
+    def __stamp(self, passed: Set[str]) -> int:
+        """Write the download stamp of the packages of which every source passed."""
+        stamped = 0
+        for config_obj, package, package_info, paths in self.packages:
+            if not paths or not all(path in passed for path in paths):
+                continue
+            build_dir = Packages.build_dir(str(config_obj["build_path"]), package, package_info)
+            stamp = f"{build_dir}/{self.DOWNLOAD_STAMP}"
+            if os.path.exists(stamp):
+                continue
+            try:
+                os.makedirs(build_dir, exist_ok=True)
+                with open(stamp, "a", encoding="utf-8"):
+                    pass
+            except OSError as err:
+                self.logger.warning(f"{stamp}: {err}")
+                continue
+            stamped += 1
+        return stamped
+
+    def run(self) -> bool:
+        """Verify every source and report the corrupt and orphaned files.
+
+        :returns: False if a source did not match its hashes, otherwise True.
+        :rtype: bool
+        """
+        digests = self.__digests()
+        passed: Set[str] = set()
+        corrupt: List[str] = []
+        unchecked: List[str] = []
+        for path, expected in sorted(self.expected.items()):
+            if path not in digests:
+                continue
+            if not expected or not digests[path]:
+                unchecked.append(path)
+                continue
+            if any(digests[path].get(hash_type) != value for hash_type, value in expected):
+                corrupt.append(path)
+            else:
+                passed.add(path)
+        for path in corrupt:
+            self.logger.error(f"{path} does not match its hashes, removing it")
+            try:
+                os.remove(path)
+            except OSError as err:
+                self.logger.warning(f"{path}: {err}")
+        stamped = self.__stamp(passed)
+        for dl_dir in sorted(self.dl_dirs):
+            orphans = self.__orphans(dl_dir)
+            orphaned_bytes = 0
+            for path in orphans:
+                try:
+                    orphaned_bytes += os.lstat(path).st_size
+                except OSError:
+                    continue
+                self.logger.debug(f"Orphaned: {path}")
+            if orphans:
+                self.logger.info(
+                    f"{dl_dir}: {len(orphans)} files, {orphaned_bytes / 1024**2:.0f} MiB, "
+                    "are not used by any target"
+                )
+            report: Dict[str, Any] = {
+                name: [
+                    os.path.relpath(path, dl_dir)
+                    for path in paths
+                    if path.startswith(f"{dl_dir}/")
+                ]
+                for name, paths in (
+                    ("passed", sorted(passed)),
+                    ("corrupt", corrupt),
+                    ("unchecked", unchecked),
+                    ("missing", sorted(set(self.expected) - set(digests))),
+                    ("orphaned", orphans),
+                )
+            }
+            report["orphaned_bytes"] = orphaned_bytes
+            Files.save_atomic(f"{dl_dir}/{self.REPORT_FILE}", json.dumps(report, indent=2))
+        self.logger.info(
+            f"Verified {len(passed)} sources: {len(corrupt)} corrupt, {len(unchecked)} without "
+            f"hashes, {stamped} downloads skipped"
+        )
+        return not corrupt
+
+    def __init__(self):
+        self.logger = Logger(__name__)
+        try:
+            self.jobs = max(int(os.environ.get("DL_VERIFY_JOBS", 0)), 0)
+        except ValueError:
+            self.jobs = 0
+        self.jobs = self.jobs or multiprocessing.cpu_count()
+        # Keyed on the path of the file in the download directory, the (type, hash) pairs.
+        self.expected: Dict[str, Set[Tuple[str, str]]] = {}
+        # The target, name, show-info entry and source paths of every package with sources.
+        self.packages: List[
+            Tuple[Dict[str, Union[str, bool]], str, Dict[str, Any], List[str]]
+        ] = []
+        self.package_dirs: Dict[Tuple[str, str], Dict[str, str]] = {}
+        self.dl_dirs: Set[str] = set()
@@ -51,12 +51,9 @@ class Files:
         :rtype: str
         """
         logger = Logger("Files")
-        buff = ""
         try:
             with open(file_location, "rt", encoding="utf-8") as file_location_fd:
-                for line in file_location_fd:
-                    buff += line
-            file_location_fd.close()
+                buff = file_location_fd.read()
             if split:
                 return buff.split(split_delim)
             if strip:
@@ -66,6 +63,43 @@ class Files:
             logger.error(f"{file_location}:{err}")
             return None
 
+    @staticmethod
+    def tail(file_location, lines=100, block_size=65536):
+        """Get the last lines of a file without reading the whole file.
+
+        The file is read backwards in blocks until enough lines are found, so memory use
+        depends on the number of lines requested, not on the size of the file.
+
+        :param str file_location: The location of the file.
+        :param int lines: The number of lines to return.
+        :param int block_size: The number of bytes to read at a time.
+        :return: A list of at most the given number of lines, without line endings.
+        :rtype: list
+        """
+        logger = Logger("Files")
+        blocks = []
+        newlines = 0
+        try:
+            with open(file_location, "rb") as file_location_fd:
+                position = file_location_fd.seek(0, os.SEEK_END)
+                # A trailing newline does not start another line.
+                if position:
+                    file_location_fd.seek(position - 1)
+                    if file_location_fd.read(1) == b"\n":
+                        newlines -= 1
+                while position > 0 and newlines < lines:
+                    read_size = min(block_size, position)
+                    position -= read_size
+                    file_location_fd.seek(position)
+                    block = file_location_fd.read(read_size)
+                    newlines += block.count(b"\n")
+                    blocks.append(block)
+        except OSError as err:
+            logger.error(f"{file_location}: {err}")
+            return []
+        buff = b"".join(reversed(blocks)).decode("utf-8", errors="replace")
+        return buff.splitlines()[-lines:] if lines > 0 else []
+
     @staticmethod
     def save_buffer(file_location, buff, overwrite=False, append=False):
         """Take a buffer and write it to a file at a specified location.
@@ -92,3 +126,29 @@ class Files:
             return True
         except IsADirectoryError as err:
             raise IsADirectoryError from err
+
+    @staticmethod
+    def save_atomic(file_location, buff):
+        """Write a buffer to a temporary file and rename it over the specified location.
+
+        Readers never see a partially written file.
+
+        :param str file_location: The location of the file.
+        :param str buff: Buffer to write to the file.
+        :return: True on success, False on failure.
+        :rtype: bool
+        """
+        logger = Logger("Files")
+        tmp_location = f"{file_location}.tmp.{os.getpid()}"
+        try:
+            with open(tmp_location, "wt", encoding="utf-8") as file_location_fd:
+                file_location_fd.write(buff)
+                file_location_fd.flush()
+                os.fsync(file_location_fd.fileno())
+            os.replace(tmp_location, file_location)
+            return True
+        except OSError as err:
+            logger.error(f"{file_location}: {err}")
+            if os.path.exists(tmp_location):
+                os.remove(tmp_location)
+            return False
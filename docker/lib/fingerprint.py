@@ -0,0 +1,157 @@
+"""Fingerprinting of the inputs of Config.apply"""
+import os
+import hashlib
+from typing import Dict, List, Union
+from lib.state import State
+
+
+class Fingerprint:
+    """Content hashes of everything that goes into applying a config.
+
+    The inputs are the defconfig, every fragment in order, the Config.in and external.desc
+    files of each external tree, the Buildroot version and the apply command. The hashes of
+    the last successful apply, along with the hash of the resulting .config, are kept in the
+    per-target state.
+    """
+
+    # Directories of an external tree that never hold Kconfig files.
+    SKIP_DIRS = {".git", "dl", "output", "images", "production"}
+
+    @staticmethod
+    def hash_file(path: str) -> Union[None, str]:
+        """Get the sha256 of a file.
+
+        :param str path: The file of which to hash.
+        :returns: The hex digest, or None if the file can't be read.
+        :rtype: Union[None, str]
+        """
+        sha256 = hashlib.sha256()
+        try:
+            with open(path, "rb") as file_fd:
+                for chunk in iter(lambda: file_fd.read(1024 * 1024), b""):
+                    sha256.update(chunk)
+        except OSError:
+            return None
+        return sha256.hexdigest()
+
+    @staticmethod
+    def buildroot_version(buildroot_path: str) -> str:
+        """Get the Buildroot version from the top-level Makefile.
+
+        :param str buildroot_path: The Buildroot directory.
+        :returns: The version, or "unknown".
+        :rtype: str
+        """
+        try:
+            with open(f"{buildroot_path}/Makefile", encoding="utf-8") as makefile:
+                for line in makefile:
+                    if "BR2_VERSION :=" in line:
+                        return line.split(":=", maxsplit=1)[1].strip()
+        except OSError:
+            pass
+        return "unknown"
+
+    @staticmethod
+    def is_applied(build_path: str) -> bool:
+        """Check if .config is still exactly the one written by the last apply.
+
+        :param str build_path: The build directory of the target.
+        :returns: True if .config is unchanged since the last apply.
+        :rtype: bool
+        """
+        recorded = State(build_path).get("apply_fingerprint")
+        if not isinstance(recorded, dict) or not recorded.get("config"):
+            return False
+        return Fingerprint.hash_file(f"{build_path}/.config") == recorded["config"]
+
+    def __external_tree_files(self, tree_path: str) -> List[str]:
+        files: List[str] = []
+        skip = {os.path.realpath(path) for path in self.skip_paths}
+        for root, dirs, names in os.walk(tree_path, followlinks=False):
+            dirs[:] = sorted(
+                name
+                for name in dirs
+                if name not in self.SKIP_DIRS
+                and os.path.realpath(f"{root}/{name}") not in skip
+            )
+            for name in sorted(names):
+                if name.startswith("Config.in") or name == "external.desc":
+                    files.append(f"{root}/{name}")
+        return files
+
+    def inputs(self) -> Dict[str, str]:
+        """Hash every apply input.
+
+        :returns: A dictionary of input names and their hashes.
+        :rtype: Dict[str, str]
+        """
+        inputs: Dict[str, str] = {
+            "buildroot-version": self.buildroot_version(self.config_obj["buildroot_path"]),
+            "command": self.command,
+        }
+        inputs[f"defconfig:{self.config_obj['defconfig_path']}"] = str(
+            self.hash_file(self.config_obj["defconfig_path"])
+        )
+        for ndx, fragment in enumerate(self.fragments):
+            inputs[f"fragment[{ndx}]:{fragment}"] = str(self.hash_file(fragment))
+        for tree in self.config_obj["external_trees"].split(":"):
+            tree_path = f"{self.config_obj['buildroot_path']}/{tree}"
+            for path in self.__external_tree_files(tree_path):
+                inputs[f"kconfig:{path}"] = str(self.hash_file(path))
+        return inputs
+
+    def changed(self) -> List[str]:
+        """Compare the current inputs with the ones of the last apply.
+
+        :returns: A list of human-readable changes. An empty list means nothing changed and
+                  the .config is the one written by the last apply.
+        :rtype: List[str]
+        """
+        recorded = self.state.get("apply_fingerprint")
+        if not isinstance(recorded, dict):
+            return ["no previous apply recorded"]
+        changes: List[str] = []
+        old_inputs: Dict[str, str] = recorded.get("inputs", {})
+        new_inputs = self.inputs()
+        for name, digest in new_inputs.items():
+            if name not in old_inputs:
+                changes.append(f"added {name}")
+            elif old_inputs[name] != digest:
+                changes.append(f"changed {name}")
+        for name in old_inputs:
+            if name not in new_inputs:
+                changes.append(f"removed {name}")
+        if self.hash_file(self.dot_config) != recorded.get("config"):
+            changes.append(f"{self.dot_config} was modified or removed")
+        return changes
+
+    def save(self) -> bool:
+        """Record the current inputs and .config as applied.
+
+        :returns: True on success, False on failure.
+        :rtype: bool
+        """
+        self.state.set(
+            "apply_fingerprint",
+            {"inputs": self.inputs(), "config": self.hash_file(self.dot_config)},
+        )
+        return self.state.save()
+
+    def __init__(
+        self,
+        config_obj: Dict[str, Union[str, bool]],
+        fragments: List[str],
+        command: str,
+    ):
+        """Initialize the class.
+
+        :param config_obj: A parsed config object.
+        :param fragments: The paths of the fragments applied to the config, in order.
+        :param command: The command used to apply the config.
+        """
+        self.config_obj = config_obj
+        self.fragments = fragments
+        self.command = command
+        self.dot_config = f"{config_obj['build_path']}/.config"
+        self.skip_paths = [config_obj["output_dir"], config_obj["dl_dir"]]
+        self.state = State(config_obj["build_path"])
@@ -1,7 +1,8 @@
 import os
-import subprocess
 from typing import Any, List, Dict, Union
+from lib.dirs import Dirs
 from lib.files import Files
+from lib.kconfig import KConfig
 from lib.logger import Logger
 from lib.json_helper import JSONHelper
 
@@ -29,26 +30,58 @@ class Fragments:
                     fragments_temp.append(fragment_path)
         self.fragments = fragments_temp
 
-    def apply(self) -> None:
-        """Apply the config fragments defined in env.json for a given config.
+    def merge(self) -> Dict[str, Union[None, str]]:
+        """Merge the defconfig and all fragments into a single symbol map.
 
-        Note: We run "make olddefconfig" to force the kconfig system to rebuild the .config
-              with the default dependencies selected for the added fragments.
+        Later fragments override earlier ones. A fragment overriding a value set by another
+        fragment is reported as a conflict, a fragment overriding the defconfig is expected.
+
+        :returns: An ordered dictionary of symbols and raw values. None means "is not set".
+        :rtype: Dict[str, Union[None, str]]
         """
+        defconfig_path = self.config_obj["defconfig_path"]
+        merged = dict(KConfig.load(defconfig_path).raw)
+        origin = {symbol: defconfig_path for symbol in merged}
+        self.conflicts.clear()
         for fragment in self.fragments:
             self.logger.info(f"Applying fragment: {fragment}")
-            fragment_buff = Files.to_buffer(file_location=fragment)
-            Files.save_buffer(
-                f"{self.config_obj['build_path']}/.config", fragment_buff, append=True
-            )
-        os.chdir(self.config_obj["build_path"])
-        with open(os.devnull, "wb") as null:
-            subprocess.check_call(
-                [self.config_obj["make"], "olddefconfig"],
-                stdout=null,
-                stderr=subprocess.STDOUT,
-            )
-        os.chdir(self.buildroot_path)
+            for symbol, value in KConfig.load(fragment).raw.items():
+                if symbol in merged and merged[symbol] != value:
+                    if origin[symbol] == defconfig_path:
+                        self.logger.debug(f"{fragment}: overrides {symbol} from the defconfig")
+                    else:
+                        self.conflicts.append(
+                            f"{symbol}: {origin[symbol]} sets {self.__format(merged[symbol])}, "
+                            f"{fragment} overrides it with {self.__format(value)}"
+                        )
+                merged[symbol] = value
+                origin[symbol] = fragment
+        for conflict in self.conflicts:
+            self.logger.warning(f"Conflicting fragments: {conflict}")
+        return merged
+
+    @staticmethod
+    def __format(value: Union[None, str]) -> str:
+        return "is not set" if value is None else value
+
+    def apply(self) -> bool:
+        """Write the merged defconfig used to apply the config defined in env.json.
+
+        The defconfig and fragments are resolved in memory, so Kconfig only needs to run once,
+        through "make defconfig DEFCONFIG=<merged_path>", instead of once for the defconfig
+        and once more through "make olddefconfig" after appending the fragments to .config.
+
+        :returns: True on success, False on failure.
+        :rtype: bool
+        """
+        lines: List[str] = []
+        for symbol, value in self.merge().items():
+            if value is None:
+                lines.append(f"# {symbol} is not set\n")
+            else:
+                lines.append(f"{symbol}={value}\n")
+        Dirs.exists(os.path.dirname(self.merged_path), make=True)
+        return Files.save_atomic(self.merged_path, "".join(lines))
 
     def __init__(
         self,
@@ -59,4 +92,6 @@ class Fragments:
         self.config_obj = config_obj
         self.fragments: List[str] = []
         self.fragment_dir = ""
+        self.merged_path = f"{self.config_obj['build_path']}/.retroroot/merged_defconfig"
+        self.conflicts: List[str] = []
         self.logger = Logger(__name__)
@@ -0,0 +1,384 @@
+"""Build history database and regression detection"""
+import os
+import sqlite3
+import platform
+import contextlib
+import statistics
+import multiprocessing
+from typing import Any, Dict, List, Union
+from lib.fingerprint import Fingerprint
+from lib.logger import Logger
+
+
+class History:
+    """Keep the duration of every target and package build in a SQLite database.
+
+    Every build appends a run with its duration and result, the ccache and artifact cache
+    results, the size of every file in images/, the host it ran on and the time each package
+    spent in its steps.
+
+    A run is slower than usual when it is at least BUILD_HISTORY_THRESHOLD percent slower
+    than the mean of the BUILD_HISTORY_BASELINE successful runs before it, and more than
+    three standard deviations above that mean. Only runs of the same target on hosts with
+    the same number of cores, and of the same kind, are compared, and at least MIN_BASELINE
+    runs are needed. A run is full when it built at least FULL_SHARE of the target packages,
+    otherwise incremental. The duration of the target is only compared across full runs, as
+    that of an incremental run depends on what changed; the durations of its packages are
+    compared with the runs of the same kind.
+
+    Environment variables:
+      - BUILD_HISTORY: Record every build. Default: true
+      - BUILD_HISTORY_DB: The database. Default: <output dir>/.retroroot-history.sqlite
+      - BUILD_HISTORY_BASELINE: The number of earlier runs compared with. Default: 10
+      - BUILD_HISTORY_THRESHOLD: The slowdown in percent that is reported. Default: 10
+    """
+
+    MIN_BASELINE = 3
+    # The share of the target packages a full run builds.
+    FULL_SHARE = 0.9
+    # Packages shorter than this vary too much to compare.
+    MIN_PACKAGE_SECONDS = 10.0
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS runs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        target TEXT NOT NULL,
+        started REAL NOT NULL,
+        seconds REAL NOT NULL,
+        success INTEGER NOT NULL,
+        cores INTEGER,
+        host TEXT,
+        host_cpus INTEGER,
+        host_cpu_model TEXT,
+        host_memory_mib INTEGER,
+        host_kernel TEXT,
+        buildroot_version TEXT,
+        ccache_hits INTEGER,
+        ccache_misses INTEGER,
+        ccache_hit_rate REAL,
+        artifact_cache_hits INTEGER,
+        artifact_cache_misses INTEGER,
+        packages_built INTEGER,
+        full INTEGER
+    );
+    CREATE INDEX IF NOT EXISTS runs_target ON runs (target, started);
+    CREATE TABLE IF NOT EXISTS packages (
+        run_id INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+        package TEXT NOT NULL,
+        seconds REAL NOT NULL,
+        PRIMARY KEY (run_id, package)
+    );
+    CREATE INDEX IF NOT EXISTS packages_package ON packages (package);
+    CREATE TABLE IF NOT EXISTS images (
+        run_id INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+        name TEXT NOT NULL,
+        bytes INTEGER NOT NULL,
+        PRIMARY KEY (run_id, name)
+    );
+    """
+    # Columns added to runs since it was first created, and their types.
+    ADDED_COLUMNS = {"packages_built": "INTEGER", "full": "INTEGER"}
+
+    @staticmethod
+    def enabled() -> bool:
+        """Check if builds are recorded.
+
+        :returns: True unless BUILD_HISTORY is set to false.
+        :rtype: bool
+        """
+        return os.environ.get("BUILD_HISTORY", "true").lower() != "false"
+
+    @staticmethod
+    def db_path(config_obj: Dict[str, Union[str, bool]]) -> str:
+        """Get the database of a target.
+
+        :param Dict[str, Union[str, bool]] config_obj: A parsed config object.
+        :returns: BUILD_HISTORY_DB, or .retroroot-history.sqlite in the output directory.
+        :rtype: str
+        """
+        return os.environ.get("BUILD_HISTORY_DB", "") or (
+            f"{config_obj['output_dir']}/.retroroot-history.sqlite"
+        )
+
+    @staticmethod
+    def host() -> Dict[str, Any]:
+        """Describe the host the build runs on.
+
+        :returns: The host name, number of cores, CPU model, memory in MiB and kernel.
+        :rtype: Dict[str, Any]
+        """
+        cpu_model = ""
+        memory = 0
+        try:
+            with open("/proc/cpuinfo", encoding="utf-8") as cpuinfo:
+                for line in cpuinfo:
+                    if line.startswith("model name"):
+                        cpu_model = line.split(":", maxsplit=1)[1].strip()
+                        break
+            with open("/proc/meminfo", encoding="utf-8") as meminfo:
+                for line in meminfo:
+                    if line.startswith("MemTotal:"):
+                        memory = int(line.split()[1]) // 1024
+                        break
+        except (OSError, IndexError, ValueError):
+            pass
+        return {
+            "host": platform.node(),
+            "host_cpus": multiprocessing.cpu_count(),
+            "host_cpu_model": cpu_model,
+            "host_memory_mib": memory,
+            "host_kernel": platform.release(),
+        }
+
+    @staticmethod
+    def full(packages: Dict[str, float], total: Union[None, int]) -> Union[None, bool]:
+        """Check if a run built the whole target.
+
+        :param Dict[str, float] packages: The seconds each package of the run spent building.
+        :param int total: The number of target packages of the target, if known.
+        :returns: True if the run built at least FULL_SHARE of the target packages, None if
+                  the number of target packages is not known.
+        :rtype: Union[None, bool]
+        """
+        if not total:
+            return None
+        built = [package for package in packages if not package.startswith("host-")]
+        return len(built) >= total * History.FULL_SHARE
+
+    @staticmethod
+    def __env_int(name: str, default: int) -> int:
+        try:
+            return max(int(os.environ.get(name, default)), 1)
+        except ValueError:
+            return default
+
+    def connect(self) -> sqlite3.Connection:
+        """Open the database, creating it if needed.
+
+        :returns: A connection in WAL mode, so parallel builds can record at once.
+        :rtype: sqlite3.Connection
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=60)
+        connection.row_factory = sqlite3.Row
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA foreign_keys=ON")
+        connection.executescript(self.SCHEMA)
+        columns = {row["name"] for row in connection.execute("PRAGMA table_info(runs)")}
+        for column, column_type in self.ADDED_COLUMNS.items():
+            if column not in columns:
+                try:
+                    connection.execute(f"ALTER TABLE runs ADD COLUMN {column} {column_type}")
+                except sqlite3.OperationalError:
+                    # Added by another build meanwhile.
+                    pass
+        return connection
+
+    def record(
+        self,
+        config_obj: Dict[str, Union[str, bool]],
+        success: bool,
+        started: float,
+        seconds: float,
+        packages: Dict[str, float],
+        cores: Union[None, int] = None,
+        ccache: Union[None, Dict[str, Any]] = None,
+        artifact_cache: Union[None, Dict[str, Any]] = None,
+        full: Union[None, bool] = None,
+    ) -> Union[None, int]:
+        """Append a build of a target.
+
+        :param Dict[str, Union[str, bool]] config_obj: The parsed config of the target.
+        :param bool success: The result of the build.
+        :param float started: When the build started, in seconds since the epoch.
+        :param float seconds: How long the build took.
+        :param Dict[str, float] packages: The seconds each package spent in its steps.
+        :param int cores: The number of cores allotted to the build.
+        :param Dict[str, Any] ccache: The ccache results of the build, if enabled.
+        :param Dict[str, Any] artifact_cache: The artifact cache results, if enabled.
+        :param bool full: Whether the run built the whole target, None if not known.
+        :returns: The id of the run, or None if it could not be recorded.
+        :rtype: Union[None, int]
+        """
+        build_path = str(config_obj["build_path"])
+        ccache = ccache or {}
+        artifact_cache = artifact_cache or {}
+        images: Dict[str, int] = {}
+        images_dir = f"{build_path}/images"
+        for name in os.listdir(images_dir) if os.path.isdir(images_dir) else []:
+            path = f"{images_dir}/{name}"
+            if os.path.isfile(path) and not os.path.islink(path):
+                images[name] = os.path.getsize(path)
+        run = dict(
+            self.host(),
+            target=build_path.rsplit("/", maxsplit=1)[-1],
+            started=started,
+            seconds=round(seconds, 3),
+            success=int(success),
+            cores=cores,
+            buildroot_version=Fingerprint.buildroot_version(str(config_obj["buildroot_path"])),
+            ccache_hits=ccache.get("hits"),
+            ccache_misses=ccache.get("misses"),
+            ccache_hit_rate=ccache.get("hit_rate"),
+            artifact_cache_hits=artifact_cache.get("hits"),
+            artifact_cache_misses=artifact_cache.get("misses"),
+            packages_built=len(packages),
+            full=None if full is None else int(full),
+        )
+        try:
+            with contextlib.closing(self.connect()) as connection, connection:
+                cursor = connection.execute(
+                    f"INSERT INTO runs ({', '.join(run)}) "
+                    f"VALUES ({', '.join('?' for _ in run)})",
+                    list(run.values()),
+                )
+                run_id = cursor.lastrowid
+                connection.executemany(
+                    "INSERT INTO packages (run_id, package, seconds) VALUES (?, ?, ?)",
+                    [
+                        (run_id, package, round(seconds, 3))
+                        for package, seconds in packages.items()
+                    ],
+                )
+                connection.executemany(
+                    "INSERT INTO images (run_id, name, bytes) VALUES (?, ?, ?)",
+                    [(run_id, name, size) for name, size in images.items()],
+                )
+        except sqlite3.Error as err:
+            self.logger.warning(f"{run['target']}: failed to record the build history: {err}")
+            return None
+        return run_id
+
+    def runs(self, target: str, limit: int = 20) -> List[Dict[str, Any]]:
+        """Get the latest runs of a target, oldest first, with the total size of their images.
+
+        :param str target: The name of the target.
+        :param int limit: The maximum number of runs.
+        :rtype: List[Dict[str, Any]]
+        """
+        with contextlib.closing(self.connect()) as connection:
+            rows = connection.execute(
+                "SELECT *, (SELECT COALESCE(SUM(bytes), 0) FROM images WHERE run_id = runs.id) "
+                "AS images_bytes FROM runs WHERE target = ? ORDER BY started DESC LIMIT ?",
+                (target, limit),
+            ).fetchall()
+        return [dict(row) for row in reversed(rows)]
+
+    def targets(self) -> List[str]:
+        """Get every target of the database.
+
+        :rtype: List[str]
+        """
+        with contextlib.closing(self.connect()) as connection:
+            rows = connection.execute("SELECT DISTINCT target FROM runs ORDER BY target")
+            return [row["target"] for row in rows]
+
+    def __compare(self, name: str, value: float, baseline: List[float]) -> Union[None, Dict]:
+        """Compare a duration with the durations of earlier runs.
+
+        :returns: The comparison if the duration is a significant slowdown, otherwise None.
+        """
+        if len(baseline) < self.MIN_BASELINE:
+            return None
+        mean = statistics.mean(baseline)
+        # Identical baselines would flag any change, allow 1% of noise.
+        stdev = max(statistics.stdev(baseline), mean * 0.01)
+        change = (value - mean) / mean * 100 if mean else 0.0
+        score = (value - mean) / stdev if stdev else 0.0
+        if change < self.threshold or score < 3.0:
+            return None
+        return {
+            "name": name,
+            "seconds": round(value, 1),
+            "baseline_seconds": round(mean, 1),
+            "change_percent": round(change, 1),
+            "z_score": round(score, 1),
+        }
+
+    def regressions(self, target: str, run_id: Union[None, int] = None) -> List[Dict]:
+        """Find the significant slowdowns of a run of a target and of its packages.
+
+        :param str target: The name of the target.
+        :param int run_id: The run to check. Default: the latest successful run.
+        :returns: The slowdowns, the target first, then the packages by change.
+        :rtype: List[Dict]
+        """
+        with contextlib.closing(self.connect()) as connection:
+            query = "SELECT * FROM runs WHERE target = ? AND success = 1"
+            params: List[Any] = [target]
+            if run_id is not None:
+                query += " AND id = ?"
+                params.append(run_id)
+            run = connection.execute(
+                f"{query} ORDER BY started DESC LIMIT 1", params
+            ).fetchone()
+            if run is None:
+                return []
+            # Runs of which the kind is not known are only compared with each other.
+            baseline_runs = connection.execute(
+                "SELECT id, seconds FROM runs WHERE target = ? AND success = 1 "
+                "AND host_cpus = ? AND full IS ? AND started < ? ORDER BY started DESC LIMIT ?",
+                (target, run["host_cpus"], run["full"], run["started"], self.baseline),
+            ).fetchall()
+            regressions: List[Dict] = []
+            if run["full"]:
+                overall = self.__compare(
+                    target, run["seconds"], [row["seconds"] for row in baseline_runs]
+                )
+                if overall is not None:
+                    regressions.append(overall)
+            baseline_ids = [row["id"] for row in baseline_runs]
+            if not baseline_ids:
+                return regressions
+            durations: Dict[str, List[float]] = {}
+            for row in connection.execute(
+                f"SELECT package, seconds FROM packages WHERE run_id IN "
+                f"({', '.join('?' for _ in baseline_ids)})",
+                baseline_ids,
+            ):
+                durations.setdefault(row["package"], []).append(row["seconds"])
+            packages: List[Dict] = []
+            for row in connection.execute(
+                "SELECT package, seconds FROM packages WHERE run_id = ? AND seconds >= ?",
+                (run["id"], self.MIN_PACKAGE_SECONDS),
+            ):
+                regression = self.__compare(
+                    row["package"], row["seconds"], durations.get(row["package"], [])
+                )
+                if regression is not None:
+                    packages.append(regression)
+        packages.sort(key=lambda regression: -regression["change_percent"])
+        return regressions + packages
+
+    def report(self, target: str, run_id: Union[None, int] = None) -> List[Dict]:
+        """Log the significant slowdowns of a run.
+
+        :param str target: The name of the target.
+        :param int run_id: The run to check. Default: the latest successful run.
+        :returns: The slowdowns.
+        :rtype: List[Dict]
+        """
+        try:
+            regressions = self.regressions(target, run_id)
+        except sqlite3.Error as err:
+            self.logger.warning(f"{target}: failed to read the build history: {err}")
+            return []
+        for regression in regressions:
+            self.logger.warning(
+                f"{target}: {regression['name']} took {regression['seconds']}s, "
+                f"{regression['change_percent']:+.1f}% over its baseline of "
+                f"{regression['baseline_seconds']}s"
+            )
+        return regressions
+
+    def __init__(self, path: str):
+        """Initialize the class.
+
+        :param str path: The database file.
+        """
+        self.logger = Logger(__name__)
+        self.path = path
+        self.baseline = self.__env_int("BUILD_HISTORY_BASELINE", 10)
+        try:
+            self.threshold = float(os.environ.get("BUILD_HISTORY_THRESHOLD", "10"))
+        except ValueError:
+            self.threshold = 10.0
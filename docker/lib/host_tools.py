@@ -0,0 +1,427 @@
+"""Host packages and toolchains shared across targets"""
+import os
+import json
+import shutil
+import hashlib
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Set, Tuple, Union
+from lib.fingerprint import Fingerprint
+from lib.kconfig import KConfig
+from lib.logger import Logger
+from lib.packages import Packages
+from lib.runner import Runner
+
+
+class HostTools:
+    """Build the host packages and external toolchain that several targets share only once.
+
+    Only targets with BR2_PER_PACKAGE_DIRECTORIES take part, as their host packages are
+    installed into a directory of their own, output/<target>/per-package/<package>.
+
+    - Each host-* and toolchain-external-* package of each target gets a key: a hash of the
+      Buildroot version, the external trees and global patch directories, the package's
+      version and sources, its config options, the target architecture and the keys of its
+      dependencies. The key of a toolchain-external-* package also holds the toolchain and
+      target CPU options. A package is only shared if all its dependencies are, or are
+      neutral: the skeleton and virtual packages every target package depends on. These are
+      part of the key, along with the skeleton and init system options, but are not shared.
+    - For every key used by more than one target, a target that has the package installed
+      is the source. If none has, the target sharing the most such packages builds them
+      first with "make <packages>".
+    - The per-package and build directories of the source are then copied into every other
+      target that has not installed the package yet, with hardlinks as Buildroot does between
+      per-package directories. Text files holding the source's output path are rewritten,
+      like Buildroot's per-package path fixup, and the rpaths of ELF files holding it are
+      rewritten with patchelf. The stamp files keep their times, so make considers the copied
+      packages installed.
+
+    A host package whose .mk file reads target options other than the ones in the key may be
+    shared when it should not be. HOST_TOOLS_EXCLUDE lists packages never to share.
+
+    Environment variables:
+      - SHARE_HOST_TOOLS: Share host packages and toolchains across targets. Default: true
+      - HOST_TOOLS_EXCLUDE: A space separated list of packages never to share. Default: none
+    """
+
+    # Options of every target that change how its host packages are built.
+    HOST_SYMBOLS = ("BR2_ARCH", "BR2_ENDIAN", "BR2_CCACHE", "BR2_REPRODUCIBLE")
+    # Option prefixes that change what an external toolchain installs.
+    TOOLCHAIN_PREFIXES = (
+        "BR2_TOOLCHAIN",
+        "BR2_GCC_TARGET_",
+        "BR2_BINFMT_",
+        "BR2_ROOTFS_MERGED_",
+        "BR2_STATIC_LIBS",
+        "BR2_SHARED_",
+    )
+    # Option prefixes that change what the skeleton installs.
+    SKELETON_PREFIXES = ("BR2_ROOTFS_", "BR2_INIT_", "BR2_TARGET_GENERIC_", "BR2_SYSTEM_")
+    FILE_LISTS = (
+        "packages-file-list.txt",
+        "packages-file-list-staging.txt",
+        "packages-file-list-host.txt",
+    )
+    ELF_MAGIC = b"\x7fELF"
+
+    @staticmethod
+    def enabled() -> bool:
+        """Check if sharing host packages is enabled.
+
+        :returns: True unless SHARE_HOST_TOOLS is set to false.
+        :rtype: bool
+        """
+        return os.environ.get("SHARE_HOST_TOOLS", "true").lower() != "false"
+
+    @staticmethod
+    def candidate(package: str, package_info: Any) -> bool:
+        """Check if a package may be shared.
+
+        :param str package: The name of the package.
+        :param package_info: The show-info entry of the package.
+        :returns: True for host packages and external toolchains.
+        :rtype: bool
+        """
+        if not isinstance(package_info, dict) or package_info.get("virtual"):
+            return False
+        return package.startswith(("host-", "toolchain-external-"))
+
+    @staticmethod
+    def neutral(package: str, package_info: Any) -> bool:
+        """Check if a package only takes part in the keys of the packages depending on it.
+
+        :param str package: The name of the package.
+        :param package_info: The show-info entry of the package.
+        :returns: True for the skeleton and virtual packages.
+        :rtype: bool
+        """
+        if not isinstance(package_info, dict):
+            return False
+        return bool(package_info.get("virtual")) or package == "skeleton" or (
+            package.startswith("skeleton-")
+        )
+
+    def installed(self, build_path: str, package: str) -> bool:
+        """Check if a target has installed a package.
+
+        :param str build_path: The output directory of the target.
+        :param str package: The name of the package.
+        :rtype: bool
+        """
+        return Packages.installed(build_path, package, self.infos[build_path])
+
+    def __symbols(self, package: str, kconfig: KConfig) -> Dict[str, Union[None, str]]:
+        """Get the options of a target that are part of a package's key."""
+        if package.startswith("toolchain-external-"):
+            prefixes: Tuple[str, ...] = self.TOOLCHAIN_PREFIXES
+        elif package.startswith("skeleton"):
+            prefixes = self.SKELETON_PREFIXES
+        else:
+            prefixes = (f"BR2_PACKAGE_{package.upper().replace('-', '_')}",)
+        return {
+            symbol: value
+            for symbol, value in sorted(kconfig.raw.items())
+            if symbol.startswith(prefixes) or symbol in self.HOST_SYMBOLS
+        }
+
+    def __keys(
+        self, config_obj: Dict[str, Union[str, bool]], info: Dict[str, Any]
+    ) -> Dict[str, str]:
+        """Get the key of every package of a target that can be shared."""
+        buildroot_path = str(config_obj["buildroot_path"])
+        kconfig = KConfig.load(f"{config_obj['build_path']}/.config", buildroot_path)
+        common = {
+            "buildroot-version": Fingerprint.buildroot_version(buildroot_path),
+            "external-trees": config_obj["external_trees"],
+            "global-patch-dir": kconfig.get("BR2_GLOBAL_PATCH_DIR"),
+        }
+        keys: Dict[str, Union[None, str]] = {}
+
+        def key(package: str) -> Union[None, str]:
+            if package in keys:
+                return keys[package]
+            package_info = info.get(package)
+            if package in self.exclude or not (
+                self.candidate(package, package_info) or self.neutral(package, package_info)
+            ):
+                return None
+            # None while the dependencies are keyed, which breaks dependency cycles.
+            keys[package] = None
+            dependencies: Dict[str, Union[None, str]] = {}
+            for dependency in sorted(package_info.get("dependencies", [])):
+                dependencies[dependency] = key(dependency)
+                if dependencies[dependency] is None:
+                    return None
+            payload = dict(
+                common,
+                package=package,
+                version=package_info.get("version"),
+                sources=[download.get("source") for download in package_info.get("downloads", [])],
+                symbols=self.__symbols(package, kconfig),
+                dependencies=dependencies,
+            )
+            keys[package] = hashlib.sha256(
+                json.dumps(payload, sort_keys=True).encode()
+            ).hexdigest()
+            return keys[package]
+
+        for package in info:
+            key(package)
+        return {
+            package: value
+            for package, value in keys.items()
+            if value is not None and self.candidate(package, info[package])
+        }
+
+    def add(self, config_objs: List[Dict[str, Union[str, bool]]]) -> None:
+        """Add the shareable packages of targets.
+
+        The targets must have been applied.
+
+        :param List[Dict[str, Union[str, bool]]] config_objs: Parsed config objects.
+        """
+        config_objs = [config_obj for config_obj in config_objs if config_obj["per_package"]]
+        with ThreadPoolExecutor(max_workers=max(len(config_objs), 1)) as executor:
+            infos = list(executor.map(Packages.show_info, config_objs))
+        for config_obj, info in zip(config_objs, infos):
+            if not info:
+                self.logger.warning(
+                    f"{config_obj['defconfig']}: could not list the packages, not sharing them"
+                )
+                continue
+            build_path = str(config_obj["build_path"])
+            self.targets[build_path] = config_obj
+            self.infos[build_path] = info
+            for package, key in self.__keys(config_obj, info).items():
+                self.groups.setdefault(key, []).append((build_path, package))
+
+    def __patchelf(self, build_path: str) -> Union[None, str]:
+        """Find patchelf on the host or in a target's host directory."""
+        for path in (
+            shutil.which("patchelf"),
+            f"{build_path}/host/bin/patchelf",
+            f"{build_path}/per-package/host-patchelf/host/bin/patchelf",
+        ):
+            if path and os.access(path, os.X_OK):
+                return path
+        return None
+
+    @staticmethod
+    def __is_text(data: bytes) -> bool:
+        """Check if a file is text, the way grep tells binary files apart."""
+        if b"\0" in data:
+            return False
+        try:
+            data.decode("utf-8")
+        except UnicodeDecodeError:
+            return False
+        return True
+
+    def __copy_file(self, path: str, target: str, old: bytes, new: bytes) -> bool:
+        """Copy a file, rewriting the old output directory if it holds it.
+
+        Only text files are rewritten, the length of the path changes. ELF files only have
+        their rpath rewritten.
+
+        :returns: False if a binary file references the old output directory, other than in
+                  the rpath of an ELF file, or there is no patchelf to fix the rpath.
+        """
+        with open(path, "rb") as file_fd:
+            data = file_fd.read()
+        if old not in data:
+            try:
+                os.link(path, target)
+            except OSError:
+                shutil.copy2(path, target)
+            return True
+        if data.startswith(self.ELF_MAGIC):
+            if self.patchelf is None:
+                self.logger.warning(f"{path}: references {old.decode()}, no patchelf to fix it")
+                return False
+            shutil.copy2(path, target)
+            rpath = Runner.run(
+                [self.patchelf, "--print-rpath", target], capture=True, stderr=False
+            )
+            if rpath and old in rpath.output.encode():
+                new_rpath = rpath.output.strip().replace(old.decode(), new.decode())
+                if not Runner.run([self.patchelf, "--set-rpath", new_rpath, target]):
+                    return False
+            with open(target, "rb") as file_fd:
+                if old not in file_fd.read():
+                    return True
+            self.logger.warning(f"{path}: references {old.decode()} outside of its rpath")
+            return False
+        if not self.__is_text(data):
+            self.logger.warning(f"{path}: a binary file referencing {old.decode()}")
+            return False
+        # A new file, as changing a hardlink would change the source target's file as well.
+        with open(target, "wb") as file_fd:
+            file_fd.write(data.replace(old, new))
+        shutil.copystat(path, target)
+        return True
+
+    def __copy_tree(self, source: str, destination: str, old: bytes, new: bytes) -> bool:
+        """Copy a directory, rewriting the files that reference the old output directory."""
+        for root, dirs, names in os.walk(source):
+            target_root = destination + root[len(source):]
+            os.makedirs(target_root, exist_ok=True)
+            for name in dirs + names:
+                path = f"{root}/{name}"
+                target = f"{target_root}/{name}"
+                if os.path.islink(path):
+                    link = os.readlink(path).encode().replace(old, new)
+                    os.symlink(link.decode(), target)
+                elif name in names and not self.__copy_file(path, target, old, new):
+                    return False
+        # Directory times last, once their entries are written.
+        for root, dirs, _ in os.walk(source, topdown=False):
+            for name in dirs + [""]:
+                path = os.path.join(root, name)
+                if not os.path.islink(path):
+                    shutil.copystat(path, destination + path[len(source):])
+        return True
+
+    def __import(self, source_path: str, destination_path: str, package: str) -> bool:
+        """Copy an installed package from one target into another."""
+        package_info = self.infos[source_path][package]
+        directories = [
+            (f"{source_path}/per-package/{package}", f"{destination_path}/per-package/{package}"),
+            (
+                Packages.build_dir(source_path, package, package_info),
+                Packages.build_dir(destination_path, package, package_info),
+            ),
+        ]
+        if not all(os.path.isdir(source_dir) for source_dir, _ in directories):
+            return False
+        self.patchelf = self.__patchelf(source_path)
+        old = source_path.encode()
+        new = destination_path.encode()
+        for source_dir, destination_dir in directories:
+            # Whatever a failed build of the package left behind.
+            shutil.rmtree(destination_dir, ignore_errors=True)
+            shutil.rmtree(f"{destination_dir}.tmp", ignore_errors=True)
+            if not self.__copy_tree(source_dir, f"{destination_dir}.tmp", old, new):
+                for _, directory in directories:
+                    shutil.rmtree(f"{directory}.tmp", ignore_errors=True)
+                return False
+        # The build directory holds the stamps, so it goes last.
+        for _, destination_dir in directories:
+            os.replace(f"{destination_dir}.tmp", destination_dir)
+        for file_list in self.FILE_LISTS:
+            try:
+                with open(f"{source_path}/build/{file_list}", encoding="utf-8") as list_fd:
+                    lines = [line for line in list_fd if line.startswith(f"{package},")]
+            except OSError:
+                continue
+            if lines:
+                with open(
+                    f"{destination_path}/build/{file_list}", "a", encoding="utf-8"
+                ) as list_fd:
+                    list_fd.write("".join(lines).replace(source_path, destination_path))
+        return True
+
+    def __build(self, build_path: str, packages: List[str]) -> bool:
+        """Build packages of a target, so other targets can copy them."""
+        config_obj = self.targets[build_path]
+        cores = os.environ.get("BUILD_CORES", "") or str(multiprocessing.cpu_count())
+        self.logger.info(
+            f"{config_obj['defconfig']}: building {len(packages)} packages shared with other "
+            f"targets: {' '.join(packages)}"
+        )
+        cmd = [
+            str(config_obj["make"]),
+            f"BR2_DL_DIR={config_obj['dl_dir']}",
+            "-Otarget",
+            f"-j{cores}",
+        ] + packages
+        if not Runner.run(cmd, cwd=build_path):
+            self.logger.warning(f"{config_obj['defconfig']}: failed to build the shared packages")
+            return False
+        return True
+
+    def sources(self) -> Dict[str, Tuple[str, str]]:
+        """Find or build the source of every shared package.
+
+        :returns: The output directory and package name of the source of each key.
+        :rtype: Dict[str, Tuple[str, str]]
+        """
+        shared = {key: members for key, members in self.groups.items() if len(members) > 1}
+        sources: Dict[str, Tuple[str, str]] = {}
+        for key, members in shared.items():
+            for build_path, package in members:
+                if self.installed(build_path, package):
+                    sources[key] = (build_path, package)
+                    break
+        # Every package no target has installed yet is built by one target, picking the
+        # targets that share the most of them first.
+        builds: Dict[str, List[str]] = {}
+        missing = [key for key in shared if key not in sources]
+        while missing:
+            counts: Dict[str, int] = {}
+            for key in missing:
+                for build_path, _ in shared[key]:
+                    counts[build_path] = counts.get(build_path, 0) + 1
+            builder = max(sorted(counts), key=lambda path: counts[path])
+            for key in missing:
+                for build_path, package in shared[key]:
+                    if build_path == builder:
+                        sources[key] = (build_path, package)
+                        builds.setdefault(builder, []).append(package)
+            missing = [key for key in missing if key not in sources]
+        for build_path, packages in builds.items():
+            self.__build(build_path, sorted(packages))
+        return sources
+
+    def run(self) -> bool:
+        """Build the shared packages once and copy them into every target that lacks them.
+
+        :returns: True on success. On failure the targets build the packages they lack
+                  themselves, so it is not fatal.
+        :rtype: bool
+        """
+        sources = self.sources()
+        imports: List[Tuple[str, str, str]] = []
+        for key, (source_path, _) in sources.items():
+            for build_path, package in self.groups[key]:
+                if build_path != source_path:
+                    imports.append((build_path, package, source_path))
+        # Dependencies first, as a package is only usable on top of its dependencies.
+        order = {
+            (build_path, package): position
+            for build_path, info in self.infos.items()
+            for position, package in enumerate(Packages.build_order(info, info))
+        }
+        imports.sort(key=lambda item: (item[0], order[(item[0], item[1])]))
+        retval = all(self.installed(*source) for source in sources.values())
+        imported: Dict[str, List[str]] = {}
+        for build_path, package, source_path in imports:
+            if not self.installed(source_path, package) or self.installed(build_path, package):
+                continue
+            info = self.infos[build_path]
+            # The neutral dependencies are built by the target itself, later.
+            dependencies = [
+                dependency
+                for dependency in info[package].get("dependencies", [])
+                if self.candidate(dependency, info.get(dependency))
+            ]
+            if not all(self.installed(build_path, dependency) for dependency in dependencies):
+                continue
+            if not self.__import(source_path, build_path, package):
+                retval = False
+                continue
+            imported.setdefault(str(self.targets[build_path]["defconfig"]), []).append(package)
+        for defconfig, packages in sorted(imported.items()):
+            self.logger.info(
+                f"{defconfig}: reusing {len(packages)} shared packages: {' '.join(packages)}"
+            )
+        return retval
+
+    def __init__(self):
+        self.logger = Logger(__name__)
+        self.exclude: Set[str] = set(os.environ.get("HOST_TOOLS_EXCLUDE", "").split())
+        # Output directory: config object, show-info
+        self.targets: Dict[str, Dict[str, Union[str, bool]]] = {}
+        self.infos: Dict[str, Dict[str, Any]] = {}
+        # Key: [(output directory, package)]
+        self.groups: Dict[str, List[Tuple[str, str]]] = {}
+        self.patchelf: Union[None, str] = None
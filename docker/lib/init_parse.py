@@ -3,17 +3,27 @@ import os
 import sys
 import json
 import logging
-from typing import List
+import argparse
+import multiprocessing
+from functools import partial
+from typing import List, Union
 from lib.config import Config
 from lib.json_helper import JSONHelper
 from lib.buildroot import Buildroot
+from lib.build_staging import BuildStaging
+from lib.host_tools import HostTools
 from lib.logger import Logger
+from lib.prefetch import Prefetch
+from lib.disk_budget import DiskBudget
+from lib.dl_verify import DownloadVerify
+from lib.runner import Runner
+from lib.scheduler import BuildJob, Scheduler
 
 
 class InitParse:
     """Init file parsing class."""
 
-    def _parse_env(self):
+    def __parse_env(self):
         environment = {}
         if "environment" in self.env:
             environment = self.env["environment"][0]
@@ -30,60 +40,273 @@ class InitParse:
             str,
             "buildroot",
         )[1]
-        self.buildroot_path = f"/home/{self.user}/buildroot"
-
-    def __single_target(self, target: str, config: Config):
-        for defconfig in self.env["configs"]:
-            config_obj = config.parse(defconfig)
-            if target == config_obj["defconfig"].replace("_defconfig", ""):
-                # Generate the legal information first, as to ensure the tarball is in the images
-                # directory before post-image.sh is called.
-                if config_obj["legal_info"]:
-                    if not Buildroot.legal_info(config_obj):
-                        return False
-                if not Buildroot.build(config_obj):
-                    return False
-                if self.clean_after_build:
-                    config.clean(force=True)
-                return True
-        self.logger.error(f"Could not find target: {target}")
-        return False
+        # buildroot_path overrides the default of /home/${user}/${buildroot_dir_name}, IE: to
+        # run outside of the docker container.
+        self.buildroot_path = JSONHelper.parse_attr(
+            environment,
+            "buildroot_path",
+            str,
+            f"/home/{self.user}/{self.buildroot_dir_name}",
+        )[1]
 
-    def run(self) -> bool:
-        """Run all the steps."""
-        single_target = os.environ.get("SINGLE_TARGET", None)
+    def parse(self, update: bool = False, configs: bool = True) -> bool:
+        """Parse the env file, then every config in it.
 
-        self._parse_env()
-        config = Config(self.buildroot_path, self.apply_configs)
-        if self.update:
+        :param bool update: Update Buildroot before parsing the configs, if the env file has
+                            update_buildroot set.
+        :param bool configs: Also parse the configs. If False, only the environment is parsed,
+                             IE: for buildroot_path.
+        :returns: True on success, False on failure.
+        :rtype: bool
+        """
+        self.__parse_env()
+        if update and self.update:
             Buildroot.update(self.buildroot_path)
+        return self.parse_configs() if configs else True
+
+    def parse_configs(self) -> bool:
+        """Parse every config in the env file once.
+
+        The parsed configs are kept for the apply, build and single target steps.
+
+        :returns: True on success, False on failure.
+        :rtype: bool
+        """
+        if self.targets is not None:
+            return True
+        targets: List[Config] = []
         for defconfig in self.env["configs"]:
-            config_obj = config.parse(defconfig)
-            if config_obj["skip"]:
-                self.logger.info(f"Skipping {config_obj['defconfig']}")
-                continue
-            if not config.clean():
-                return False
-            if not config.apply():
+            config = Config(self.buildroot_path, self.apply_configs)
+            if not config.parse(defconfig):
                 return False
-        if single_target:
-            return self.__single_target(single_target, config)
-        for defconfig in self.env["configs"]:
-            config_obj = config.parse(defconfig)
-            if not config_obj["build"] or config_obj["skip"] or self.no_build:
-                self.logger.info(f"{config_obj['defconfig']}: Skip build step")
-                continue
+            targets.append(config)
+        self.targets = targets
+        return True
+
+    def __build_target(self, config: Config, cores: Union[int, None] = None) -> bool:
+        """Build a single target. Runs in its own process when called by the scheduler.
+
+        :param Config config: The parsed config of the target.
+        :param int cores: The number of cores allotted to the build.
+        :returns: True on success, False on failure.
+        :rtype: bool
+        """
+        config_obj = config.config
+        staging = BuildStaging(config_obj)
+        with DiskBudget.use(config_obj["build_path"]):
+            staging.stage()
             # Generate the legal information first, as to ensure the tarball is in the images
             # directory before post-image.sh is called.
             if config_obj["legal_info"]:
                 if not Buildroot.legal_info(config_obj):
                     return False
-            if not Buildroot.build(config_obj):
+            built = Buildroot.build(config_obj, cores)
+            if not built and staging.full():
+                # The tmpfs filled up, carry on from where the build stopped on disk.
+                staging.spill()
+                built = Buildroot.build(config_obj, cores)
+            if BuildStaging.enabled(config_obj):
+                staging.record()
+            if not built:
                 return False
-            if self.clean_after_build:
-                config.clean(force=True)
+        if self.clean_after_build:
+            config.clean(force=True)
         return True
 
+    def __job(self, config: Config) -> BuildJob:
+        build_path = config.config["build_path"]
+        name = build_path.rsplit("/", maxsplit=1)[-1]
+        return BuildJob(
+            name, build_path, partial(self.__build_target, config), config.config
+        )
+
+    @staticmethod
+    def add_arguments(
+        parser: argparse.ArgumentParser, env_files_help: str, target: bool = True
+    ) -> None:
+        """Add the env files, and the --target, arguments of the command line tools.
+
+        :param argparse.ArgumentParser parser: The parser of the tool.
+        :param str env_files_help: What the tool uses the env files for.
+        :param bool target: Also add --target, defaulting to SINGLE_TARGET.
+        """
+        parser.add_argument(
+            "env_files",
+            nargs="*",
+            default=os.environ.get("ENV_FILES", "x86_64.json").replace('"', "").split(":"),
+            help=f"{env_files_help}. Default: ENV_FILES",
+        )
+        if target:
+            parser.add_argument(
+                "--target", default=os.environ.get("SINGLE_TARGET", ""), help="Only this target"
+            )
+
+    @staticmethod
+    def parse_env_files(env_files: List[str], target: str = "") -> List[Config]:
+        """Parse the env files of a command line tool, exiting if one can't be parsed.
+
+        :param List[str] env_files: The env files.
+        :param str target: Only this target, IE: raspberrypi4, as SINGLE_TARGET.
+        :returns: The parsed configs of every env file.
+        :rtype: List[Config]
+        """
+        configs: List[Config] = []
+        for env_file in env_files:
+            init = InitParse(env_file, False, True, False)
+            if not init.parse():
+                sys.exit(-1)
+            configs += [
+                config
+                for config in init.targets
+                if not target or target == config.config["defconfig"].replace("_defconfig", "")
+            ]
+        return configs
+
+    @staticmethod
+    def concurrency() -> int:
+        """Get the number of targets cleaned and applied at once.
+
+        :returns: APPLY_JOBS, or the number of cores if not set.
+        :rtype: int
+        """
+        try:
+            jobs = int(os.environ.get("APPLY_JOBS", "0"))
+        except ValueError:
+            jobs = 0
+        return jobs if jobs > 0 else multiprocessing.cpu_count()
+
+    def clean(self) -> bool:
+        """Clean every config that is not skipped, concurrently."""
+        configs = [config for config in self.targets if not config.config["skip"]]
+        results = Runner.gather(
+            [config.clean_async() for config in configs], self.concurrency()
+        )
+        return all(results)
+
+    def apply(self) -> bool:
+        """Apply every config that is not skipped, concurrently."""
+        configs: List[Config] = []
+        for config in self.targets:
+            if config.config["skip"]:
+                self.logger.info(f"Skipping {config.config['defconfig']}")
+                continue
+            configs.append(config)
+        results = Runner.gather(
+            [config.apply_async() for config in configs], self.concurrency()
+        )
+        return all(results)
+
+    def prepare(self) -> bool:
+        """Update Buildroot, then clean and apply every config."""
+        if not self.parse(update=True):
+            return False
+        if not self.clean():
+            return False
+        return self.apply()
+
+    def jobs(self) -> Union[None, List[BuildJob]]:
+        """Get the build jobs of every config that should be built.
+
+        If SINGLE_TARGET is set, only that target is returned, regardless of its build and
+        skip attributes.
+
+        :returns: A list of build jobs, or None on failure or if SINGLE_TARGET does not match
+                  any config.
+        :rtype: Union[None, List[BuildJob]]
+        """
+        single_target = os.environ.get("SINGLE_TARGET", None)
+        if not self.parse_configs():
+            return None
+        jobs: List[BuildJob] = []
+        for config in self.targets:
+            config_obj = config.config
+            if single_target:
+                if single_target == config_obj["defconfig"].replace("_defconfig", ""):
+                    return [self.__job(config)]
+                continue
+            if not config_obj["build"] or config_obj["skip"] or self.no_build:
+                self.logger.info(f"{config_obj['defconfig']}: Skip build step")
+                continue
+            jobs.append(self.__job(config))
+        if single_target:
+            self.logger.error(f"Could not find target: {single_target}")
+            return None
+        return jobs
+
+    @staticmethod
+    def prefetch(jobs: List[BuildJob]) -> bool:
+        """Download the sources of every job before building, unless disabled.
+
+        :param List[BuildJob] jobs: The build jobs of all env files.
+        :returns: True if every source was downloaded or prefetching is disabled.
+        :rtype: bool
+        """
+        if not Prefetch.enabled():
+            return True
+        prefetch = Prefetch()
+        prefetch.add([job.config_obj for job in jobs if job.config_obj is not None])
+        return prefetch.run()
+
+    @staticmethod
+    def verify_downloads(jobs: List[BuildJob]) -> bool:
+        """Check the sources of every job against their hashes before building, unless disabled.
+
+        :param List[BuildJob] jobs: The build jobs of all env files.
+        :returns: True if no source is corrupt or verification is disabled.
+        :rtype: bool
+        """
+        if not DownloadVerify.enabled():
+            return True
+        verify = DownloadVerify()
+        verify.add([job.config_obj for job in jobs if job.config_obj is not None])
+        return verify.run()
+
+    @staticmethod
+    def share_host_tools(jobs: List[BuildJob]) -> bool:
+        """Build the host packages shared by several targets once, unless disabled.
+
+        :param List[BuildJob] jobs: The build jobs of all env files.
+        :returns: True if the shared packages were reused or sharing is disabled.
+        :rtype: bool
+        """
+        if not HostTools.enabled():
+            return True
+        host_tools = HostTools()
+        host_tools.add([job.config_obj for job in jobs if job.config_obj is not None])
+        return host_tools.run()
+
+    @staticmethod
+    def enforce_disk_budget(jobs: List[BuildJob]) -> bool:
+        """Trim and evict the least recently used targets if over the disk budget.
+
+        :param List[BuildJob] jobs: The build jobs of all env files, which are kept.
+        :returns: True if the targets are within the budget or there is no budget.
+        :rtype: bool
+        """
+        if not DiskBudget.enabled():
+            return True
+        config_objs = [job.config_obj for job in jobs if job.config_obj is not None]
+        disk_budget = DiskBudget()
+        disk_budget.add({str(config_obj["output_dir"]) for config_obj in config_objs})
+        disk_budget.protect(str(config_obj["build_path"]) for config_obj in config_objs)
+        return disk_budget.run()
+
+    def run(self) -> bool:
+        """Run all the steps."""
+        if not self.prepare():
+            return False
+        jobs = self.jobs()
+        if jobs is None:
+            return False
+        self.prefetch(jobs)
+        self.verify_downloads(jobs)
+        self.share_host_tools(jobs)
+        self.enforce_disk_budget(jobs)
+        scheduler = Scheduler()
+        for job in jobs:
+            scheduler.add(job)
+        return scheduler.run()
+
     def __init__(
         self,
         env_file: str,
@@ -108,3 +331,4 @@ class InitParse:
         self.fragments = None
         self.no_build = no_build
         self.clean_after_build = clean_after_build
+        self.targets: Union[None, List[Config]] = None
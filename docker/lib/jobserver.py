@@ -0,0 +1,107 @@
+"""A GNU make jobserver shared by every target build"""
+import os
+import errno
+import select
+import contextlib
+from typing import Dict, Iterator, Tuple, Union
+
+
+class Jobserver:
+    """Own a GNU make jobserver and hand it to every make the builds run.
+
+    The jobserver is a pipe holding one token per core of the budget. Each make started
+    with it in MAKEFLAGS is a jobserver client: it runs its first job for free and reads a
+    token from the pipe for every other job it runs at the same time, including the jobs of
+    the package sub-makes Buildroot starts. A build takes a token of its own before starting
+    its top-level make to pay for that free job, so the number of jobs running across all
+    packages of all targets never exceeds the number of tokens.
+
+    Buildroot only passes -j$(PARALLEL_JOBS) to package builds if MAKEFLAGS has no -j, so
+    with the jobserver BR2_JLEVEL is not used. Packages built by ninja do not take part in
+    the jobserver and still use BR2_JLEVEL.
+
+    The pipe style of --jobserver-auth is used rather than a fifo, as it is understood by
+    GNU make 4.2 and later.
+
+    Set JOBSERVER=false to divide the cores between the targets instead.
+    """
+
+    # The jobserver created by the scheduler, inherited by the forked build processes.
+    active: Union[None, "Jobserver"] = None
+
+    @staticmethod
+    def enabled() -> bool:
+        """Check if builds share a jobserver.
+
+        :returns: True unless JOBSERVER is set to false.
+        :rtype: bool
+        """
+        return os.environ.get("JOBSERVER", "true").lower() != "false"
+
+    @property
+    def fds(self) -> Tuple[int, int]:
+        """The read and write ends of the jobserver pipe, to keep open in make."""
+        return self.read_fd, self.write_fd
+
+    def env(self) -> Dict[str, str]:
+        """Get an environment that makes make a client of the jobserver.
+
+        MAKEFLAGS inherited from a calling make is replaced, as its jobserver is not passed on.
+
+        :returns: A copy of the environment with MAKEFLAGS set.
+        :rtype: Dict[str, str]
+        """
+        return dict(
+            os.environ,
+            MAKEFLAGS=f"-j{self.tokens} --jobserver-auth={self.read_fd},{self.write_fd}",
+        )
+
+    def acquire(self) -> None:
+        """Take a token, waiting until one is free.
+
+        GNU make 4.3 makes the shared read end non-blocking, so a read with no token free
+        fails with EAGAIN rather than waiting.
+        """
+        while True:
+            try:
+                token = os.read(self.read_fd, 1)
+            except InterruptedError:
+                continue
+            except BlockingIOError:
+                select.select([self.read_fd], [], [])
+                continue
+            if not token:
+                raise OSError(errno.EPIPE, "The jobserver pipe is closed")
+            return
+
+    def release(self) -> None:
+        """Give a token back."""
+        os.write(self.write_fd, b"+")
+
+    @contextlib.contextmanager
+    def slot(self) -> Iterator[None]:
+        """Hold a token while running a top-level make."""
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def close(self) -> None:
+        """Close the jobserver pipe."""
+        for fd in self.fds:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        if Jobserver.active is self:
+            Jobserver.active = None
+
+    def __init__(self, tokens: int):
+        """Initialize the class.
+
+        :param int tokens: The number of jobs that may run at once.
+        """
+        self.tokens = max(tokens, 1)
+        self.read_fd, self.write_fd = os.pipe()
+        os.write(self.write_fd, b"+" * self.tokens)
@@ -0,0 +1,130 @@
+"""Kconfig (defconfig and .config) parsing"""
+import os
+from typing import Dict, Tuple, Union
+
+
+class KConfig:
+    """A parsed Kconfig file.
+
+    Use KConfig.load() instead of instantiating this class directly; parsed files are cached
+    and only re-read when their mtime or size changes.
+
+    - "# SYMBOL is not set" lines are kept as explicitly unset symbols.
+    - String values are unquoted and unescaped.
+    - $(TOPDIR) is expanded to the Buildroot directory.
+    """
+
+    __cache: Dict[Tuple[str, str], "KConfig"] = {}
+
+    @staticmethod
+    def load(path: str, topdir: str = "") -> "KConfig":
+        """Get the parsed model of a Kconfig file.
+
+        :param str path: The path of the defconfig or .config.
+        :param str topdir: The Buildroot directory used to expand $(TOPDIR).
+        :returns: The parsed file.
+        :rtype: KConfig
+        :raises FileNotFoundError: If path does not exist.
+        """
+        stat = os.stat(path)
+        signature = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        key = (os.path.abspath(path), topdir)
+        cached = KConfig.__cache.get(key)
+        if cached is not None and cached.signature == signature:
+            return cached
+        kconfig = KConfig(path, topdir, signature)
+        KConfig.__cache[key] = kconfig
+        return kconfig
+
+    @staticmethod
+    def invalidate(path: str) -> None:
+        """Drop a file from the cache, IE: after writing it within the mtime granularity.
+
+        :param str path: The path of the defconfig or .config.
+        """
+        path = os.path.abspath(path)
+        for key in [key for key in KConfig.__cache if key[0] == path]:
+            del KConfig.__cache[key]
+
+    @staticmethod
+    def unquote(value: str) -> str:
+        """Strip the quotes and escapes from a Kconfig string value.
+
+        :param str value: A raw value.
+        :returns: The unquoted value.
+        :rtype: str
+        """
+        if len(value) >= 2 and value[0] == '"' and value[-1] == '"':
+            return value[1:-1].replace('\\"', '"').replace("\\\\", "\\")
+        return value
+
+    @staticmethod
+    def parse_line(line: str) -> Union[None, Tuple[str, Union[None, str]]]:
+        """Parse a single Kconfig line.
+
+        :param str line: A line of a defconfig, .config or fragment.
+        :returns: None for comments and blank lines, otherwise a tuple of the symbol and its
+                  raw value. The value is None if the symbol is not set.
+        :rtype: Union[None, Tuple[str, Union[None, str]]]
+        """
+        line = line.strip()
+        if not line:
+            return None
+        if line[0] == "#":
+            if line.endswith(" is not set"):
+                symbol = line[1:-len(" is not set")].strip()
+                if symbol and " " not in symbol:
+                    return symbol, None
+            return None
+        symbol, sep, value = line.partition("=")
+        if not sep or not symbol:
+            return None
+        return symbol.strip(), value.strip()
+
+    def get(self, symbol: str, default: Union[None, str] = None) -> Union[None, str]:
+        """Get the value of a symbol.
+
+        :param str symbol: The symbol of which to get, IE: BR2_DL_DIR.
+        :param default: A default value to return if the symbol is not set.
+        :returns: The unquoted, expanded value, or the default value.
+        :rtype: Union[None, str]
+        """
+        value = self.values.get(symbol)
+        if value is None:
+            return default
+        return value
+
+    def is_set(self, symbol: str) -> bool:
+        """Check if a symbol has a value.
+
+        :param str symbol: The symbol of which to check.
+        :returns: True if the symbol has a value, False if it is not set or missing.
+        :rtype: bool
+        """
+        return self.values.get(symbol) is not None
+
+    def __parse(self) -> None:
+        with open(self.path, encoding="utf-8") as kconfig_fd:
+            for line in kconfig_fd:
+                parsed = self.parse_line(line)
+                if parsed is None:
+                    continue
+                symbol, value = parsed
+                self.raw[symbol] = value
+                if value is None:
+                    self.values[symbol] = None
+                    continue
+                value = self.unquote(value)
+                if self.topdir:
+                    value = value.replace("$(TOPDIR)", self.topdir)
+                self.values[symbol] = value
+
+    def __init__(self, path: str, topdir: str = "", signature: Tuple[int, int, int] = None):
+        self.path = path
+        self.topdir = topdir
+        self.signature = signature
+        # The raw values as written in the file, None if the symbol is not set.
+        self.raw: Dict[str, Union[None, str]] = {}
+        # The unquoted and expanded values, None if the symbol is not set.
+        self.values: Dict[str, Union[None, str]] = {}
+        self.__parse()
@@ -0,0 +1,210 @@
+"""Legal information generation"""
+import os
+import json
+import shutil
+import hashlib
+import subprocess
+import multiprocessing
+from typing import Any, Dict, Union
+from lib.build_log import BuildLog
+from lib.fingerprint import Fingerprint
+from lib.logger import Logger
+from lib.packages import Packages
+from lib.runner import Runner
+
+
+class LegalInfo:
+    """Generate the legal-info tarball of a target.
+
+    - The sources Buildroot saves for redistribution are not wanted in the tarball. They are
+      collected outside of legal-info/, in .retroroot/legal-sources, where Buildroot hardlinks
+      them from the download directory, and removed afterwards. legal-info.sha256 then only
+      lists the files that are shipped.
+    - License files are stored once, content-addressed, in <output dir>/.legal-info-store and
+      hardlinked into each target's legal-info. Identical license texts take the space of one
+      file across all targets, and tar stores them once per tarball.
+    - The tarball is compressed with pigz on all cores if it is installed, gzip otherwise.
+    - Tarballs are cached in <output dir>/.legal-info-cache, keyed on the Buildroot version,
+      the target's .config, which the tarball ships as buildroot.config, and the name,
+      version and licenses of every package. A target whose configuration did not change
+      reuses the cached tarball without running make legal-info.
+    """
+
+    @staticmethod
+    def __link(store_path: str, path: str) -> None:
+        """Atomically replace a file with a hardlink to its stored copy."""
+        tmp_path = f"{path}.store.{os.getpid()}"
+        try:
+            os.link(store_path, tmp_path)
+            os.replace(tmp_path, path)
+        except OSError:
+            if os.path.lexists(tmp_path):
+                os.remove(tmp_path)
+
+    @staticmethod
+    def __prune(directory: str, keep: str = "") -> None:
+        """Remove the entries of a store that are no longer linked from anywhere else."""
+        for root, _, names in os.walk(directory):
+            for name in names:
+                path = f"{root}/{name}"
+                try:
+                    if path != keep and os.stat(path).st_nlink == 1:
+                        os.remove(path)
+                except OSError:
+                    continue
+
+    def key(self) -> Union[None, str]:
+        """Get the cache key of the target's legal information.
+
+        :returns: A hex digest, or None if the packages or .config could not be read.
+        :rtype: Union[None, str]
+        """
+        config_digest = Fingerprint.hash_file(f"{self.build_path}/.config")
+        if config_digest is None:
+            return None
+        info = Packages.show_info(self.config_obj)
+        if not info:
+            return None
+        packages: Dict[str, Any] = {
+            package: [package_info.get("version"), package_info.get("licenses")]
+            for package, package_info in info.items()
+            if isinstance(package_info, dict)
+        }
+        payload = {
+            "buildroot-version": Fingerprint.buildroot_version(self.buildroot_path),
+            "config": config_digest,
+            "packages": packages,
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+    def deduplicate(self) -> int:
+        """Replace every license file with a hardlink into the content-addressed store.
+
+        :returns: The number of bytes saved.
+        :rtype: int
+        """
+        saved = 0
+        for licenses in ("licenses", "host-licenses"):
+            for root, _, names in os.walk(f"{self.legal_info_path}/{licenses}"):
+                for name in names:
+                    path = f"{root}/{name}"
+                    if os.path.islink(path) or not os.path.isfile(path):
+                        continue
+                    digest = Fingerprint.hash_file(path)
+                    if digest is None:
+                        continue
+                    store_path = f"{self.store_path}/{digest[:2]}/{digest}"
+                    os.makedirs(os.path.dirname(store_path), exist_ok=True)
+                    if os.path.exists(store_path):
+                        if not os.path.samefile(store_path, path):
+                            saved += os.path.getsize(path)
+                            self.__link(store_path, path)
+                        continue
+                    try:
+                        os.link(path, store_path)
+                    except FileExistsError:
+                        saved += os.path.getsize(path)
+                        self.__link(store_path, path)
+                    except OSError:
+                        continue
+        return saved
+
+    def compress(self, tarball: str) -> bool:
+        """Compress legal-info into a tarball.
+
+        :param str tarball: The path of the tarball of which to write.
+        :returns: True on success, False on failure.
+        :rtype: bool
+        """
+        tmp_tarball = f"{tarball}.tmp"
+        cmd = ["tar", "--sort=name", "-C", self.build_path, "-cf", tmp_tarball]
+        pigz = shutil.which("pigz")
+        if pigz:
+            cmd += [f"--use-compress-program={pigz} -p {multiprocessing.cpu_count()}"]
+        else:
+            cmd += ["--gzip"]
+        cmd += ["legal-info"]
+        try:
+            subprocess.run(cmd, check=True)
+        except (OSError, subprocess.SubprocessError) as err:
+            self.logger.error(f"Failed to compress {self.legal_info_path}: {err}")
+            if os.path.exists(tmp_tarball):
+                os.remove(tmp_tarball)
+            return False
+        os.replace(tmp_tarball, tarball)
+        return True
+
+    def __install(self, cached: str) -> bool:
+        """Link a cached tarball into the images directory."""
+        os.makedirs(os.path.dirname(self.tarball), exist_ok=True)
+        tmp_tarball = f"{self.tarball}.tmp"
+        try:
+            if os.path.lexists(tmp_tarball):
+                os.remove(tmp_tarball)
+            try:
+                os.link(cached, tmp_tarball)
+            except OSError:
+                shutil.copyfile(cached, tmp_tarball)
+            os.replace(tmp_tarball, self.tarball)
+        except OSError as err:
+            self.logger.error(f"{self.tarball}: {err}")
+            return False
+        return True
+
+    def run(self) -> bool:
+        """Generate the legal-info tarball into the images directory, or reuse a cached one.
+
+        :returns: True on success, False on failure.
+        :rtype: bool
+        """
+        key = self.key()
+        cached = f"{self.cache_path}/{key}.tar.gz"
+        if key and os.path.isfile(cached):
+            if os.path.isfile(self.tarball) and os.path.samefile(cached, self.tarball):
+                self.logger.info("Legal info already generated.")
+                return True
+            self.logger.info(f"Reusing the legal-info of an identical package set: {cached}")
+            return self.__install(cached)
+
+        self.logger.info(f"Generating legal-info for {self.config_obj['defconfig']}")
+        sources_path = f"{self.build_path}/.retroroot/legal-sources"
+        cmd = (
+            f"{self.config_obj['make']} BR2_DL_DIR={self.config_obj['dl_dir']} "
+            f"REDIST_SOURCES_DIR_TARGET={sources_path}/sources "
+            f"REDIST_SOURCES_DIR_HOST={sources_path}/host-sources legal-info"
+        )
+        try:
+            retval = Runner.run(cmd, cwd=self.build_path)
+        finally:
+            shutil.rmtree(sources_path, ignore_errors=True)
+        if not retval:
+            self.logger.error(
+                f"ERROR: Failed to generate legal information for {self.config_obj['defconfig']}"
+            )
+            if self.config_obj["make"] == "brmake":
+                BuildLog.report(f"{self.build_path}/br.log")
+            return False
+        saved = self.deduplicate()
+        self.logger.info(f"Deduplicated {saved // 1024} KiB of license files")
+        if not key:
+            os.makedirs(os.path.dirname(self.tarball), exist_ok=True)
+            return self.compress(self.tarball)
+        os.makedirs(self.cache_path, exist_ok=True)
+        if not self.compress(cached):
+            return False
+        if not self.__install(cached):
+            return False
+        self.__prune(self.store_path)
+        self.__prune(self.cache_path, keep=cached)
+        return True
+
+    def __init__(self, config_obj: Dict[str, Union[str, bool]]):
+        self.logger = Logger(__name__)
+        self.config_obj = config_obj
+        self.buildroot_path = str(config_obj["buildroot_path"])
+        self.build_path = str(config_obj["build_path"])
+        self.legal_info_path = f"{self.build_path}/legal-info"
+        board_name = str(config_obj["defconfig"]).replace("_defconfig", "")
+        self.tarball = f"{self.build_path}/images/{board_name}-legal-info.tar.gz"
+        self.store_path = f"{config_obj['output_dir']}/.legal-info-store"
+        self.cache_path = f"{config_obj['output_dir']}/.legal-info-cache"
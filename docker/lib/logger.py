@@ -1,13 +1,21 @@
-from inspect import getframeinfo, stack
+import os
+import json
 import logging
+from typing import Dict, Tuple
 
 
 class MyFormatter(logging.Formatter):
-    """Easy format changing for the logger."""
+    """Easy format changing for the logger.
 
-    def __init__(self, fmt):
+    Records logged with the retroroot_caller extra attribute are prefixed with the file name
+    and line number they were logged from. If json is set, records are formatted as a JSON
+    object per line instead.
+    """
+
+    def __init__(self, fmt, json_output=False):
         """Initialize the class."""
         logging.Formatter.__init__(self, fmt)
+        self.json_output = json_output
 
     def format(self, record):
         """Set the log format.
@@ -15,38 +23,57 @@ class MyFormatter(logging.Formatter):
         :param record: A log record format.
         :return: The new message format.
         """
+        caller = None
+        if getattr(record, "retroroot_caller", False):
+            caller = f"{record.pathname}:{str(record.lineno)}"
+        if self.json_output:
+            entry = {
+                "time": self.formatTime(record),
+                "level": record.levelname,
+                "name": record.name,
+                "message": record.getMessage(),
+            }
+            if caller:
+                entry["caller"] = caller
+            if record.exc_info:
+                entry["exception"] = self.formatException(record.exc_info)
+            return json.dumps(entry)
         message = logging.Formatter.format(self, record)
-        check = "\n".join([x for x in message.split("\n")])
-        return check
+        if caller:
+            return f"{caller} {message}"
+        return message
 
 
 class Logger:
-    """Handle logging in a reproducible format."""
+    """Handle logging in a reproducible format.
 
-    @staticmethod
-    def __parse_stack_info(stack_info):
-        """Get the filename and line number for stack output.
+    The handlers of each logger name are set up once and kept in a registry, so constructing
+    a Logger with the same arguments again is cheap. Constructing one with different
+    arguments replaces the handlers of that name, as before.
 
-        :param stack_info: The stack info function return.
-        :return: filename:lineno
-        """
-        caller = getframeinfo(stack_info[1][0])
-        return f"{caller.filename}:{str(caller.lineno)}"
+    Messages below the level of every handler return before a log record is created.
+    Setting the LOG_FORMAT environment variable to "json" prints one JSON object per message.
+    """
 
-    def __set_formatter(self, log_format=None, default=False):
-        """Set the formatter to either a custom format or the default format.
+    # Logger name: (arguments, logging.Logger, stream handler, file handler)
+    __registry: Dict[str, Tuple[tuple, logging.Logger, logging.Handler, logging.Handler]] = {}
 
-        :param log_format: The format for the log message.
-        :param default: If set, the default log format will be used.
+    def __log(self, level, message, args, kwargs, caller=False):
+        """Log a message, skipping all the work if no handler would output it.
+
+        :param level: The logging level of the message.
+        :param message: The message to print.
+        :param args: The args to pass
+        :param kwargs: optional kwargs
+        :param caller: Prefix the message with the file name and line number of the caller.
         """
-        if not default:
-            self.stream_handler.setFormatter(MyFormatter(log_format))
-            if self.file_path:
-                self.file_handler.setFormatter(MyFormatter(log_format))
-        else:
-            self.stream_handler.setFormatter(MyFormatter(self.log_format))
-            if self.file_path:
-                self.file_handler.setFormatter(MyFormatter(self.log_format))
+        if level < self.min_level:
+            return
+        if caller:
+            kwargs["extra"] = dict(kwargs.get("extra") or {}, retroroot_caller=True)
+        # Skip __log and the public method to attribute the record to their caller.
+        kwargs.setdefault("stacklevel", 3)
+        self.logger.log(level, message, *args, **kwargs)
 
     def debug(self, message, *args, **kwargs):
         """Pass-through convenience function to print an debug message.
@@ -55,11 +82,7 @@ class Logger:
         :param args: The args to pass
         :param kwargs: optional kwargs
         """
-        stack_info = self.__parse_stack_info(stack())
-        log_format = f"{stack_info} {self.log_format}"
-        self.__set_formatter(log_format)
-        self.logger.debug(message, *args, **kwargs)
-        self.__set_formatter(default=True)
+        self.__log(logging.DEBUG, message, args, kwargs, caller=True)
 
     def info(self, message, *args, **kwargs):
         """Pass-through convenience function to print an info message.
@@ -68,7 +91,7 @@ class Logger:
         :param args: The args to pass
         :param kwargs: optional kwargs
         """
-        self.logger.info(message, *args, **kwargs)
+        self.__log(logging.INFO, message, args, kwargs)
 
     def warning(self, message, *args, **kwargs):
         """Pass-through convenience function to print an warning message.
@@ -77,7 +100,7 @@ class Logger:
         :param args: The args to pass
         :param kwargs: optional kwargs
         """
-        self.logger.warning(message, *args, **kwargs)
+        self.__log(logging.WARNING, message, args, kwargs)
 
     def error(self, message, *args, **kwargs):
         """Pass-through convenience function to print an error message.
@@ -86,12 +109,7 @@ class Logger:
         :param args: The args to pass
         :param kwargs: optional kwargs
         """
-        if self.level == logging.DEBUG:
-            log_format = f"{self.__parse_stack_info(stack())} {self.log_format}"
-            self.__set_formatter(log_format)
-        self.logger.error(message, *args, **kwargs)
-        if self.level == logging.DEBUG:
-            self.__set_formatter(default=True)
+        self.__log(logging.ERROR, message, args, kwargs, caller=self.level == logging.DEBUG)
 
     def exception(self, message, *args, **kwargs):
         """Pass-through convenience function to print an error with exception information.
@@ -100,12 +118,8 @@ class Logger:
         :param args: The args to pass
         :param kwargs: optional kwargs
         """
-        if self.level == logging.DEBUG:
-            log_format = f"{self.__parse_stack_info(stack())} {self.log_format}"
-            self.__set_formatter(log_format)
-        self.logger.exception(message, *args, **kwargs)
-        if self.level == logging.DEBUG:
-            self.__set_formatter(default=True)
+        kwargs.setdefault("exc_info", True)
+        self.__log(logging.ERROR, message, args, kwargs, caller=self.level == logging.DEBUG)
 
     def critical(self, message, *args, **kwargs):
         """Pass-through convenience function to print a critical error message.
@@ -114,12 +128,7 @@ class Logger:
         :param args: The args to pass
         :param kwargs: optional kwargs
         """
-        if self.level == logging.DEBUG:
-            log_format = f"{self.__parse_stack_info(stack())} {self.log_format}"
-            self.__set_formatter(log_format)
-        self.logger.critical(message, *args, **kwargs)
-        if self.level == logging.DEBUG:
-            self.__set_formatter(default=True)
+        self.__log(logging.CRITICAL, message, args, kwargs, caller=self.level == logging.DEBUG)
 
     def __init__(
         self,
@@ -139,24 +148,37 @@ class Logger:
             self.log_format = "%(asctime)s:%(levelname)s:%(name)s %(message)s"
         if custom_log_format:
             self.log_format = custom_log_format
+        self.min_level = min(stream_level, file_level) if file_path else stream_level
+        json_output = os.environ.get("LOG_FORMAT", "").lower() == "json"
+
+        # A log file opened for writing is truncated on every construction, as before.
+        arguments = (stream_level, self.log_format, file_path, file_level, json_output)
+        registered = self.__registry.get(name)
+        if registered is not None and registered[0] == arguments and not clear_log_file:
+            _, self.logger, self.stream_handler, self.file_handler = registered
+            return
 
         # Create the logger with the given name and level
         self.logger = logging.getLogger(name)
         self.logger.setLevel(logging.DEBUG)
 
         if self.logger.hasHandlers():
+            for handler in self.logger.handlers:
+                handler.close()
             self.logger.handlers.clear()
 
         # Create the stream logger for output handling
         self.stream_handler = logging.StreamHandler()
         self.stream_handler.setLevel(stream_level)
-        self.stream_handler.setFormatter(MyFormatter(self.log_format))
+        self.stream_handler.setFormatter(MyFormatter(self.log_format, json_output))
         self.logger.addHandler(self.stream_handler)
 
+        self.file_handler = None
         if self.file_path:
             self.file_handler = logging.FileHandler(
                 file_path, "w" if clear_log_file else "a"
             )
             self.file_handler.setLevel(file_level)
-            self.file_handler.setFormatter(MyFormatter(self.log_format))
+            self.file_handler.setFormatter(MyFormatter(self.log_format, json_output))
             self.logger.addHandler(self.file_handler)
+        self.__registry[name] = (arguments, self.logger, self.stream_handler, self.file_handler)
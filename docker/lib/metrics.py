@@ -0,0 +1,335 @@
+"""Live build progress, event stream and metrics export"""
+import os
+import json
+import contextlib
+import time
+import threading
+import subprocess
+from typing import Any, Dict, List, Set, Tuple, Union
+from lib.files import Files
+from lib.jobserver import Jobserver
+from lib.logger import Logger
+from lib.runner import Runner
+from lib.state import State
+
+
+class BuildMonitor:
+    """Follow a running build and export what it is doing.
+
+    - The build's output is passed through, with the progress prepended to the ">>> package
+      version step" lines.
+    - Buildroot's build/build-time.log is followed as it is written and every package step
+      start and end is appended to .retroroot/events.jsonl as a JSON line.
+    - A Prometheus textfile-format metrics file is kept up to date in METRICS_DIR, or in
+      .retroroot/ if METRICS_DIR is not set.
+    """
+
+    POLL_INTERVAL = 0.5
+    METRICS_INTERVAL = 5.0
+
+    @staticmethod
+    def parse_build_time_line(line: str) -> Union[None, Tuple[float, str, str, str]]:
+        """Parse a line of build-time.log.
+
+        :param str line: A line such as "1700000000.123456789:start:extract   : zlib".
+        :returns: A tuple of timestamp, "start" or "end", step and package, or None.
+        :rtype: Union[None, Tuple[float, str, str, str]]
+        """
+        fields = line.split(":", maxsplit=3)
+        if len(fields) != 4:
+            return None
+        try:
+            timestamp = float(fields[0])
+        except ValueError:
+            return None
+        return timestamp, fields[1].strip(), fields[2].strip(), fields[3].strip()
+
+    @staticmethod
+    def __label(value: str) -> str:
+        return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    def __count_packages(self) -> Union[None, int]:
+        """Get the number of packages of the build from "make show-targets"."""
+        try:
+            output = subprocess.run(
+                ["make", "-s", "--no-print-directory", "show-targets"],
+                cwd=self.build_path,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                timeout=120,
+                check=True,
+            ).stdout.decode("utf-8", errors="replace")
+        except (OSError, subprocess.SubprocessError):
+            return None
+        packages = output.split()
+        return len(packages) if packages else None
+
+    def __emit(self, event: Dict[str, Any]) -> None:
+        event["target"] = self.target
+        self.events_fd.write(json.dumps(event, sort_keys=True) + "\n")
+        self.events_fd.flush()
+
+    def __handle_build_time(self, line: str) -> None:
+        parsed = self.parse_build_time_line(line)
+        if parsed is None:
+            return
+        timestamp, kind, step, package = parsed
+        with self.lock:
+            if kind == "start":
+                self.started[(package, step)] = timestamp
+                self.__emit(
+                    {"event": "step_start", "time": timestamp, "package": package, "step": step}
+                )
+                return
+            if kind != "end":
+                return
+            duration = max(timestamp - self.started.pop((package, step), timestamp), 0.0)
+            self.step_durations[(package, step)] = (
+                self.step_durations.get((package, step), 0.0) + duration
+            )
+            if step.startswith("install"):
+                self.done.add(package)
+            self.__emit(
+                {
+                    "event": "step_end",
+                    "time": timestamp,
+                    "package": package,
+                    "step": step,
+                    "duration": round(duration, 3),
+                }
+            )
+
+    def __follow(self) -> None:
+        """Read the lines appended to build-time.log until the build stops."""
+        partial = ""
+        log_fd = None
+        while True:
+            stopping = self.stop_event.is_set()
+            if log_fd is None and os.path.isfile(self.build_time_log):
+                log_fd = open(self.build_time_log, encoding="utf-8", errors="replace")
+                log_fd.seek(self.build_time_offset)
+            if log_fd is not None:
+                partial += log_fd.read()
+                *lines, partial = partial.split("\n")
+                for line in lines:
+                    self.__handle_build_time(line)
+            if time.monotonic() - self.metrics_written >= self.METRICS_INTERVAL:
+                self.write_metrics()
+            if stopping:
+                break
+            self.stop_event.wait(self.POLL_INTERVAL)
+        if log_fd is not None:
+            log_fd.close()
+
+    def progress(self) -> str:
+        """Get the progress of the build.
+
+        :returns: "[ 42%]" if the number of packages is known, otherwise "[12 done]".
+        :rtype: str
+        """
+        with self.lock:
+            done = len(self.done)
+        if self.total:
+            return f"[{min(int(100 * done / self.total), 100):3d}%]"
+        return f"[{done} done]"
+
+    def output(self, line: str) -> None:
+        """Pass a line of make output through, adding the progress to package steps.
+
+        :param str line: A line of output from make or brmake.
+        """
+        if line.startswith(">>> "):
+            line = f"{self.progress()} {line}"
+        print(line, end="" if line.endswith("\n") else "\n", flush=True)
+
+    def package_durations(self) -> Dict[str, float]:
+        """Get the time each package spent in its steps so far.
+
+        :returns: A dictionary of package names and seconds.
+        :rtype: Dict[str, float]
+        """
+        package_durations: Dict[str, float] = {}
+        with self.lock:
+            for (package, _), duration in self.step_durations.items():
+                package_durations[package] = package_durations.get(package, 0.0) + duration
+        return package_durations
+
+    def write_metrics(self, success: Union[None, bool] = None) -> None:
+        """Atomically write the Prometheus textfile.
+
+        :param bool success: The result of the build, None while it is running.
+        """
+        target = self.__label(self.target)
+        now = time.time()
+        with self.lock:
+            step_durations = dict(self.step_durations)
+            done = len(self.done)
+        package_durations = self.package_durations()
+        lines: List[str] = [
+            "# HELP retroroot_build_running Whether the target is being built.",
+            "# TYPE retroroot_build_running gauge",
+            f'retroroot_build_running{{target="{target}"}} {0 if self.stopped else 1}',
+            "# HELP retroroot_build_start_time_seconds When the build started.",
+            "# TYPE retroroot_build_start_time_seconds gauge",
+            f'retroroot_build_start_time_seconds{{target="{target}"}} {self.start_time:.3f}',
+            "# HELP retroroot_build_elapsed_seconds How long the build has been running.",
+            "# TYPE retroroot_build_elapsed_seconds gauge",
+            f'retroroot_build_elapsed_seconds{{target="{target}"}} '
+            f"{(self.end_time or now) - self.start_time:.3f}",
+            "# HELP retroroot_build_packages_done Packages that finished installing.",
+            "# TYPE retroroot_build_packages_done gauge",
+            f'retroroot_build_packages_done{{target="{target}"}} {done}',
+        ]
+        if self.total:
+            lines += [
+                "# HELP retroroot_build_packages_total Packages of the build.",
+                "# TYPE retroroot_build_packages_total gauge",
+                f'retroroot_build_packages_total{{target="{target}"}} {self.total}',
+            ]
+        if success is not None:
+            lines += [
+                "# HELP retroroot_build_success Whether the last build succeeded.",
+                "# TYPE retroroot_build_success gauge",
+                f'retroroot_build_success{{target="{target}"}} {1 if success else 0}',
+            ]
+        lines += [
+            "# HELP retroroot_package_step_duration_seconds Time spent in a package step.",
+            "# TYPE retroroot_package_step_duration_seconds gauge",
+        ]
+        for (package, step), duration in sorted(step_durations.items()):
+            lines.append(
+                f'retroroot_package_step_duration_seconds{{target="{target}",'
+                f'package="{self.__label(package)}",step="{self.__label(step)}"}} '
+                f"{duration:.3f}"
+            )
+        lines += [
+            "# HELP retroroot_package_duration_seconds Time spent building a package.",
+            "# TYPE retroroot_package_duration_seconds gauge",
+        ]
+        for package, duration in sorted(package_durations.items()):
+            lines.append(
+                f'retroroot_package_duration_seconds{{target="{target}",'
+                f'package="{self.__label(package)}"}} {duration:.3f}'
+            )
+        os.makedirs(os.path.dirname(self.metrics_path), exist_ok=True)
+        Files.save_atomic(self.metrics_path, "\n".join(lines) + "\n")
+        self.metrics_written = time.monotonic()
+
+    def start(self) -> None:
+        """Start following the build."""
+        os.makedirs(self.state_dir, exist_ok=True)
+        try:
+            self.build_time_offset = os.path.getsize(self.build_time_log)
+        except OSError:
+            self.build_time_offset = 0
+        self.total = self.__count_packages()
+        self.start_time = time.time()
+        self.events_fd = open(self.events_path, "w", encoding="utf-8")
+        self.__emit({"event": "build_start", "time": self.start_time, "packages": self.total})
+        self.write_metrics()
+        self.thread = threading.Thread(target=self.__follow, daemon=True)
+        self.thread.start()
+
+    def stop(self, success: bool) -> None:
+        """Stop following the build and write the final events and metrics.
+
+        :param bool success: The result of the build.
+        """
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.stopped = True
+        self.end_time = time.time()
+        with self.lock:
+            self.__emit(
+                {
+                    "event": "build_end",
+                    "time": self.end_time,
+                    "duration": round(self.end_time - self.start_time, 3),
+                    "success": success,
+                    "packages_done": len(self.done),
+                }
+            )
+        self.events_fd.close()
+        self.write_metrics(success)
+        if success:
+            # build-time.log is appended to by every build, this tells the last one apart.
+            state = State(self.build_path)
+            state.set("build_window", [self.start_time, self.end_time])
+            state.save()
+        self.logger.info(f"{self.target}: events: {self.events_path}")
+        self.logger.info(f"{self.target}: metrics: {self.metrics_path}")
+
+    def run(
+        self,
+        cmds: Union[str, List[str]],
+        timeout: Union[None, float] = None,
+        jobserver: Union[None, Jobserver] = None,
+    ) -> int:
+        """Run build commands, passing their output through while following the build.
+
+        Several commands, IE: a ccache pre-warm then the full build, are followed as one
+        build, in one events file and build window. They run in order until one fails.
+
+        :param Union[str, List[str]] cmds: The shell command, or commands, of which to run.
+        :param float timeout: Kill the commands once they took this many seconds in total.
+        :param Jobserver jobserver: The jobserver to run the commands with, holding a token.
+        :returns: The exit code of the last command run.
+        :rtype: int
+        """
+        if isinstance(cmds, str):
+            cmds = [cmds]
+        self.start()
+        returncode = 1
+        try:
+            with jobserver.slot() if jobserver is not None else contextlib.nullcontext():
+                for cmd in cmds:
+                    remaining = None
+                    if timeout is not None:
+                        remaining = max(timeout - (time.time() - self.start_time), 0.001)
+                    if jobserver is None:
+                        result = Runner.run(
+                            cmd, cwd=self.build_path, timeout=remaining, output=self.output
+                        )
+                    else:
+                        result = Runner.run(
+                            cmd,
+                            cwd=self.build_path,
+                            env=jobserver.env(),
+                            timeout=remaining,
+                            output=self.output,
+                            pass_fds=jobserver.fds,
+                        )
+                    if result.timed_out:
+                        self.logger.error(
+                            f"{self.target}: build timed out after {timeout} seconds"
+                        )
+                    returncode = result.returncode
+                    if returncode:
+                        break
+        finally:
+            self.stop(returncode == 0)
+        return returncode
+
+    def __init__(self, config_obj: Dict[str, Union[str, bool]]):
+        self.logger = Logger(__name__)
+        self.build_path = str(config_obj["build_path"])
+        self.target = self.build_path.rsplit("/", maxsplit=1)[-1]
+        self.state_dir = f"{self.build_path}/.retroroot"
+        self.build_time_log = f"{self.build_path}/build/build-time.log"
+        self.build_time_offset = 0
+        self.events_path = f"{self.state_dir}/events.jsonl"
+        metrics_dir = os.environ.get("METRICS_DIR", "") or self.state_dir
+        self.metrics_path = f"{metrics_dir}/retroroot_{self.target}.prom"
+        self.events_fd = None
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread: Union[None, threading.Thread] = None
+        self.started: Dict[Tuple[str, str], float] = {}
+        self.step_durations: Dict[Tuple[str, str], float] = {}
+        self.done: Set[str] = set()
+        self.total: Union[None, int] = None
+        self.start_time = time.time()
+        self.end_time: Union[None, float] = None
+        self.metrics_written = 0.0
+        self.stopped = False
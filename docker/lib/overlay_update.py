@@ -0,0 +1,297 @@
+"""Overlay-only updates of a built root filesystem image"""
+import os
+import shlex
+import shutil
+import subprocess
+from typing import Dict, List, Tuple, Union
+from lib.fingerprint import Fingerprint
+from lib.kconfig import KConfig
+from lib.logger import Logger
+from lib.runner import Runner
+
+
+class OverlayUpdate:
+    """Write changed BR2_ROOTFS_OVERLAY files straight into the built rootfs.ext2.
+
+    When every file changed since the last build lies in a rootfs overlay, running make only
+    copies the overlays again, runs target-finalize and the post-build scripts, and generates
+    every image from scratch. With OVERLAY_ONLY=true the changed files are written into
+    images/rootfs.ext2 with debugfs instead, with the ownership and mode the file had in the
+    image, or root and the mode Buildroot's overlay copy gives it if it is new. They are also
+    copied into target/, so it matches the image. The post-image scripts are then run as
+    Buildroot runs them, regenerating the sdcard image and mender artifact from the updated
+    rootfs.ext2.
+
+    The fast path is only taken when it gives the same result as make, otherwise the build
+    runs as usual:
+
+    - rootfs.ext2 must be the only root filesystem image, uncompressed.
+    - No overlay file was removed, as it may have replaced a file installed by a package.
+    - The post-build scripts are not run, so changes that they would act on need a build.
+
+    Environment variables:
+      - OVERLAY_ONLY: Update rootfs.ext2 in place when only overlay files changed.
+                      Default: false
+    """
+
+    # Files Buildroot's overlay copy leaves out.
+    EXCLUDED_SUFFIXES = ("~",)
+    EXCLUDED_NAMES = (".empty",)
+
+    @staticmethod
+    def enabled() -> bool:
+        """Check if overlay-only updates are enabled.
+
+        :returns: True if OVERLAY_ONLY is set to true.
+        :rtype: bool
+        """
+        return os.environ.get("OVERLAY_ONLY", "false").lower() == "true"
+
+    def __overlay_files(self, changed: List[str]) -> Union[None, List[Tuple[str, str]]]:
+        """Map the changed files to their path in the root filesystem.
+
+        :returns: A list of (source, path in the rootfs), or None if a change is not an
+                  overlay file the fast path can write.
+        """
+        files: Dict[str, str] = {}
+        for path in changed:
+            overlay = next(
+                (overlay for overlay in self.overlays if path.startswith(f"{overlay}/")), None
+            )
+            if overlay is None:
+                self.logger.info(f"{self.target}: {path} is not in a rootfs overlay")
+                return None
+            name = os.path.basename(path)
+            if name in self.EXCLUDED_NAMES or name.endswith(self.EXCLUDED_SUFFIXES):
+                continue
+            relative = path[len(overlay):]
+            # Later overlays replace the files of earlier ones.
+            for candidate in reversed(self.overlays):
+                if os.path.lexists(f"{candidate}{relative}"):
+                    files[relative] = f"{candidate}{relative}"
+                    break
+            else:
+                self.logger.info(f"{self.target}: {path} was removed")
+                return None
+        return sorted((source, relative) for relative, source in files.items())
+
+    def __debugfs(self, image: str, commands: List[str], write: bool = False) -> str:
+        """Run debugfs commands on an image.
+
+        :returns: The output of debugfs.
+        :raises subprocess.CalledProcessError: If debugfs fails.
+        """
+        cmd = [self.debugfs_bin, "-f", "-"]
+        if write:
+            cmd.append("-w")
+        return subprocess.run(
+            cmd + [image],
+            input="\n".join(commands) + "\n",
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            check=True,
+            text=True,
+        ).stdout
+
+    def __existing(self, image: str, paths: List[str]) -> Dict[str, Tuple[int, int, int]]:
+        """Get the permissions, uid and gid of the paths that exist in an image."""
+        output = self.__debugfs(image, [f'stat "{path}"' for path in paths])
+        existing: Dict[str, Tuple[int, int, int]] = {}
+        path = ""
+        uid = gid = 0
+        for line in output.splitlines():
+            if line.startswith("debugfs:"):
+                path = line.split("stat", maxsplit=1)[-1].strip().strip('"')
+            elif line.startswith("Inode:") and "Mode:" in line:
+                mode = int(line.split("Mode:", maxsplit=1)[1].split()[0], 8)
+                existing[path] = (mode, uid, gid)
+            elif line.startswith("User:") and path in existing:
+                fields = line.split()
+                uid, gid = int(fields[1]), int(fields[3])
+                existing[path] = (existing[path][0], uid, gid)
+        return existing
+
+    def __commands(
+        self, files: List[Tuple[str, str]], existing: Dict[str, Tuple[int, int, int]]
+    ) -> List[str]:
+        """Get the debugfs commands that write the files into the image."""
+        commands: List[str] = []
+        created = set(existing)
+        for source, relative in files:
+            # Create the missing parent directories.
+            parent = os.path.dirname(relative)
+            missing: List[str] = []
+            while parent not in ("", "/") and parent not in created:
+                missing.append(parent)
+                parent = os.path.dirname(parent)
+            for directory in reversed(missing):
+                commands += [
+                    f'mkdir "{directory}"',
+                    f'sif "{directory}" mode 040755',
+                    f'sif "{directory}" uid 0',
+                    f'sif "{directory}" gid 0',
+                ]
+                created.add(directory)
+            stat = os.lstat(source)
+            mode, uid, gid = existing.get(relative, (0, 0, 0))
+            if relative in existing:
+                commands.append(f'rm "{relative}"')
+            if os.path.islink(source):
+                commands.append(f'symlink "{relative}" "{os.readlink(source)}"')
+            else:
+                if relative not in existing:
+                    # rsync --chmod=u=rwX,go=rX, as Buildroot copies overlays.
+                    mode = 0o644 | (0o111 if stat.st_mode & 0o111 else 0)
+                commands += [
+                    f'write "{source}" "{relative}"',
+                    f'sif "{relative}" mode 0{0o100000 | mode:o}',
+                ]
+            commands += [
+                f'sif "{relative}" uid {uid}',
+                f'sif "{relative}" gid {gid}',
+                f'sif "{relative}" mtime @{int(stat.st_mtime)}',
+            ]
+            created.add(relative)
+        return commands
+
+    def __update_target_dir(self, files: List[Tuple[str, str]]) -> None:
+        """Copy the files into target/, as the overlay copy of the next build would."""
+        for source, relative in files:
+            destination = f"{self.build_path}/target{relative}"
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            if os.path.lexists(destination):
+                os.remove(destination)
+            if os.path.islink(source):
+                os.symlink(os.readlink(source), destination)
+                continue
+            shutil.copy2(source, destination)
+            os.chmod(destination, 0o644 | (0o111 if os.stat(source).st_mode & 0o111 else 0))
+
+    def __post_image(self) -> bool:
+        """Run the post-image scripts with the environment Buildroot runs them with."""
+        host_dir = f"{self.build_path}/host"
+        env = dict(
+            os.environ,
+            BR2_CONFIG=f"{self.build_path}/.config",
+            BR2_VERSION=Fingerprint.buildroot_version(self.buildroot_path),
+            HOST_DIR=host_dir,
+            STAGING_DIR=os.path.realpath(f"{self.build_path}/staging"),
+            TARGET_DIR=f"{self.build_path}/target",
+            BUILD_DIR=f"{self.build_path}/build",
+            BINARIES_DIR=f"{self.build_path}/images",
+            BASE_DIR=self.build_path,
+            PATH=f"{host_dir}/bin:{host_dir}/sbin:{os.environ.get('PATH', '')}",
+        )
+        for tree in str(self.config_obj["external_trees"]).split(":"):
+            try:
+                with open(
+                    f"{self.buildroot_path}/{tree}/external.desc", encoding="utf-8"
+                ) as desc:
+                    for line in desc:
+                        if line.startswith("name:"):
+                            name = line.split(":", maxsplit=1)[1].strip()
+                            env[f"BR2_EXTERNAL_{name}_PATH"] = f"{self.buildroot_path}/{tree}"
+            except OSError:
+                continue
+        args = shlex.split(self.kconfig.get("BR2_ROOTFS_POST_SCRIPT_ARGS") or "")
+        for script in (self.kconfig.get("BR2_ROOTFS_POST_IMAGE_SCRIPT") or "").split():
+            self.logger.info(f"{self.target}: running {script}")
+            result = Runner.run(
+                [os.path.join(self.buildroot_path, script), f"{self.build_path}/images"] + args,
+                cwd=self.buildroot_path,
+                env=env,
+                output=lambda line: print(line, end=""),
+            )
+            if not result:
+                self.logger.error(f"{self.target}: {script} failed")
+                return False
+        return True
+
+    def usable(self) -> bool:
+        """Check if the target's root filesystem can be updated in place.
+
+        :rtype: bool
+        """
+        if not self.overlays or not self.debugfs_bin or not self.e2fsck_bin:
+            return False
+        if not os.path.isfile(self.rootfs) or os.path.islink(self.rootfs):
+            return False
+        # Any other root filesystem image would be left stale. The image types are the
+        # BR2_TARGET_ROOTFS_ symbols without a further underscore, IE: _TAR or _SQUASHFS.
+        for symbol in self.kconfig.values:
+            kind = symbol[len("BR2_TARGET_ROOTFS_"):]
+            if symbol.startswith("BR2_TARGET_ROOTFS_") and "_" not in kind and kind != "EXT2":
+                if self.kconfig.get(symbol) == "y":
+                    return False
+        return not any(
+            name.startswith("rootfs.ext2.") for name in os.listdir(f"{self.build_path}/images")
+        )
+
+    def run(self, changed: List[str]) -> bool:
+        """Write the changed overlay files into rootfs.ext2 and regenerate the other images.
+
+        :param List[str] changed: The files changed since the last build.
+        :returns: True if the images were updated, False if the target needs a build.
+        :rtype: bool
+        """
+        if not changed or not self.usable():
+            return False
+        files = self.__overlay_files(changed)
+        if not files:
+            return False
+        self.logger.info(
+            f"{self.target}: only overlay files changed, writing {len(files)} files into "
+            f"{self.rootfs}"
+        )
+        tmp_path = f"{self.rootfs}.overlay.tmp"
+        try:
+            # Update a copy, so a failure leaves the image as it was.
+            shutil.copyfile(self.rootfs, tmp_path)
+            paths = {relative for _, relative in files}
+            for relative in list(paths):
+                while os.path.dirname(relative) not in ("", "/"):
+                    relative = os.path.dirname(relative)
+                    paths.add(relative)
+            existing = self.__existing(tmp_path, sorted(paths))
+            self.__debugfs(tmp_path, self.__commands(files, existing), write=True)
+            # debugfs carries on after a failed command, check every file was written.
+            written = self.__existing(tmp_path, [relative for _, relative in files])
+            missing = [relative for _, relative in files if relative not in written]
+            if missing:
+                raise OSError(f"failed to write {' '.join(missing)}")
+            subprocess.run(
+                [self.e2fsck_bin, "-fn", tmp_path],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                check=True,
+            )
+            os.replace(tmp_path, self.rootfs)
+        except (OSError, subprocess.SubprocessError) as err:
+            self.logger.warning(f"{self.target}: could not update {self.rootfs}: {err}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return False
+        self.__update_target_dir(files)
+        return self.__post_image()
+
+    def __tool(self, name: str) -> str:
+        """Find an e2fsprogs tool, preferring the one Buildroot built."""
+        host_tool = f"{self.build_path}/host/sbin/{name}"
+        if os.access(host_tool, os.X_OK):
+            return host_tool
+        return shutil.which(name) or shutil.which(name, path="/sbin:/usr/sbin") or ""
+
+    def __init__(self, config_obj: Dict[str, Union[str, bool]]):
+        self.logger = Logger(__name__)
+        self.config_obj = config_obj
+        self.buildroot_path = str(config_obj["buildroot_path"])
+        self.build_path = str(config_obj["build_path"])
+        self.target = self.build_path.rsplit("/", maxsplit=1)[-1]
+        self.rootfs = f"{self.build_path}/images/rootfs.ext2"
+        self.kconfig = KConfig.load(f"{self.build_path}/.config", self.buildroot_path)
+        self.overlays = [
+            os.path.join(self.buildroot_path, overlay).rstrip("/")
+            for overlay in (self.kconfig.get("BR2_ROOTFS_OVERLAY") or "").split()
+        ]
+        self.debugfs_bin = self.__tool("debugfs")
+        self.e2fsck_bin = self.__tool("e2fsck")
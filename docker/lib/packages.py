@@ -0,0 +1,180 @@
+"""Package information of a configured target"""
+import os
+import json
+import threading
+from typing import Any, Dict, Iterable, List, Set, Tuple, Union
+from lib.fingerprint import Fingerprint
+from lib.logger import Logger
+from lib.runner import Runner
+
+
+class Packages:
+    """Query the packages of a target through Buildroot's "make show-info"."""
+
+    # The stamp Buildroot writes once every install step of a package is done.
+    INSTALLED_STAMPS = (".stamp_installed", ".stamp_host_installed")
+    # Directories holding the .mk files of packages, relative to Buildroot or an external tree.
+    PACKAGE_DIRS = ("package", "boot", "linux", "toolchain", "fs", "system")
+
+    __cache: Dict[Tuple[str, str], Tuple[Tuple[int, int, int], Dict[str, Any]]] = {}
+    __lock = threading.Lock()
+
+    @staticmethod
+    def show_info(config_obj: Dict[str, Union[str, bool]]) -> Dict[str, Any]:
+        """Get the packages of a target from "make show-info".
+
+        The output is cached for each target and only queried again when its .config
+        changes, as every step of a build asks for it. The returned dictionary is shared and
+        must not be modified.
+
+        :param Dict[str, Union[str, bool]] config_obj: A parsed config object. The target must
+                                                       have been applied.
+        :returns: The show-info dictionary, keyed on package name. Empty on failure.
+        :rtype: Dict[str, Any]
+        """
+        build_path = str(config_obj["build_path"])
+        try:
+            stat = os.stat(f"{build_path}/.config")
+        except OSError:
+            return {}
+        signature = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        key = (os.path.abspath(build_path), str(config_obj["dl_dir"]))
+        with Packages.__lock:
+            cached = Packages.__cache.get(key)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        # stderr is kept for the cause of a failure, the JSON is a line of its own.
+        result = Runner.run(
+            [
+                "make",
+                "-s",
+                "--no-print-directory",
+                f"BR2_DL_DIR={config_obj['dl_dir']}",
+                "show-info",
+            ],
+            cwd=build_path,
+            timeout=300,
+            capture=True,
+        )
+        logger = Logger(__name__)
+        if not result:
+            logger.error(
+                f"{config_obj['defconfig']}: make show-info failed"
+                + (" (timed out)" if result.timed_out else "")
+                + ":\n"
+                + "\n".join(result.output.splitlines()[-20:])
+            )
+            return {}
+        lines = [line for line in result.output.splitlines() if line.startswith("{")]
+        try:
+            info = json.loads(max(lines, key=len) if lines else result.output)
+        except json.decoder.JSONDecodeError as err:
+            logger.error(f"{config_obj['defconfig']}: make show-info: {err}")
+            return {}
+        if not isinstance(info, dict):
+            return {}
+        with Packages.__lock:
+            Packages.__cache[key] = (signature, info)
+        return info
+
+    @staticmethod
+    def package_dirs(buildroot_path: str, external_trees: str) -> Dict[str, str]:
+        """Find the directory of every package, the one holding <package>/<package>.mk.
+
+        :param str buildroot_path: The Buildroot directory.
+        :param str external_trees: The external trees, relative to Buildroot and colon separated.
+        :returns: A dictionary of package names, without the host- prefix, and directories.
+        :rtype: Dict[str, str]
+        """
+        directories: Dict[str, str] = {}
+        trees = [buildroot_path] + [
+            f"{buildroot_path}/{tree}" for tree in external_trees.split(":") if tree
+        ]
+        for tree in trees:
+            for top in Packages.PACKAGE_DIRS:
+                for root, dirs, names in os.walk(f"{tree}/{top}"):
+                    dirs[:] = [name for name in dirs if name not in Fingerprint.SKIP_DIRS]
+                    name = os.path.basename(root)
+                    if f"{name}.mk" in names:
+                        directories[name] = root
+        return directories
+
+    @staticmethod
+    def reverse_dependencies(info: Dict[str, Any], packages: Iterable[str]) -> Set[str]:
+        """Get every package that depends on the given packages, directly or not.
+
+        :param Dict[str, Any] info: The output of show_info().
+        :param Iterable[str] packages: The packages of which to get the dependents.
+        :returns: The dependents, without the given packages themselves.
+        :rtype: Set[str]
+        """
+        seen: Set[str] = set(packages)
+        queue = list(seen)
+        while queue:
+            package = queue.pop()
+            package_info = info.get(package)
+            if not isinstance(package_info, dict):
+                continue
+            for dependent in package_info.get("reverse_dependencies", []):
+                if dependent not in seen:
+                    seen.add(dependent)
+                    queue.append(dependent)
+        return seen - set(packages)
+
+    @staticmethod
+    def build_dir(build_path: str, package: str, package_info: Dict[str, Any]) -> str:
+        """Get the build directory of a package, where Buildroot keeps its stamp files.
+
+        :param str build_path: The output directory of the target.
+        :param str package: The name of the package.
+        :param Dict[str, Any] package_info: The show-info entry of the package.
+        :returns: The path of output/<target>/build/<package>-<version>.
+        :rtype: str
+        """
+        version = str(package_info.get("version") or "").replace("/", "_").replace(" ", "_")
+        if not version:
+            return f"{build_path}/build/{package}"
+        return f"{build_path}/build/{package}-{version}"
+
+    @staticmethod
+    def installed(build_path: str, package: str, info: Dict[str, Any]) -> bool:
+        """Check if a target has installed a package.
+
+        :param str build_path: The output directory of the target.
+        :param str package: The name of the package.
+        :param Dict[str, Any] info: The output of show_info().
+        :rtype: bool
+        """
+        package_info = info.get(package)
+        if not isinstance(package_info, dict):
+            return False
+        build_dir = Packages.build_dir(build_path, package, package_info)
+        return any(
+            os.path.exists(f"{build_dir}/{stamp}") for stamp in Packages.INSTALLED_STAMPS
+        )
+
+    @staticmethod
+    def build_order(info: Dict[str, Any], packages: Iterable[str]) -> List[str]:
+        """Sort packages so that every package comes after its dependencies.
+
+        :param Dict[str, Any] info: The output of show_info().
+        :param Iterable[str] packages: The packages of which to sort.
+        :returns: The packages by the length of their longest dependency chain, then name.
+        :rtype: List[str]
+        """
+        depths: Dict[str, int] = {}
+
+        def depth(package: str) -> int:
+            if package in depths:
+                return depths[package]
+            # 0 while the dependencies are measured, which breaks dependency cycles.
+            depths[package] = 0
+            package_info = info.get(package)
+            if isinstance(package_info, dict):
+                depths[package] = 1 + max(
+                    (depth(dependency) for dependency in package_info.get("dependencies", [])),
+                    default=0,
+                )
+            return depths[package]
+
+        return sorted(packages, key=lambda package: (depth(package), package))
@@ -0,0 +1,209 @@
+"""Source prefetching across targets"""
+import os
+import subprocess
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Tuple, Union
+from lib.logger import Logger
+from lib.packages import Packages
+
+
+class Prefetch:
+    """Download the sources of every target before the builds start.
+
+    The downloads of each target are read from "make show-info". They are deduplicated across
+    targets by download directory and file name, and fetched by a bounded pool of workers so
+    the builds never stall on the network.
+
+    - Files that already exist in the download directory are skipped. Buildroot still checks
+      their hashes when building, and downloads them again on a mismatch.
+    - http, https and ftp sources are fetched directly, trying each of the package's sites in
+      order. Sources from any other method (git, svn, scp, ...), and sources that could not be
+      fetched directly, are downloaded with "make <package>-source", one make per target.
+    - A failed prefetch is not fatal; the build downloads what is missing as usual.
+
+    Environment variables:
+      - PREFETCH_SOURCES: Prefetch the sources of all targets before building. Default: true
+      - PREFETCH_JOBS: The number of concurrent downloads. Default: 8
+      - PREFETCH_MIRROR: A mirror tried before any other site, laid out like
+                         sources.buildroot.net, IE: http://localhost:8000
+    """
+
+    DIRECT_METHODS = {"http", "https", "ftp"}
+    TIMEOUT = 60
+
+    @staticmethod
+    def enabled() -> bool:
+        """Check if prefetching is enabled.
+
+        :returns: True unless PREFETCH_SOURCES is set to false.
+        :rtype: bool
+        """
+        return os.environ.get("PREFETCH_SOURCES", "true").lower() != "false"
+
+    @staticmethod
+    def parse_uri(uri: str) -> Tuple[str, str, bool]:
+        """Split a show-info download uri.
+
+        :param str uri: A uri such as "http|urlencode+http://sources.buildroot.net/zlib".
+        :returns: A tuple of the download method, the site and whether the file name must be
+                  url encoded.
+        :rtype: Tuple[str, str, bool]
+        """
+        method, sep, site = uri.partition("+")
+        if not sep:
+            return "", uri, False
+        method, _, flags = method.partition("|")
+        return method, site.rstrip("/"), flags == "urlencode"
+
+    def add(self, config_objs: List[Dict[str, Union[str, bool]]]) -> None:
+        """Add the downloads of targets.
+
+        The targets must have been applied.
+
+        :param List[Dict[str, Union[str, bool]]] config_objs: Parsed config objects.
+        """
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            infos = list(executor.map(Packages.show_info, config_objs))
+        for config_obj, info in zip(config_objs, infos):
+            if not info:
+                self.logger.warning(
+                    f"{config_obj['defconfig']}: could not list the sources, not prefetching"
+                )
+                continue
+            # make runs from the Buildroot directory, which a relative BR2_DL_DIR is relative to.
+            dl_dir = os.path.join(str(config_obj["buildroot_path"]), str(config_obj["dl_dir"]))
+            for package, package_info in sorted(info.items()):
+                if not isinstance(package_info, dict):
+                    continue
+                dl_subdir = package_info.get("dl_dir") or package
+                for download in package_info.get("downloads", []):
+                    source = download.get("source")
+                    if not source:
+                        continue
+                    path = f"{dl_dir}/{dl_subdir}/{source}"
+                    if path in self.downloads:
+                        continue
+                    self.downloads[path] = {
+                        "package": package,
+                        "dl_subdir": dl_subdir,
+                        "source": source,
+                        "uris": download.get("uris", []),
+                        "config_obj": config_obj,
+                    }
+
+    def __urls(self, download: Dict[str, Any]) -> Union[None, List[str]]:
+        """Get the urls from which a file can be fetched directly.
+
+        :returns: The urls in order, or None if the file must be downloaded through make.
+        """
+        urls: List[str] = []
+        if self.mirror:
+            urls.append(f"{self.mirror}/{download['dl_subdir']}/{download['source']}")
+            urls.append(f"{self.mirror}/{download['source']}")
+        for uri in download["uris"]:
+            method, site, urlencode = self.parse_uri(uri)
+            if method not in self.DIRECT_METHODS:
+                return None
+            source = urllib.parse.quote(download["source"]) if urlencode else download["source"]
+            urls.append(f"{site}/{source}")
+        return urls
+
+    def __fetch(self, path: str, urls: List[str]) -> bool:
+        """Fetch a file from the first url that has it."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.prefetch.{os.getpid()}.tmp"
+        for url in urls:
+            try:
+                with urllib.request.urlopen(url, timeout=self.TIMEOUT) as response:
+                    with open(tmp_path, "wb") as tmp_fd:
+                        while True:
+                            chunk = response.read(1024 * 1024)
+                            if not chunk:
+                                break
+                            tmp_fd.write(chunk)
+                os.replace(tmp_path, path)
+                self.logger.info(f"Fetched {os.path.basename(path)} from {url}")
+                return True
+            except (OSError, ValueError, urllib.error.URLError) as err:
+                self.logger.debug(f"{url}: {err}")
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        return False
+
+    def __make_source(self, config_obj: Dict[str, Union[str, bool]], packages: List[str]) -> bool:
+        """Download the sources of packages of a single target through make."""
+        cmd = [
+            "make",
+            f"BR2_DL_DIR={config_obj['dl_dir']}",
+        ] + [f"{package}-source" for package in packages]
+        self.logger.info(f"{config_obj['defconfig']}: make source for {' '.join(packages)}")
+        try:
+            subprocess.run(
+                cmd,
+                cwd=config_obj["build_path"],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                check=True,
+            )
+        except (OSError, subprocess.SubprocessError):
+            self.logger.warning(f"{config_obj['defconfig']}: make source failed")
+            return False
+        return True
+
+    def run(self) -> bool:
+        """Download every missing source.
+
+        :returns: True if every source is in its download directory, otherwise False.
+        :rtype: bool
+        """
+        missing = {
+            path: download
+            for path, download in self.downloads.items()
+            if not os.path.exists(path)
+        }
+        self.logger.info(
+            f"Prefetching {len(missing)} of {len(self.downloads)} sources "
+            f"with {self.jobs} workers"
+        )
+        if not missing:
+            return True
+        direct: List[Tuple[str, List[str]]] = []
+        through_make: Dict[str, Tuple[Dict[str, Union[str, bool]], List[str]]] = {}
+        for path, download in missing.items():
+            urls = self.__urls(download)
+            if urls is None:
+                config_obj = download["config_obj"]
+                entry = through_make.setdefault(config_obj["build_path"], (config_obj, []))
+                if download["package"] not in entry[1]:
+                    entry[1].append(download["package"])
+                continue
+            direct.append((path, urls))
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            results = list(executor.map(lambda item: self.__fetch(*item), direct))
+            # Sources that could not be fetched directly get a second chance through make.
+            for (path, _), fetched in zip(direct, results):
+                if fetched:
+                    continue
+                download = missing[path]
+                config_obj = download["config_obj"]
+                entry = through_make.setdefault(config_obj["build_path"], (config_obj, []))
+                if download["package"] not in entry[1]:
+                    entry[1].append(download["package"])
+            list(executor.map(lambda entry: self.__make_source(*entry), through_make.values()))
+        failed = [path for path in missing if not os.path.exists(path)]
+        for path in failed:
+            self.logger.warning(f"Could not prefetch {path}")
+        return not failed
+
+    def __init__(self):
+        self.logger = Logger(__name__)
+        try:
+            self.jobs = max(int(os.environ.get("PREFETCH_JOBS", 8)), 1)
+        except ValueError:
+            self.jobs = 8
+        self.mirror = os.environ.get("PREFETCH_MIRROR", "").rstrip("/")
+        # Keyed on the path of the file in the download directory.
+        self.downloads: Dict[str, Dict[str, Any]] = {}
@@ -0,0 +1,345 @@
+"""Incremental rebuilds of the packages affected by external tree changes"""
+import os
+import json
+import subprocess
+from typing import Any, Dict, List, Set, Tuple, Union
+from lib.build_staging import BuildStaging
+from lib.files import Files
+from lib.fingerprint import Fingerprint
+from lib.kconfig import KConfig
+from lib.logger import Logger
+from lib.packages import Packages
+
+
+class RebuildPlanner:
+    """Plan the steps needed to bring a build up to date with its external trees.
+
+    Buildroot does not notice when the files of an in-tree package, a global patch or a
+    kernel config fragment change after the package was built. The external trees are
+    snapshot after each successful build; before the next build the changed files are mapped
+    to packages:
+
+    - A file in a package directory (the directory holding <package>.mk) maps to the package.
+    - A file in <BR2_GLOBAL_PATCH_DIR>/<package>/ maps to the package.
+    - A file referenced by a package's config option, IE: BR2_LINUX_KERNEL_CUSTOM_CONFIG_FILE
+      or BR2_PACKAGE_RPI_FIRMWARE_CONFIG_FILE, maps to that package.
+    - A patch to Buildroot itself, in <external tree>/patches/buildroot, maps to the packages
+      whose files it changes, IE: package/<package>/, from its diff or, once removed, its
+      name. A patch to Buildroot's infrastructure, IE: package/pkg-generic.mk, or one that
+      can't be mapped, needs a full rebuild: the target is cleaned with make clean.
+    - Anything else, IE: overlays and post-build or post-image scripts, only needs the target
+      finalization and images, which every make regenerates.
+
+    The changed packages are cleaned with <package>-dirclean. The packages that depend on them
+    are marked for rebuilding (for reconfiguring with per-package directories, so their
+    per-package host and staging directories are prepared again). The build that follows
+    then only builds what was cleaned and regenerates the images.
+    """
+
+    # Config options that reference files or directories, whose prefix names a package.
+    PATH_SYMBOL_PREFIXES = {
+        "BR2_LINUX_KERNEL_": "linux",
+        "BR2_PACKAGE_": "",
+        "BR2_TARGET_": "",
+    }
+
+    # The patches applied to Buildroot when the container is built, see the Dockerfile.
+    BUILDROOT_PATCH_DIR = "patches/buildroot"
+    # Top-level Buildroot directories that only change what every make regenerates.
+    IMAGE_DIRS = ("board", "configs", "docs", "fs")
+
+    def __scan(self) -> Dict[str, List[Any]]:
+        """Stat every file of the external trees, hashing those that changed since the last
+        snapshot.
+
+        :returns: A dictionary of paths and their [mtime_ns, size, sha256].
+        """
+        old = self.snapshot or {}
+        files: Dict[str, List[Any]] = {}
+        skip = {
+            os.path.realpath(str(path))
+            for path in (self.config_obj["output_dir"], self.dl_dir)
+        }
+        for tree in str(self.config_obj["external_trees"]).split(":"):
+            tree_path = f"{self.buildroot_path}/{tree}"
+            for root, dirs, names in os.walk(tree_path, followlinks=False):
+                dirs[:] = [
+                    name
+                    for name in dirs
+                    if name not in Fingerprint.SKIP_DIRS
+                    and os.path.realpath(f"{root}/{name}") not in skip
+                ]
+                for name in names:
+                    path = f"{root}/{name}"
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    cached = old.get(path)
+                    if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+                        files[path] = cached
+                        continue
+                    files[path] = [stat.st_mtime_ns, stat.st_size, Fingerprint.hash_file(path)]
+        return files
+
+    def __changed_files(self) -> List[str]:
+        old = self.snapshot or {}
+        changed = [
+            path
+            for path, entry in self.files.items()
+            if path not in old or old[path][2] != entry[2]
+        ]
+        changed += [path for path in old if path not in self.files]
+        return sorted(changed)
+
+    def __path_symbols(self) -> List[Tuple[str, str]]:
+        """Get the package of each path referenced by the package config options."""
+        try:
+            kconfig = KConfig.load(f"{self.build_path}/.config", self.buildroot_path)
+        except OSError:
+            return []
+        paths: List[Tuple[str, str]] = []
+        for symbol, value in kconfig.values.items():
+            if not value or "/" not in value:
+                continue
+            package = self.__symbol_package(symbol)
+            if not package:
+                continue
+            for path in value.split():
+                paths.append((os.path.join(self.buildroot_path, path), package))
+        return paths
+
+    def __symbol_package(self, symbol: str) -> Union[None, str]:
+        """Get the enabled package a config option belongs to.
+
+        BR2_PACKAGE_RPI_FIRMWARE_CONFIG_FILE belongs to rpi-firmware, the longest prefix of the
+        option that names an enabled package.
+        """
+        for prefix, package in self.PATH_SYMBOL_PREFIXES.items():
+            if not symbol.startswith(prefix):
+                continue
+            if package:
+                return package if package in self.info else None
+            words = symbol[len(prefix):].lower().split("_")
+            for ndx in range(len(words), 0, -1):
+                candidate = "-".join(words[:ndx])
+                if candidate in self.info:
+                    return candidate
+        return None
+
+    def __package_of(self, path: str, path_symbols: List[Tuple[str, str]]) -> Union[None, str]:
+        """Get the enabled package a changed file belongs to."""
+        for referenced, package in path_symbols:
+            if path == referenced or path.startswith(f"{referenced.rstrip('/')}/"):
+                return package
+        for patch_dir in self.patch_dirs:
+            if path.startswith(f"{patch_dir}/"):
+                package = path[len(patch_dir) + 1 :].split("/", maxsplit=1)[0]
+                if package in self.info:
+                    return package
+        directory = os.path.dirname(path)
+        while directory.startswith(f"{self.buildroot_path}/"):
+            name = os.path.basename(directory)
+            if os.path.isfile(f"{directory}/{name}.mk") or path == f"{directory}/{name}.mk":
+                return name if name in self.info else None
+            directory = os.path.dirname(directory)
+        return None
+
+    def __buildroot_patch(self, path: str) -> bool:
+        """Check if a changed file is a patch to Buildroot itself."""
+        return any(
+            os.path.dirname(path)
+            == os.path.join(self.buildroot_path, tree, self.BUILDROOT_PATCH_DIR)
+            for tree in str(self.config_obj["external_trees"]).split(":")
+        )
+
+    def __patched_packages(self, path: str) -> Union[None, Set[str]]:
+        """Get the enabled packages a patch to Buildroot changes.
+
+        :returns: The packages, or None if the patch changes more than packages or can't be
+                  mapped.
+        """
+        paths: Set[str] = set()
+        try:
+            with open(path, encoding="utf-8", errors="replace") as patch_fd:
+                for line in patch_fd:
+                    if line.startswith(("--- ", "+++ ")):
+                        patched = line[4:].split("\t", maxsplit=1)[0].strip()
+                        if patched != "/dev/null":
+                            paths.add(patched.split("/", maxsplit=1)[-1])
+        except OSError:
+            # Removed: IE: 0002-package-boost-install-cmake-files.patch
+            name = os.path.basename(path).split("-", maxsplit=1)[-1].rsplit(".", maxsplit=1)[0]
+            if not name.startswith("package-"):
+                return None
+            name = name[len("package-") :]
+            candidates = [
+                package
+                for package in self.info
+                if name == package or name.startswith(f"{package}-")
+            ]
+            return {max(candidates, key=len)} if candidates else None
+        if not paths:
+            return None
+        packages: Set[str] = set()
+        for patched in paths:
+            parts = patched.split("/")
+            if parts[0] in self.IMAGE_DIRS:
+                continue
+            if parts[0] == "linux":
+                packages.update({"linux"} & set(self.info))
+                continue
+            if parts[0] not in ("package", "boot") or len(parts) < 3:
+                return None
+            # package/x11r7/xapp-xinit/xapp-xinit.mk: the deepest directory naming a package.
+            for name in reversed(parts[1:-1]):
+                if name in self.info or f"host-{name}" in self.info:
+                    packages.add(name if name in self.info else f"host-{name}")
+                    break
+        return packages
+
+    def plan(self) -> Dict[str, List[str]]:
+        """Work out which packages to clean.
+
+        :returns: A dictionary of the changed files, the packages to dirclean, the packages
+                  to rebuild and the changed files that need a full rebuild. Empty lists if
+                  there is no previous build to compare with.
+        :rtype: Dict[str, List[str]]
+        """
+        plan: Dict[str, List[str]] = {"changed": [], "dirclean": [], "rebuild": [], "clean": []}
+        if self.snapshot is None or not os.path.isdir(f"{self.build_path}/build"):
+            return plan
+        plan["changed"] = self.__changed_files()
+        if not plan["changed"]:
+            return plan
+        self.info = Packages.show_info(self.config_obj)
+        if not self.info:
+            self.logger.warning(f"{self.target}: could not list the packages, not planning")
+            return plan
+        global_patch_dirs = KConfig.load(
+            f"{self.build_path}/.config", self.buildroot_path
+        ).get("BR2_GLOBAL_PATCH_DIR", "")
+        self.patch_dirs = [
+            os.path.join(self.buildroot_path, path).rstrip("/")
+            for path in global_patch_dirs.split()
+        ]
+        path_symbols = self.__path_symbols()
+        packages: Set[str] = set()
+        for path in plan["changed"]:
+            if self.__buildroot_patch(path):
+                patched = self.__patched_packages(path)
+                if patched is None:
+                    plan["clean"].append(path)
+                    continue
+            else:
+                package = self.__package_of(path, path_symbols)
+                patched = {package} if package else set()
+            for package in patched:
+                packages.add(package)
+                # The host variant is built from the same files.
+                if f"host-{package}" in self.info:
+                    packages.add(f"host-{package}")
+        if plan["clean"]:
+            # Everything is built again, nothing to clean package by package.
+            return plan
+        plan["dirclean"] = sorted(packages)
+        # Filesystem images are not packages; every make regenerates them.
+        plan["rebuild"] = sorted(
+            package
+            for package in Packages.reverse_dependencies(self.info, packages)
+            if self.info.get(package, {}).get("type") != "rootfs"
+        )
+        return plan
+
+    def run(self, plan: Union[None, Dict[str, List[str]]] = None) -> bool:
+        """Plan and clean what changed since the last successful build.
+
+        :param Dict[str, List[str]] plan: A plan returned by plan(), to not plan again.
+        :returns: True on success, False if cleaning failed.
+        :rtype: bool
+        """
+        if plan is None:
+            plan = self.plan()
+        if not plan["changed"]:
+            return True
+        self.logger.info(
+            f"{self.target}: {len(plan['changed'])} files changed since the last build"
+        )
+        if plan["clean"]:
+            self.logger.info(
+                f"{self.target}: {' '.join(os.path.basename(path) for path in plan['clean'])} "
+                "changed Buildroot beyond its packages, rebuilding the target from scratch"
+            )
+            # make clean would only remove the links to build trees staged on tmpfs.
+            BuildStaging.discard(self.build_path)
+            try:
+                subprocess.run(
+                    ["make", "clean"],
+                    cwd=self.build_path,
+                    stdout=subprocess.DEVNULL,
+                    check=True,
+                )
+            except (OSError, subprocess.SubprocessError) as err:
+                self.logger.error(f"{self.target}: failed to clean the target: {err}")
+                return False
+            return True
+        if not plan["dirclean"]:
+            self.logger.info(f"{self.target}: no package changed, regenerating the images")
+            return True
+        self.logger.info(f"{self.target}: dirclean {' '.join(plan['dirclean'])}")
+        step = "reconfigure" if self.config_obj["per_package"] else "rebuild"
+        if plan["rebuild"]:
+            self.logger.info(f"{self.target}: {step} {' '.join(plan['rebuild'])}")
+        # The clean-for-* targets only drop the stamps; the build that follows does the work.
+        targets = [f"{package}-dirclean" for package in plan["dirclean"]]
+        targets += [f"{package}-clean-for-{step}" for package in plan["rebuild"]]
+        try:
+            subprocess.run(
+                ["make", f"BR2_DL_DIR={self.config_obj['dl_dir']}"] + targets,
+                cwd=self.build_path,
+                stdout=subprocess.DEVNULL,
+                check=True,
+            )
+        except (OSError, subprocess.SubprocessError) as err:
+            self.logger.error(f"{self.target}: failed to clean the changed packages: {err}")
+            return False
+        return True
+
+    def save(self) -> bool:
+        """Record the external trees as built. Call after a successful full build.
+
+        :returns: True on success, False on failure.
+        :rtype: bool
+        """
+        os.makedirs(os.path.dirname(self.snapshot_path), exist_ok=True)
+        return Files.save_atomic(self.snapshot_path, json.dumps(self.files))
+
+    def __load(self) -> Union[None, Dict[str, List[Any]]]:
+        try:
+            with open(self.snapshot_path, encoding="utf-8") as snapshot_fd:
+                snapshot = json.load(snapshot_fd)
+            if isinstance(snapshot, dict):
+                return snapshot
+        except (OSError, json.decoder.JSONDecodeError):
+            pass
+        return None
+
+    def __init__(self, config_obj: Dict[str, Union[str, bool]]):
+        """Initialize the class and snapshot the external trees.
+
+        The snapshot is taken before building, so files edited during the build are
+        picked up by the next build.
+
+        :param config_obj: A parsed config object.
+        """
+        self.logger = Logger(__name__)
+        self.config_obj = config_obj
+        self.buildroot_path = str(config_obj["buildroot_path"])
+        self.build_path = str(config_obj["build_path"])
+        self.target = self.build_path.rsplit("/", maxsplit=1)[-1]
+        self.dl_dir = os.path.join(self.buildroot_path, str(config_obj["dl_dir"]))
+        self.snapshot_path = f"{self.build_path}/.retroroot/build_snapshot.json"
+        self.snapshot = self.__load()
+        self.info: Dict[str, Any] = {}
+        self.patch_dirs: List[str] = []
+        self.files = self.__scan()
@@ -0,0 +1,171 @@
+"""Asynchronous external command execution"""
+import os
+import sys
+import signal
+import asyncio
+from typing import Awaitable, Callable, Dict, List, Tuple, Union
+
+
+# pylint: disable=R0903
+class Result:
+    """The outcome of a command run by Runner."""
+
+    def __init__(self, returncode: int, output: str = "", timed_out: bool = False):
+        """Initialize the class.
+
+        :param int returncode: The exit code; negative if the command was killed by a signal.
+        :param str output: The captured output, if capture was requested.
+        :param bool timed_out: True if the command was killed after its timeout.
+        """
+        self.returncode = returncode
+        self.output = output
+        self.timed_out = timed_out
+
+    def __bool__(self) -> bool:
+        return self.returncode == 0
+
+
+class Runner:
+    """Run external commands with asyncio.
+
+    Every command gets its working directory passed explicitly; the process working
+    directory is never changed, so commands of different targets can run concurrently.
+
+    - A str command is run through the shell, a list is executed directly.
+    - Output is read line by line and passed to the output callable, printed by default.
+    - With capture, the output is returned in Result.output instead of being printed.
+    - On timeout or cancellation the whole process group of the command is killed.
+    """
+
+    KILL_GRACE = 10
+    CHUNK_SIZE = 65536
+
+    @staticmethod
+    def __print(line: str) -> None:
+        sys.stdout.write(line)
+        sys.stdout.flush()
+
+    @staticmethod
+    async def __terminate(process: asyncio.subprocess.Process) -> None:
+        """Stop a command and everything it started."""
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            try:
+                os.killpg(process.pid, sig)
+            except (ProcessLookupError, PermissionError):
+                return
+            try:
+                await asyncio.wait_for(process.wait(), Runner.KILL_GRACE)
+                return
+            except asyncio.TimeoutError:
+                continue
+
+    @staticmethod
+    async def run_async(
+        cmd: Union[str, List[str]],
+        cwd: Union[None, str] = None,
+        env: Union[None, Dict[str, str]] = None,
+        timeout: Union[None, float] = None,
+        output: Union[None, Callable[[str], None]] = None,
+        capture: bool = False,
+        stderr: bool = True,
+        pass_fds: Tuple[int, ...] = (),
+    ) -> Result:
+        """Run a command.
+
+        :param cmd: A shell command line, or a list of arguments.
+        :param str cwd: The working directory of the command.
+        :param env: The environment of the command. Default: the current environment.
+        :param float timeout: Kill the command after this many seconds.
+        :param output: A callable passed each line of output. Default: print the line.
+        :param bool capture: Return the output in Result.output instead of passing it on.
+        :param bool stderr: Merge stderr into the output. If False, stderr is discarded.
+        :param pass_fds: File descriptors kept open in the command, IE: a jobserver's.
+        :returns: The result of the command. A command that can't be started returns 127.
+        :rtype: Result
+        """
+        stderr_target = asyncio.subprocess.STDOUT if stderr else asyncio.subprocess.DEVNULL
+        kwargs = {
+            "cwd": cwd,
+            "env": env,
+            "stdin": asyncio.subprocess.DEVNULL,
+            "stdout": asyncio.subprocess.PIPE,
+            "stderr": stderr_target,
+            "pass_fds": pass_fds,
+            # A process group of its own, so it can be killed with everything it started.
+            "start_new_session": True,
+        }
+        try:
+            if isinstance(cmd, str):
+                process = await asyncio.create_subprocess_shell(cmd, **kwargs)
+            else:
+                process = await asyncio.create_subprocess_exec(*cmd, **kwargs)
+        except OSError as err:
+            return Result(127, str(err))
+        output = output or Runner.__print
+        captured: List[bytes] = []
+
+        def emit(line: bytes) -> None:
+            if capture:
+                captured.append(line)
+            else:
+                output(line.decode("utf-8", errors="replace"))
+
+        async def communicate() -> int:
+            # Read in chunks and split the lines here: readline() fails on lines longer than
+            # the stream limit, IE: the compiler command lines of a verbose build.
+            pending: List[bytes] = []
+            while True:
+                chunk = await process.stdout.read(Runner.CHUNK_SIZE)
+                if not chunk:
+                    break
+                if b"\n" not in chunk:
+                    pending.append(chunk)
+                    continue
+                lines = b"".join(pending + [chunk]).split(b"\n")
+                pending = [lines.pop()]
+                for line in lines:
+                    emit(line + b"\n")
+            if b"".join(pending):
+                emit(b"".join(pending))
+            return await process.wait()
+
+        try:
+            returncode = await asyncio.wait_for(communicate(), timeout)
+        except asyncio.TimeoutError:
+            await Runner.__terminate(process)
+            return Result(process.returncode or -signal.SIGKILL, timed_out=True)
+        except BaseException:
+            # Cancelled, or the output callable failed: never leave the command running.
+            await Runner.__terminate(process)
+            raise
+        return Result(returncode, b"".join(captured).decode("utf-8", errors="replace"))
+
+    @staticmethod
+    def run(cmd: Union[str, List[str]], **kwargs) -> Result:
+        """Run a command from synchronous code. Takes the arguments of run_async().
+
+        :returns: The result of the command.
+        :rtype: Result
+        """
+        return asyncio.run(Runner.run_async(cmd, **kwargs))
+
+    @staticmethod
+    def gather(awaitables: List[Awaitable], limit: int = 0) -> List:
+        """Run coroutines concurrently from synchronous code.
+
+        :param awaitables: The coroutines of which to run.
+        :param int limit: The maximum number of coroutines running at once, 0 for no limit.
+        :returns: The results of the coroutines, in order.
+        :rtype: List
+        """
+
+        async def gather() -> List:
+            semaphore = asyncio.Semaphore(limit or max(len(awaitables), 1))
+
+            async def bounded(awaitable: Awaitable):
+                async with semaphore:
+                    return await awaitable
+
+            return await asyncio.gather(*(bounded(awaitable) for awaitable in awaitables))
+
+        return asyncio.run(gather())
@@ -0,0 +1,208 @@
+"""Multi-target build scheduling"""
+import os
+import sys
+import time
+import multiprocessing
+import multiprocessing.connection
+from typing import Callable, Dict, List, Union
+from lib.jobserver import Jobserver
+from lib.logger import Logger
+from lib.state import State
+
+
+# pylint: disable=R0903
+class BuildJob:
+    """A single target build handed to the scheduler."""
+
+    def __init__(
+        self,
+        name: str,
+        build_path: str,
+        func: Callable[[Union[int, None]], bool],
+        config_obj: Union[None, Dict[str, Union[str, bool]]] = None,
+    ):
+        """Initialize the class.
+
+        :param str name: The name of the target, used for reporting.
+        :param str build_path: The output directory of the target.
+        :param func: A callable that builds the target. It is passed the number of cores
+                     allotted to the build, or None to use the defconfig defaults.
+        :param config_obj: The parsed config of the target, if it is a Buildroot build.
+        """
+        self.name = name
+        self.build_path = build_path
+        self.func = func
+        self.config_obj = config_obj
+        self.log_path = f"{build_path}/retroroot.log"
+        self.estimate: Union[float, None] = State(build_path).get("build_seconds")
+        self.duration: float = 0.0
+        self.success: bool = False
+
+
+class Scheduler:
+    """Run several target builds at once under a global core and memory budget.
+
+    Environment variables:
+      - PARALLEL_BUILDS: The maximum number of targets to build at once. Default: 1
+      - BUILD_CORES: The number of cores shared by all running builds. Default: all cores
+      - BUILD_MEMORY: The memory budget in MiB shared by all running builds.
+                      Default: MemAvailable from /proc/meminfo
+      - BUILD_MEMORY_PER_TARGET: The memory in MiB a single target build needs. Default: 4096
+      - JOBSERVER: Share a GNU make jobserver of BUILD_CORES tokens between the builds
+                   rather than dividing the cores between them. Default: true
+
+    With a single build slot, the build keeps the parallelism of its defconfig.
+    """
+
+    @staticmethod
+    def __env_int(name: str, default: int) -> int:
+        try:
+            return max(int(os.environ.get(name, default)), 1)
+        except ValueError:
+            return default
+
+    @staticmethod
+    def __mem_available() -> int:
+        """Get the available memory in MiB.
+
+        :returns: MemAvailable in MiB, or 0 if it can't be determined.
+        :rtype: int
+        """
+        try:
+            with open("/proc/meminfo", encoding="utf-8") as meminfo:
+                for line in meminfo:
+                    if line.startswith("MemAvailable:"):
+                        return int(line.split()[1]) // 1024
+        except (OSError, IndexError, ValueError):
+            pass
+        return 0
+
+    def add(self, job: BuildJob) -> None:
+        """Queue a job.
+
+        :param BuildJob job: The job of which to queue.
+        """
+        self.jobs.append(job)
+
+    def slots(self) -> int:
+        """Get the number of builds that may run at once.
+
+        :returns: The number of build slots.
+        :rtype: int
+        """
+        slots = min(self.parallel_builds, max(len(self.jobs), 1))
+        return max(min(slots, self.memory // self.memory_per_target), 1)
+
+    def __order(self) -> List[BuildJob]:
+        """Order jobs longest-first by their last recorded build time.
+
+        Targets that have never been built are assumed to be full builds and go first.
+        """
+        return sorted(
+            self.jobs,
+            key=lambda job: -job.estimate if job.estimate is not None else -sys.maxsize,
+        )
+
+    @staticmethod
+    def __run_job(job: BuildJob, cores: Union[int, None], redirect: bool) -> None:
+        """The entry point of a forked build process."""
+        if redirect:
+            os.makedirs(job.build_path, exist_ok=True)
+            log_fd = os.open(job.log_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            os.dup2(log_fd, sys.stdout.fileno())
+            os.dup2(log_fd, sys.stderr.fileno())
+            os.close(log_fd)
+        retval = job.func(cores)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        sys.exit(0 if retval else 1)
+
+    def __finish(self, job: BuildJob, exitcode: int, start: float) -> None:
+        job.duration = time.monotonic() - start
+        job.success = exitcode == 0
+        if job.success:
+            state = State(job.build_path)
+            state.set("build_seconds", round(job.duration, 3))
+            state.save()
+            self.logger.info(f"{job.name}: finished in {job.duration:.0f}s")
+        else:
+            self.logger.error(f"{job.name}: failed after {job.duration:.0f}s")
+
+    def report(self) -> None:
+        """Print a summary of every job."""
+        for job in self.jobs:
+            status = "OK" if job.success else "FAILED"
+            line = f"{job.name}: {status} ({job.duration:.0f}s)"
+            if self.slots() > 1:
+                line += f" log: {job.log_path}"
+            if job.success:
+                self.logger.info(line)
+            else:
+                self.logger.error(line)
+
+    def run(self) -> bool:
+        """Run all queued jobs.
+
+        A failing target does not stop the other targets.
+
+        :returns: True if every job succeeded, otherwise False.
+        :rtype: bool
+        """
+        if not self.jobs:
+            return True
+        slots = self.slots()
+        # With a single slot, keep the defconfig's own parallelism unless BUILD_CORES is set,
+        # and print to the console.
+        if slots > 1:
+            cores = max(self.cores // slots, 1)
+        else:
+            cores = self.cores if os.environ.get("BUILD_CORES") else None
+        redirect = slots > 1
+        jobserver = None
+        if slots > 1 and Jobserver.enabled():
+            jobserver = Jobserver(self.cores)
+            Jobserver.active = jobserver
+            self.logger.info(
+                f"Building {len(self.jobs)} targets, {slots} at a time sharing {self.cores} "
+                "jobs through a make jobserver"
+            )
+        elif slots > 1:
+            self.logger.info(
+                f"Building {len(self.jobs)} targets, {slots} at a time with {cores} cores each"
+            )
+        try:
+            self.__dispatch(slots, cores, redirect)
+        finally:
+            if jobserver is not None:
+                jobserver.close()
+        self.report()
+        return all(job.success for job in self.jobs)
+
+    def __dispatch(self, slots: int, cores: Union[int, None], redirect: bool) -> None:
+        """Run the jobs in forked processes, at most slots at a time."""
+        context = multiprocessing.get_context("fork")
+        pending = self.__order()
+        running: Dict[int, tuple] = {}
+        while pending or running:
+            while pending and len(running) < slots:
+                job = pending.pop(0)
+                if redirect:
+                    self.logger.info(f"{job.name}: building, log: {job.log_path}")
+                process = context.Process(
+                    target=self.__run_job, args=(job, cores, redirect), name=job.name
+                )
+                process.start()
+                running[process.sentinel] = (process, job, time.monotonic())
+            ready = multiprocessing.connection.wait(list(running.keys()))
+            for sentinel in ready:
+                process, job, start = running.pop(sentinel)
+                process.join()
+                self.__finish(job, process.exitcode, start)
+
+    def __init__(self):
+        self.logger = Logger(__name__)
+        self.jobs: List[BuildJob] = []
+        self.parallel_builds = self.__env_int("PARALLEL_BUILDS", 1)
+        self.cores = self.__env_int("BUILD_CORES", multiprocessing.cpu_count())
+        self.memory = self.__env_int("BUILD_MEMORY", self.__mem_available() or sys.maxsize)
+        self.memory_per_target = self.__env_int("BUILD_MEMORY_PER_TARGET", 4096)
@@ -0,0 +1,62 @@
+import os
+import json
+from typing import Any, Dict
+from lib.logger import Logger
+
+
+class State:
+    """Persistent per-target state kept in the build directory.
+
+    The state lives in ${build_path}/.retroroot/state.json and survives "make clean", as
+    Buildroot only removes its own directories.
+    """
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """Get a value from the state.
+
+        :param str key: The key of which to get.
+        :param default: A default value to return if the key doesn't exist.
+        :returns: The stored value or the default value.
+        """
+        return self.data.get(key, default)
+
+    def set(self, key: str, value: Any) -> None:
+        """Set a value in the state. Call save() to persist it.
+
+        :param str key: The key of which to set.
+        :param value: A json serializable value.
+        """
+        self.data[key] = value
+
+    def save(self) -> bool:
+        """Atomically write the state to disk.
+
+        :returns: True on success, False on failure.
+        :rtype: bool
+        """
+        try:
+            os.makedirs(self.state_dir, exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as state_fd:
+                json.dump(self.data, state_fd, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.path)
+        except OSError as err:
+            self.logger.warning(f"{self.path}: {err}")
+            return False
+        return True
+
+    def __load(self) -> Dict[str, Any]:
+        try:
+            with open(self.path, encoding="utf-8") as state_fd:
+                data = json.load(state_fd)
+            if isinstance(data, dict):
+                return data
+        except (OSError, json.decoder.JSONDecodeError):
+            pass
+        return {}
+
+    def __init__(self, build_path: str):
+        self.logger = Logger(__name__)
+        self.state_dir = f"{build_path}/.retroroot"
+        self.path = f"{self.state_dir}/state.json"
+        self.data: Dict[str, Any] = self.__load()
@@ -2,6 +2,7 @@
 set -e
 CWD=$(pwd)
 BOARD_DIR="$(realpath "$(dirname "$0")")"
+source "${BOARD_DIR}"/../../common/image-compression-include
 DEVICE_TYPE="rpi4"
 GENIMAGE_CFG="${BOARD_DIR}/genimage.cfg"
 GENIMAGE_TMP="${BUILD_DIR}/genimage.tmp"
@@ -46,7 +47,7 @@ parse_args(){
 create_mender_image(){
   echo "Generating ${PRODUCTION_DIR}/${DEVICE_TYPE}-${VERSION}-${WEEK_NUM}.mender"
   "${BASE_DIR}/host/usr/bin/mender-artifact" \
-    --compression lzma \
+    --compression "$(get_best_compression)" \
     write rootfs-image \
     --no-checksum-provide \
     -t "${DEVICE_TYPE}" \
@@ -107,6 +108,10 @@ finalize(){
   mkdir -p "${PRODUCTION_DIR}"
   echo "cp ${BINARIES_DIR}/sdcard.img ${PRODUCTION_DIR}/${DEVICE_TYPE}.img"
   cp "${BINARIES_DIR}/sdcard.img" "${PRODUCTION_DIR}/${DEVICE_TYPE}.img"
+  compress_images "${PRODUCTION_DIR}" \
+    "${PRODUCTION_DIR}/${DEVICE_TYPE}.img" \
+    "${BINARIES_DIR}/rootfs.ext2" \
+    "${BINARIES_DIR}/data.ext4"
   if [ "${MENDER_ARTIFACT}" == "true" ]; then
     create_mender_image
   fi
@@ -24,6 +24,10 @@ copy_images() {
   if [[ -e ${BINARIES_DIR}"/${MENDER_IMAGE}" ]]; then
      cp -rf "${BINARIES_DIR}"/"${MENDER_IMAGE}" "${IMAGE_DIR}"/"${MENDER_IMAGE}"
   fi
+  compress_images "${IMAGE_DIR}" \
+    "${BINARIES_DIR}"/"${DEVICE_TYPE}".img \
+    "${BINARIES_DIR}"/rootfs.ext2 \
+    "${BINARIES_DIR}"/data-part.ext4
 }
 
 